@@ -38,7 +38,6 @@ __email__ 		= ["bioinformatics@foi.se", "david.sundell@foi.se"]
 __date__ 		= "2020-04-23"
 __status__ 		= "Production"
 
-from CanSNPer2.modules.CanSNPer2 import CanSNPer2
 import logging
 import logging.config
 import os,sys
@@ -48,33 +47,104 @@ import os,sys
 import argparse
 
 
+def run_CanSNPer2(args,query,database,refdir,outdir):
+	'''Create and run a CanSNPer2 object'''
+	from CanSNPer2.modules.CanSNPer2 import CanSNPer2
+	CanSNPer2_obj = CanSNPer2(query,
+									refdir=refdir,
+									verbose=args.verbose,
+									outdir=outdir,
+									tmpdir=args.tmpdir,
+									logdir=args.logdir.rstrip("/")+"/",
+									skip_mauve=args.skip_mauve,
+									save_tree=args.save_tree,
+									tree_format=args.tree_format,
+									render_workers=args.render_workers,
+									keep_temp= args.keep_temp,
+									workdir=args.workdir,
+									export=args.no_snpfiles,
+									database=database,
+									min_required_hits=args.min_required_hits,
+									keep_going=args.keep_going,
+									rerun=args.rerun,
+									incremental=args.incremental,
+									alignment_maps=args.alignment_maps,
+									concat_contigs=args.concat_contigs,
+									min_contig_length=args.min_contig_length,
+									align_profile=args.align_profile,
+									summary=args.summary,
+									strictness=args.strictness,
+									read_input=args.read_input,
+									read_options={"kmer_size": args.kmer_size, "min_depth": args.min_depth, "min_fraction": args.min_allele_fraction, "workers": args.read_workers},
+									sam_input=args.sam_input,
+									sam_options={"min_depth": args.min_depth, "min_fraction": args.min_allele_fraction, "min_base_quality": args.min_base_quality},
+									vcf_input=args.vcf_input,
+									uncalled=args.uncalled
+	)
+
+	if args.validate_profile:
+		CanSNPer2_obj.validate_profile(database)
+		return
+	'''Run CanSNPer2'''
+	CanSNPer2_obj.run(database=database)
+
 def main():
 	'''Initiate CanSNPer2 object'''
 	parser = argparse.ArgumentParser(description='CanSNPer2 ')
 	required_arguments = parser.add_argument_group("Required arguments")
 	required_arguments.add_argument('query', nargs=argparse.ZERO_OR_MORE, 	metavar='query', 		help="File(s) to align (fasta)")
-	required_arguments.add_argument('-db',  '--database', 	metavar='', 							help='CanSNP database')
+	required_arguments.add_argument('-db',  '--database', 	metavar='', action="append",			help='CanSNP database, repeat to route queries to the database of their species')
+	required_arguments.add_argument('--bundle', 			metavar='', 							help='CanSNPer2 bundle (replaces --database and --refdir)')
 
 	output_options = parser.add_argument_group("Output options")
 	output_options.add_argument('-o', '--outdir', 			metavar='DIR', default="results",		help="Output directory")
-	output_options.add_argument('--save_tree',				action='store_true',					help='Save tree as PDF using ETE3 (default False)')
+	output_options.add_argument('--no_tree',				action='store_false', dest="save_tree",	help="Don´t save tree output (trees are saved by default, formats set by --tree_format)")
+	output_options.add_argument('--save_tree',				action='store_true', dest="legacy_save_tree",	help=argparse.SUPPRESS)	## Trees are saved by default, kept for old command lines
+	output_options.add_argument('--tree_format',	nargs="+", default=["svg"], choices=["svg","newick","json","pdf"],
+																									help="Tree output format(s), pdf requires ETE3 and Qt (default svg)")
+	output_options.add_argument('--render_workers',	type=int, default=2,					help="Processes rendering trees in the background, 0 renders trees inline (default 2)")
 	output_options.add_argument('--no_snpfiles', 			action='store_false',					help="Don´t save output files.")
 	output_options.add_argument('--summary',				action='store_true',					help="Output a summary file and tree with all called SNPs\nnot affected by no_snpfiles")
 
 	run_options = parser.add_argument_group("Run options")
-	run_options.add_argument('--refdir', 			metavar='', default="references/",	help="Specify reference directory")
+	run_options.add_argument('--refdir', 			metavar='', action="append",		help="Specify reference directory (default references/, repeat once for each --database)")
 	run_options.add_argument('--workdir',			metavar='',	default="./",			help="Change workdir default (./)")
-	run_options.add_argument('--read_input', 		action='store_true', 				help="Select if input is reads not fasta")
+	run_options.add_argument('--read_input', 		action='store_true', 				help="Select if input is reads not fasta (fastq, gzipped or not, pairs are matched by _1/_2 or _R1/_R2)")
 	run_options.add_argument('--min_required_hits', type=int, default=3, 				help="Minimum sequential hits to call a SNP!")
 	run_options.add_argument('--strictness', 		type=float, default=0.7,			help="Percent of snps in path reqired for calling SNP (default 0.7)")
 	run_options.add_argument('--keep_going', 		action='store_true', 				help="If Error occurs, continue with the rest of samples")
 	run_options.add_argument('--rerun', 			action='store_true', 				help="Rerun already processed files (else skip if result file exists)")
+	run_options.add_argument('--incremental', 		action='store_true', 				help="Only retype references changed in the database since a file was processed")
+	run_options.add_argument('--alignment_maps', 	action='store_true', 				help="Keep compact alignment maps (outdir/alignment_maps), --incremental types changed references from them without aligning")
+	run_options.add_argument('--concat_contigs', 	action='store_true', 				help="Join the contigs of draft assemblies to one sequence before alignment (faster progressiveMauve, contig map in outdir/{query}_contigs.txt)")
+	run_options.add_argument('--min_contig_length', type=int, default=0, 				help="Leave out contigs shorter than this with --concat_contigs (default 0, SNPs on them are not typed)")
+
+	run_options.add_argument('--align_profile',		default="default", choices=["fast","default","sensitive"],
+																						help="progressiveMauve alignment profile, fast skips refinement (default default, recorded in the snps output)")
+	run_options.add_argument('--validate_profile',	action='store_true',				help="Align the queries with --align_profile and the default profile and report per SNP concordance and speedup (outdir/profile_validation_{profile}.txt), no typing")
 
 	'''Remove the two below when script is complete, possibly keep as hidden for debug'''
 	run_options.add_argument('--skip_mauve' ,		action='store_true', 				help="If xmfa files already exists skip step")
 	run_options.add_argument('--keep_temp',			action='store_true', 				help="keep temporary files")
 
 
+	read_options = parser.add_argument_group("Read input options")
+	read_options.add_argument('--sam_input', 		action='store_true', 				help="Input is reads mapped to one of the references (SAM sorted by position, gzipped or not)")
+	read_options.add_argument('--min_base_quality',	type=int, default=20,				help="Minimum base quality of mapped reads at SNPs (--sam_input, default 20)")
+	read_options.add_argument('--vcf_input', 		action='store_true', 				help="Input is variant calls against one of the references (VCF sorted by position, bgzipped or not)")
+	read_options.add_argument('--uncalled',			default="missing", choices=["missing","ancestral","reference"],
+																						help="SNPs of the called reference without a VCF record are missing, ancestral or the reference genome base (default missing)")
+	read_options.add_argument('--read_workers',		type=int, default=os.cpu_count(),	help="Processes counting reads (default number of cpus)")
+	read_options.add_argument('--kmer_size',		type=int, default=31,				help="Length of the k-mers around SNPs matched in reads (default 31)")
+	read_options.add_argument('--min_depth',		type=int, default=3,				help="Minimum reads covering a SNP to call it (default 3)")
+	read_options.add_argument('--min_allele_fraction',	type=float, default=0.8,		help="Minimum fraction of reads supporting the called allele (default 0.8)")
+
+	db_options = parser.add_argument_group("Database options")
+	db_options.add_argument('--db_immutable',		action='store_true',				help="The database is not modified while running (no locking, for downloaded databases)")
+	db_options.add_argument('--db_mmap_size',		type=float, default=256,			help="Size (MB) of the database read through mmap (default 256)")
+	db_options.add_argument('--db_cache_size',		type=float, default=16,				help="Page cache size (MB) of each database connection (default 16)")
+	db_options.add_argument('--max_distance',		type=float, default=0.1,			help="Maximum Mash distance of a query to the closest reference, queries further away are off target (several databases, default 0.1)")
+
 	debugopts = parser.add_argument_group("Logging and debug options")
 	debugopts.add_argument('--tmpdir', 			metavar='', default="/tmp/CanSNPer2",						help="Specify reference directory")
 	debugopts.add_argument('--logdir', 			metavar='', default="logs/", 								help="Specify log directory")
@@ -100,6 +170,8 @@ def main():
 	elif args.verbose:
 		logval = args.verbose
 
+	if args.validate_profile and (args.align_profile == "default" or args.skip_mauve or args.read_input or args.sam_input or args.vcf_input):
+		parser.error("--validate_profile aligns fasta queries with a profile other than default (--align_profile fast or sensitive)")
 	if args.skip_mauve and not args.keep_temp: ## Make sure keep temp is default if --skip_mauve is used
 		args.keep_temp = True
 
@@ -141,27 +213,43 @@ def main():
 	## Add log level and log file path
 	logger.debug(args)
 
-	CanSNPer2_obj = CanSNPer2(args.query,
-									refdir=args.refdir,
-									verbose=args.verbose,
-									outdir=args.outdir,
-									tmpdir=args.tmpdir,
-									logdir=args.logdir.rstrip("/")+"/",
-									skip_mauve=args.skip_mauve,
-									save_tree=args.save_tree,
-									keep_temp= args.keep_temp,
-									workdir=args.workdir,
-									export=args.no_snpfiles,
-									database=args.database,
-									min_required_hits=args.min_required_hits,
-									keep_going=args.keep_going,
-									rerun=args.rerun,
-									summary=args.summary,
-									strictness=args.strictness
-	)
-
-	'''Run CanSNPer2'''
-	CanSNPer2_obj.run(database=args.database)
+	## Import the CanSNPer2 modules first when they are needed, keeps --help and --version fast
+	from CanSNPer2.modules.DatabaseConnection import set_read_only_options
+	from CanSNPer2.modules.Bundle import is_bundle,open_bundle
+	databases = [args.bundle] if args.bundle else args.database or []
+	args.refdir = args.refdir or ["references/"]
+	refdirs = args.refdir*len(databases) if len(args.refdir) == 1 and databases else list(args.refdir)
+	if len(refdirs) != max(len(databases),1) or (len(args.refdir) == 1 and sum(not is_bundle(database) for database in databases) > 1):
+		parser.error("give one --refdir for each --database")
+	names = [os.path.basename(database).rsplit(".",1)[0] for database in databases]	## Output folder of each database when queries are routed
+	if len(set(names)) != len(names):
+		parser.error("the databases must have different file names, results are written to --outdir/<database name>")
+	for i,database in enumerate(databases):		## A bundle can also be given as database
+		if is_bundle(database):
+			databases[i],refdirs[i] = open_bundle(database,os.path.join(args.tmpdir,"bundles"))
+			args.db_immutable = True						## The unpacked database is never modified
+	set_read_only_options(args.db_immutable,args.db_mmap_size,args.db_cache_size)
+	if len(databases) < 2:
+		run_CanSNPer2(args,args.query,databases[0] if databases else None,refdirs[0],args.outdir)
+		return
+
+	'''Several databases, route each query to the database holding the closest reference'''
+	if args.read_input or args.sam_input or args.vcf_input:
+		parser.error("queries can only be routed to one of several databases from fasta input")
+	from CanSNPer2.modules.Sketch import route_queries
+	args.workdir = os.path.abspath(args.workdir)		## CanSNPer2 changes to the workdir for each database
+	os.makedirs(args.workdir,exist_ok=True)
+	os.chdir(args.workdir)
+	query = args.query
+	if len(query) > 0 and query[0].endswith(".txt"):
+		with open(query[0]) as f:
+			query = [line.strip() for line in f if line.strip()]
+	routes = route_queries(query,dict(zip(databases,refdirs)),args.max_distance,args.outdir)
+	for database,refdir,name in zip(databases,refdirs,names):
+		if not routes[database]:
+			logger.info("No queries routed to {database}".format(database=database))
+			continue
+		run_CanSNPer2(args,routes[database],database,refdir,os.path.join(args.outdir,name))
 
 if oname=="__main__":
 	main()
@@ -1,24 +1,133 @@
 #!/usr/bin/env python3
 import sys, os
+import json
+import zlib
+import hashlib
 import textwrap
-from urllib.request import urlretrieve
+import threading
 
 import argparse,os
-from subprocess import Popen
-from multiprocessing import Process
-from CanSNPer2.modules.DatabaseConnection import CanSNPdbFunctions
+from time import sleep
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from CanSNPer2.modules.DatabaseConnection import CanSNPdbFunctions,set_read_only_options
+from CanSNPer2.modules.FastaIndex import FastaIndexer,index_path,index_fasta,is_current
+from CanSNPer2.modules.ReferenceStore import ReferenceStore
 import logging
 logger = logging.getLogger(__name__)
 
+class DownloadError(Exception):
+	def __init__(self, value):
+		self.value = value
+	def __str__(self):
+		return repr(self.value)
+
+def stream(url,offset=0,timeout=60,blocksize=1<<16):
+	'''Generator of the content of url starting at offset (HTTP range or FTP REST)
+		the first value is True if the download starts at offset, False if the server sends the whole file
+	'''
+	if urlparse(url).scheme == "ftp":
+		from ftplib import FTP
+		url = urlparse(url)
+		with FTP(url.hostname,timeout=timeout) as ftp:
+			ftp.login()
+			ftp.voidcmd("TYPE I")
+			with ftp.transfercmd("RETR {path}".format(path=url.path), rest=offset or None) as conn:
+				yield offset > 0
+				for block in iter(lambda: conn.recv(blocksize), b""):
+					yield block
+			ftp.voidresp()
+		return
+	from urllib.request import Request,urlopen  ## urllib pulls in ssl/http, only import it when a download is made
+	from urllib.error import HTTPError
+	request = Request(url)
+	if offset:
+		request.add_header("Range", "bytes={offset}-".format(offset=offset))
+	try:
+		response = urlopen(request, timeout=timeout)
+	except HTTPError as e:
+		if e.code == 416 and offset:	## Range not satisfiable, the file is already complete
+			yield True
+			return
+		raise
+	with response:
+		resumed = offset > 0 and response.status == 206
+		if offset and not resumed:
+			logger.debug("{url} does not support resume, restart download".format(url=url))
+		yield resumed
+		for block in iter(lambda: response.read(blocksize), b""):
+			yield block
+
+def read_text(url,timeout=60):
+	'''Return the content of a (small) text file'''
+	blocks = stream(url,timeout=timeout)
+	next(blocks)
+	return b"".join(blocks).decode("utf-8")
+
+class GzipStream(object):
+	"""Decompress gzip data as it arrives (files with several gzip members are supported)"""
+	def __init__(self):
+		self.decompressor = zlib.decompressobj(16+zlib.MAX_WBITS)
+
+	def decompress(self,data):
+		out = []
+		while data:
+			out.append(self.decompressor.decompress(data))
+			data = b""
+			if self.decompressor.eof:
+				data = self.decompressor.unused_data
+				self.decompressor = zlib.decompressobj(16+zlib.MAX_WBITS)
+		return b"".join(out)
+
 class DownloadGenomes(object):
-	"""docstring for DownloadGenomes."""
-	def __init__(self, database, source="genbank",directory="references",verbose=False):
+	"""DownloadGenomes downloads the reference genomes of a CanSNPer2 database from NCBI
+			downloads run in a fixed number of threads, partial files are resumed, failed downloads are retried with backoff
+			and every file is verified against md5checksums.txt of the assembly. Completed references are recorded in
+			{directory}/manifest.json, references found in the manifest are not downloaded again.
+	"""
+	def __init__(self, database, source="genbank",directory="references",verbose=False,threads=4,retries=3,backoff=2,
+					base_url="https://ftp.ncbi.nlm.nih.gov/genomes/all",store=False):
 		super(DownloadGenomes, self).__init__()
-		self.database = CanSNPdbFunctions(database,verbose=verbose)
+		self.database = CanSNPdbFunctions(database,verbose=verbose,readonly=True)
+		self.database_path = database
 		self.source = source
 		self.directory = directory
+		self.threads = threads
+		self.retries = retries
+		self.backoff = backoff
+		self.base_url = base_url.rstrip("/")
+		self.manifest_path = os.path.join(self.directory,"manifest.json")
+		self.manifest_lock = threading.Lock()
+		self.store = False
+		if store:
+			'''Genomes are kept in a store shared by all reference folders of the host and linked into directory'''
+			self.store = ReferenceStore(store)
 		if not os.path.exists(self.directory):
 			os.makedirs(self.directory)
+		self.manifest = self.read_manifest()
+
+	def read_manifest(self):
+		'''Read the manifest of downloaded references'''
+		try:
+			with open(self.manifest_path) as f:
+				return json.load(f)
+		except (FileNotFoundError,ValueError):
+			return {}
+
+	def write_manifest(self):
+		'''Write the manifest atomically'''
+		tmp = self.manifest_path+".tmp"
+		with open(tmp, "w") as f:
+			json.dump(self.manifest,f,indent=1,sort_keys=True)
+		os.replace(tmp, self.manifest_path)
+
+	def is_complete(self,refid):
+		'''Check if a reference in the manifest is still present (same size)'''
+		entry = self.manifest.get(refid)
+		if not entry:
+			return False
+		path = os.path.join(self.directory,entry["file"])
+		return os.path.exists(path) and os.path.getsize(path) == entry["size"] and os.path.exists(os.path.join(self.directory,"{refid}.fna".format(refid=refid)))
 
 	def get_genomes(self, database=False,source="genbank"):
 		'''Get the list of genomes in the database'''
@@ -30,7 +139,6 @@ class DownloadGenomes(object):
 		logger.debug("Selected source: {source}".format(source=source))
 		for id,genome_id,strain,refseq_id,genbank_id,assembly_name in database.query(QUERY).fetchall():
 			logging.debug([id,genome_id,strain,refseq_id,genbank_id,assembly_name])
-			logging.debug("Downloading {genome}".format(genome=genome_id))
 			if source == "refseq":
 				genomeDict[refseq_id] = assembly_name
 				keys.append(refseq_id)
@@ -41,75 +149,162 @@ class DownloadGenomes(object):
 		logging.info(genomeDict)
 		return genomeDict,keys
 
-	def download(self,genome_id, assembly, refid ,source="genbank", directory="references"):
-		'''Download genomes from refseq or genbank on request
-			ftp://ftp.ncbi.nlm.nih.gov/genomes/all/GCF/000/00x/xxx/GCF_00000xxxx.x_ASMxxxv1/GCF_00000xxxx.x_ASMxxxv1_genomic.fna.gz
+	def get_url(self,genome_id,assembly):
+		'''Return the url of the assembly folder
+			{base_url}/GCF/000/00x/xxx/GCF_00000xxxx.x_ASMxxxv1/
 		'''
-		sourceD = {"refseq":"F", "genbank": "A"}
 		try:
 			n1,n2,n3 = textwrap.wrap(genome_id.split("_")[-1].split(".")[0],3)  ## Get the three number parts
 		except ValueError:
-			logger.warning("Could not download {refid}".format(refid=refid))
-			return
-		link = "ftp://ftp.ncbi.nlm.nih.gov/genomes/all/GC{source}/{n1}/{n2}/{n3}/{genome_id}_{assembly}/{genome_id}_{assembly}_genomic.fna.gz".format(
-						source=sourceD[source],
+			raise DownloadError("Invalid accession {genome_id}".format(genome_id=genome_id))
+		return "{base_url}/{prefix}/{n1}/{n2}/{n3}/{genome_id}_{assembly}".format(
+						base_url=self.base_url,
+						prefix=genome_id.split("_")[0],
 						n1=n1,
 						n2=n2,
 						n3=n3,
 						genome_id=genome_id,
 						assembly=assembly
 						)
-		retrieved_file = "{directory}/source/{genome_id}_{assembly}_genomic.fna.gz".format(genome_id=genome_id,assembly=assembly,directory=directory)
-		if not os.path.exists(retrieved_file.strip(".gz")) or os.path.exists(retrieved_file):
-			logging.debug("Downloading: "+ link +" <-> "+ retrieved_file)
-			urlretrieve(link, retrieved_file)
-			### unzip file (mauve cant handle zipped sources)
-			p = Popen(["gunzip", "-f", retrieved_file])
-			os.chdir(directory)
-			bname = os.path.basename(retrieved_file.rstrip(".gz"))
+
+	def get_md5(self,url,filename):
+		'''Return the md5 of filename listed in md5checksums.txt of the assembly folder'''
+		for row in read_text("{url}/md5checksums.txt".format(url=url)).splitlines():
+			columns = row.split()		## md5  ./{filename}
+			if len(columns) == 2 and os.path.basename(columns[1]) == filename:
+				return columns[0]
+		raise DownloadError("{filename} is not listed in {url}/md5checksums.txt".format(filename=filename,url=url))
+
+	def retry(self,function,*args):
+		'''Call function, retry with exponential backoff on network errors and checksum mismatches'''
+		for attempt in range(self.retries+1):
 			try:
-				os.symlink("source/{bname}".format(bname=bname), "{refid}.fna".format(refid=refid))
-			except FileExistsError:
-				logger.debug("symlink already exists, skip!")
-				return
+				return function(*args)
+			except (OSError,DownloadError) as e:
+				if attempt == self.retries:
+					raise
+				wait = self.backoff*2**attempt
+				logger.warning("{error}, retry in {wait}s".format(error=e,wait=wait))
+				sleep(wait)
+
+	def fetch_fasta(self,url,partial,fasta,md5,blocksize=1<<20):
+		'''Download a gzipped fasta file, the data is decompressed to fasta and indexed as it arrives
+			the compressed data is kept in partial until the download is complete so that an interrupted download can be resumed,
+			the file (and its index) is moved in place when the md5 of the download matches
+		'''
+		offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+		blocks = stream(url,offset=offset)
+		resumed = next(blocks)
+		checksum,gz,indexer = hashlib.md5(),GzipStream(),FastaIndexer()
+		try:
+			with open(fasta+".tmp", "wb") as out:
+				def receive(block):
+					checksum.update(block)
+					data = gz.decompress(block)
+					out.write(data)
+					indexer.update(data)
+				if resumed:	## The data already downloaded is decompressed before the download continues
+					with open(partial, "rb") as f:
+						for block in iter(lambda: f.read(blocksize), b""):
+							receive(block)
+				with open(partial, "ab" if resumed else "wb") as part:
+					for block in blocks:
+						part.write(block)
+						receive(block)
+		except zlib.error as e:		## A corrupt partial (or stream) is removed and downloaded again from the start
+			blocks.close()
+			for path in [partial,fasta+".tmp"]:
+				if os.path.exists(path):
+					os.remove(path)
+			raise DownloadError("Corrupt data in {url} ({e})".format(url=url,e=e))
+		if checksum.hexdigest() != md5:
+			os.remove(partial)
+			os.remove(fasta+".tmp")
+			raise DownloadError("Checksum mismatch for {url}".format(url=url))
+		indexer.write(index_path(fasta))
+		os.replace(fasta+".tmp", fasta)
+		os.remove(partial)
+		return fasta
+
+	def download(self,genome_id, assembly, refid):
+		'''Download, verify and unpack the genome of refid, the reference is linked as {directory}/{refid}.fna'''
+		if self.is_complete(refid):
+			logger.debug("Reference {refid} already downloaded".format(refid=refid))
+			link = os.path.join(self.directory,"{refid}.fna".format(refid=refid))
+			if not is_current(index_path(link),link):	## downloaded before references were indexed
+				logger.info("Indexing {refid}".format(refid=refid))
+				index_fasta(link)
+			return False
+		url = self.get_url(genome_id,assembly)
+		filename = "{genome_id}_{assembly}_genomic.fna.gz".format(genome_id=genome_id,assembly=assembly)
+		md5 = self.retry(self.get_md5,url,filename)
+		link = os.path.join(self.directory,"{refid}.fna".format(refid=refid))
+		if self.store:
+			downloaded = self.download_to_store(url,filename,genome_id,md5,link)
+			entry = {"file": os.path.basename(link), "store": self.store.object_dir(genome_id,md5)}
 		else:
-			logger.debug("Reference file for {f} already exists!".format(f=retrieved_file.split("/")[-1].strip("_genomic.fna.gz")))
-		return
+			source_dir = os.path.join(self.directory,"source")
+			fasta = os.path.join(source_dir,filename[:-len(".gz")])
+			'''The download is unpacked while it is downloaded (mauve can´t handle zipped sources), files in place are always complete'''
+			self.retry(self.fetch_fasta,"{url}/{filename}".format(url=url,filename=filename),os.path.join(source_dir,filename+".part"),fasta,md5)
+			for path,target in [(link,os.path.basename(fasta)),(index_path(link),os.path.basename(index_path(fasta)))]:
+				if os.path.lexists(path):
+					os.remove(path)
+				os.symlink(os.path.join("source",target), path)
+			downloaded = True
+			entry = {"file": os.path.join("source",os.path.basename(fasta))}
+		with self.manifest_lock:
+			entry.update({"accession": genome_id, "size": os.path.getsize(link), "md5": md5, "url": url})
+			self.manifest[refid] = entry
+			self.write_manifest()
+		if downloaded:
+			logger.info("Downloaded {refid} ({genome_id})".format(refid=refid,genome_id=genome_id))
+		else:
+			logger.info("Linked {refid} ({genome_id}) from the reference store".format(refid=refid,genome_id=genome_id))
+		return downloaded
+
+	def download_to_store(self,url,filename,genome_id,md5,link):
+		'''Download a genome to the reference store (unless it is already stored) and link it to link, returns True if it was downloaded'''
+		fasta = filename[:-len(".gz")]
+		downloaded = False
+		with self.store.lock(genome_id,md5):	## Only one process downloads a genome, others wait and link it
+			if not self.store.get(genome_id,md5,fasta):
+				tmp = os.path.join(self.store.tmpdir,"{md5}_{fasta}".format(md5=md5,fasta=fasta))
+				self.retry(self.fetch_fasta,"{url}/{filename}".format(url=url,filename=filename),self.store.partial(genome_id,md5,filename),tmp,md5)
+				self.store.add(genome_id,md5,{fasta: tmp, index_path(fasta): index_path(tmp)})
+				downloaded = True
+			self.store.link(genome_id,md5,fasta,link)
+			self.store.link(genome_id,md5,index_path(fasta),index_path(link))
+		return downloaded
 
 	def run(self):
 		'''Start download'''
 		self.genomes,keys = self.get_genomes(self.database,self.source)
-		threads = []
 		logging.info("Downloading references")
-		if not os.path.isdir("{directory}/source".format(directory=self.directory)): os.mkdir("{directory}/source".format(directory=self.directory))
-		for genome_id in keys:
-			assembly = self.genomes[genome_id]
-			refid = self.genomes[assembly]
-			kwargs = {"source":self.source, "directory":self.directory}
-			p = Process(target=self.download, args=(genome_id, assembly, refid), kwargs=kwargs)
-			p.start()
-			threads.append(p)
-		for p in threads:
-			p.join() # this blocks until the process terminates
-		logging.info("Done!")
-		return
-
-def main():
-	parser = argparse.ArgumentParser(description='CanSNPer2-download')
-
-	baseopts = parser.add_argument_group('Required')
-	baseopts.add_argument('-db',  '--database', 	metavar='', required=True,									help='CanSNP database')
-
-	downlopts = parser.add_argument_group('Download options')
-	downlopts.add_argument('-s', '--source', 			metavar='', default="genbank",	choices=["genbank","refseq"], 	help="Source for download (genbank/refseq)")
-	downlopts.add_argument('-o', '--outdir', 			metavar='', default="references",								help="reference genomes folder")
-
-	debugopts = parser.add_argument_group('Logging and debug options')
-	debugopts.add_argument('--logs', metavar='', default='logs', 				help='Specify log directory')
-	debugopts.add_argument('--verbose',	action='store_const', const=logging.DEBUG, help='Verbose logging')
-
-	args = parser.parse_args()
+		if not self.store:
+			os.makedirs(os.path.join(self.directory,"source"),exist_ok=True)
+		failed = []
+		with ThreadPoolExecutor(max_workers=self.threads) as executor:
+			jobs = {}
+			for genome_id in keys:
+				assembly = self.genomes[genome_id]
+				refid = self.genomes[assembly]
+				jobs[refid] = executor.submit(self.download, genome_id, assembly, refid)
+			downloaded = 0
+			for refid,job in jobs.items():
+				try:
+					downloaded += job.result()
+				except (OSError,DownloadError) as e:
+					logger.error("Could not download {refid}: {error}".format(refid=refid,error=e))
+					failed.append(refid)
+		logging.info("Done! {n} downloaded, {skip} already present or linked, {failed} failed".format(n=downloaded,skip=len(keys)-downloaded-len(failed),failed=len(failed)))
+		'''Sketch the references so that CanSNPer2 can route queries to this database (only new references are sketched)'''
+		from CanSNPer2.modules.Sketch import sketch_references		## Sketch uses numpy, imported only when references are sketched
+		sketch_references(self.database_path,self.directory)
+		return failed
 
+def setup_logging(args):
+	'''Setup log file and level'''
 	logval = logging.WARNING
 	if args.verbose:
 		logval = args.verbose
@@ -132,10 +327,55 @@ def main():
 		        logging.FileHandler(logpath),
 		        logging.StreamHandler()
 		    ])
-	logger = logging.getLogger(__name__)
+
+def gc_main(argv):
+	'''CanSNPer2-download gc, remove genomes from the reference store that are not linked from any reference folder'''
+	parser = argparse.ArgumentParser(prog='CanSNPer2-download gc', description='Remove unused genomes from the reference store')
+	parser.add_argument('--store', metavar='', default=os.environ.get("CANSNPER2_STORE"), required=not os.environ.get("CANSNPER2_STORE"),
+																help="Reference store (default $CANSNPER2_STORE)")
+	parser.add_argument('--dry_run', action='store_true',		help="Only list the genomes that would be removed")
+	parser.add_argument('--logs', metavar='', default='logs', 	help='Specify log directory')
+	parser.add_argument('--verbose',	action='store_const', const=logging.INFO, help='Verbose logging')
+	args = parser.parse_args(argv)
+	setup_logging(args)
+	removed,freed = ReferenceStore(args.store).gc(dry_run=args.dry_run)
+	for genome in removed:
+		print(genome)
+	print("{action} {n} genomes ({size:.1f} MB)".format(action="Unused" if args.dry_run else "Removed",n=len(removed),size=freed/1e6))
+
+def main():
+	if len(sys.argv) > 1 and sys.argv[1] == "gc":
+		return gc_main(sys.argv[2:])
+	parser = argparse.ArgumentParser(description='CanSNPer2-download (CanSNPer2-download gc removes unused genomes from the reference store)')
+
+	baseopts = parser.add_argument_group('Required')
+	baseopts.add_argument('-db',  '--database', 	metavar='', required=True,									help='CanSNP database')
+
+	downlopts = parser.add_argument_group('Download options')
+	downlopts.add_argument('-s', '--source', 			metavar='', default="genbank",	choices=["genbank","refseq"], 	help="Source for download (genbank/refseq)")
+	downlopts.add_argument('-o', '--outdir', 			metavar='', default="references",								help="reference genomes folder")
+	downlopts.add_argument('--threads', 				metavar='', default=4, type=int,								help="Number of parallel downloads (default 4)")
+	downlopts.add_argument('--retries', 				metavar='', default=3, type=int,								help="Retries of a failed download (default 3)")
+	downlopts.add_argument('--base_url', 				metavar='', default="https://ftp.ncbi.nlm.nih.gov/genomes/all",	help="NCBI genomes/all url (https, http or ftp, a mirror or local server can be used)")
+	downlopts.add_argument('--store', 					metavar='', default=os.environ.get("CANSNPER2_STORE"),			help="Reference store shared by all databases, genomes are linked into outdir (default $CANSNPER2_STORE)")
+
+	dbopts = parser.add_argument_group('Database options')
+	dbopts.add_argument('--db_immutable',	action='store_true',		help="The database is not modified while running (no locking, for downloaded databases)")
+	dbopts.add_argument('--db_mmap_size',	type=float, default=256,	help="Size (MB) of the database read through mmap (default 256)")
+	dbopts.add_argument('--db_cache_size',	type=float, default=16,		help="Page cache size (MB) of each database connection (default 16)")
+
+	debugopts = parser.add_argument_group('Logging and debug options')
+	debugopts.add_argument('--logs', metavar='', default='logs', 				help='Specify log directory')
+	debugopts.add_argument('--verbose',	action='store_const', const=logging.DEBUG, help='Verbose logging')
+
+	args = parser.parse_args()
+	setup_logging(args)
 	# create a database connection
-	DG = DownloadGenomes(args.database,args.source,args.outdir)
-	DG.run()
+	set_read_only_options(args.db_immutable,args.db_mmap_size,args.db_cache_size)
+	DG = DownloadGenomes(args.database,args.source,args.outdir,threads=args.threads,retries=args.retries,base_url=args.base_url,store=args.store)
+	failed = DG.run()
+	if failed:
+		exit(1)
 
 if __name__ == '__main__':
 	main()
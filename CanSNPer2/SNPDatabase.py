@@ -5,120 +5,155 @@ CreateDatabase is a simple script to simplify the creation of a new database
 
 #**** Imports ****
 import sys, os
-import sqlite3
+import argparse
+from importlib.util import find_spec
 
 import logging
-#logger = logging.getLogger(__name__)
+logger = logging.getLogger(__name__)
+
+from CanSNPer2.CanSNPerTree import __version__
+## The database modules depend on flextaxd (and ete3 through NewickTree), they are imported in main
+## by the action requiring them so that --help, --version and argument errors return without loading them
 
-from CanSNPer2.modules.InitiateDatabase import CanSNPDatabase
-from CanSNPer2.modules.ModifyDatabase import ModifyCanSNPer2Database
-from flextaxd.modules.WriteTaxonomy import WriteTaxonomy
-from CanSNPer2.modules.NewickTree import NewickTree
-import flextaxd
+## Tree formats imported by CanSNPer2 itself (InitiateDatabase.read_modules), listed here without importing the database modules
+local_read_modules = ["CanSNPer","tab"]
 
 def get_read_modules():
-	'''Find (ReadTaxonomy) modules and return options'''
-	read_modules = []
-	for script in os.listdir(os.path.dirname(os.path.abspath(flextaxd.__file__))+"/modules"):
-		if script.startswith("ReadTaxonomy"):
-			modname = script.lstrip("ReadTaxonomy").rstrip(".py")
-			if modname != "":
-				read_modules.append(modname)
+	'''Find (ReadTaxonomy) modules and return options, the flextaxd package is located without importing it'''
+	read_modules = list(local_read_modules)
+	spec = find_spec("flextaxd")
+	if spec is None:
+		return read_modules
+	for path in spec.submodule_search_locations:
+		for script in os.listdir(os.path.join(path,"modules")):
+			if script.startswith("ReadTaxonomy"):
+				modname = script.lstrip("ReadTaxonomy").rstrip(".py")
+				if modname != "" and modname not in read_modules:
+					read_modules.append(modname)
 	return read_modules
 
-supported_input = set(get_read_modules())
 supported_output = set(["tab", "newick"])# set(["cansnper","ncbi","tab","newick"])
 
-
-import argparse
-parser = argparse.ArgumentParser(description='CanSNPer2-database ')
-
-required_args = parser.add_argument_group('Required')
-required_args.add_argument('-db',  '--database',     metavar='',                            help='CanSNPer2 database name')
-
-
-create_database = parser.add_argument_group("Load database")
-create_database.add_argument('--tree',         metavar='', default=False,                	help="CanSNPer tree source file")
-create_database.add_argument('--annotation',   metavar='', default=False,                	help="CanSNPer snp source file")
-create_database.add_argument('--references',   metavar='', default=False,                 	help="File containing all reference genomes listed")
-create_database.add_argument('--source_type',  metavar='', default="CanSNPer",
-													choices=supported_input, 				help="Select source file type")
-create_database.add_argument('--create',             action='store_true',                   help="Create new database!")
-
-
-modify_database = parser.add_argument_group("Database modifications")
-modify_database.add_argument('--mod_file',     metavar='',                                 	help="File with modifications/update to the tree")
-modify_database.add_argument('--parent',         metavar='',                                 	help="Node (or nodes matching tree file) from which to update/replace/remove")
-modify_database.add_argument('--remove',     action='store_true',                         	help="If node is given, instead of replace/update remove branch from node")
-modify_database.add_argument('--replace',     action='store_true',                          help="replace node")
-#modify_database.add_argument('--add_node',     metavar='',                                 	help="Add a single node, parent,node,children")
-#modify_database.add_argument('--add_snp',     metavar='',                                 	help="Add a single snp,  parent,node,children")
-
-
-export_database = parser.add_argument_group("Export database")
-export_database.add_argument('--export',  action='store_true',					help="Export database to text format (exports tree and annotation file)")
-export_database.add_argument('--export_format', metavar='', default='tab',  				choices=supported_output, help="Select output format [{format}]".format(format=", ".join(supported_output)))
-export_database.add_argument('-o', '--outdir', metavar='',									help="outdir for database export!")
-
-
-debugopts = parser.add_argument_group("Logging and debug options")
-debugopts.add_argument('--tmpdir', 			metavar='', default="/tmp",						help="Specify tmp directory default (/tmp)")
-debugopts.add_argument('--logs', 				metavar='', default="logs", 				help="Specify log directory")
-debugopts.add_argument('--verbose',			action='store_const', const=logging.INFO,		help="print process info, default no output")
-debugopts.add_argument('--debug',				action='store_const', const=logging.DEBUG,	help="print debug info")
-debugopts.add_argument('--supress',				action='store_const', const=logging.ERROR,
-																default=logging.WARNING,	help="supress warnings")
-
-parser.add_argument("--version", action='store_true', help=argparse.SUPPRESS)
-
-args = parser.parse_args()
-if len(sys.argv)==1:
-	parser.print_help()
-	parser.exit()
-
-
-if args.version:
-	print("CanSNPer2 - version {version}".format(version=__version__))
-	exit()
-
-
-logval = args.supress
-if args.debug:
-	logval = args.debug
-elif args.verbose:
-	logval = args.verbose
-
-from datetime import date,time
-t = time()
-today = date.today()
-args.logs = args.logs.rstrip("/")+"/"
-logpath = args.logs+"CanSNPer2-database"+today.strftime("%b-%d-%Y")+"{}.log"
-if not os.path.exists(args.logs):
-	os.system("mkdir -p {path}".format(path=args.logs))
-if os.path.exists(logpath):
-	logpath=logpath.format("-{:%H:%M}".format(t))
-else: logpath = logpath.format("")
-
-logging.basicConfig(
-		#filename=logpath,
-		level=logval,
-		format="%(asctime)s %(module)s [%(levelname)-5.5s]  %(message)s",
-	    handlers=[
-	        logging.FileHandler(logpath),
-	        logging.StreamHandler()
-	    ])
-logger = logging.getLogger(__name__)
+def get_parser():
+	'''Create the CanSNPer2-database argument parser'''
+	parser = argparse.ArgumentParser(description='CanSNPer2-database ')
+
+	required_args = parser.add_argument_group('Required')
+	required_args.add_argument('-db',  '--database',     metavar='',                            help='CanSNPer2 database name')
+
+
+	create_database = parser.add_argument_group("Load database")
+	create_database.add_argument('--tree',         metavar='', default=False,                	help="CanSNPer tree source file")
+	create_database.add_argument('--annotation',   metavar='', default=False,                	help="CanSNPer snp source file")
+	create_database.add_argument('--references',   metavar='', default=False,                 	help="File containing all reference genomes listed")
+	create_database.add_argument('--source_type',  metavar='', default="CanSNPer",				help="Select source file type (CanSNPer, tab or ReadTaxonomy modules available in flextaxd)")
+	create_database.add_argument('--create',             action='store_true',                   help="Create new database!")
+
+
+	modify_database = parser.add_argument_group("Database modifications")
+	modify_database.add_argument('--mod_file',     metavar='',                                 	help="File with modifications/update to the tree")
+	modify_database.add_argument('--parent',         metavar='',                                 	help="Node (or nodes matching tree file) from which to update/replace/remove")
+	modify_database.add_argument('--remove',     action='store_true',                         	help="If node is given, instead of replace/update remove branch from node")
+	modify_database.add_argument('--replace',     action='store_true',                          help="replace node")
+	modify_database.add_argument('--optimize',     action='store_true',                         	help="Add indexes to an existing database (and print query times before and after)")
+	#modify_database.add_argument('--add_node',     metavar='',                                 	help="Add a single node, parent,node,children")
+	#modify_database.add_argument('--add_snp',     metavar='',                                 	help="Add a single snp,  parent,node,children")
+
+
+	export_database = parser.add_argument_group("Export database")
+	export_database.add_argument('--export',  action='store_true',					help="Export database to text format (exports tree and annotation file)")
+	export_database.add_argument('--export_format', metavar='', default='tab',  				choices=supported_output, help="Select output format [{format}]".format(format=", ".join(supported_output)))
+	export_database.add_argument('-o', '--outdir', metavar='',									help="outdir for database export!")
+	export_database.add_argument('--bundle', metavar='',											help="Write database, compiled tree and SNPs and reference genomes to a single bundle file")
+	export_database.add_argument('--refdir', metavar='', default="references",						help="Reference genomes added to the bundle (default references)")
+
+
+	debugopts = parser.add_argument_group("Logging and debug options")
+	debugopts.add_argument('--tmpdir', 			metavar='', default="/tmp",						help="Specify tmp directory default (/tmp)")
+	debugopts.add_argument('--logs', 				metavar='', default="logs", 				help="Specify log directory")
+	debugopts.add_argument('--verbose',			action='store_const', const=logging.INFO,		help="print process info, default no output")
+	debugopts.add_argument('--debug',				action='store_const', const=logging.DEBUG,	help="print debug info")
+	debugopts.add_argument('--supress',				action='store_const', const=logging.ERROR,
+																	default=logging.WARNING,	help="supress warnings")
+
+	parser.add_argument("--version", action='store_true', help=argparse.SUPPRESS)
+	return parser
+
+def setup_logging(args):
+	'''Setup logging and debug options'''
+	logval = args.supress
+	if args.debug:
+		logval = args.debug
+	elif args.verbose:
+		logval = args.verbose
+
+	from datetime import date,time
+	t = time()
+	today = date.today()
+	args.logs = args.logs.rstrip("/")+"/"
+	logpath = args.logs+"CanSNPer2-database"+today.strftime("%b-%d-%Y")+"{}.log"
+	if not os.path.exists(args.logs):
+		os.makedirs(args.logs,exist_ok=True)
+	if os.path.exists(logpath):
+		logpath=logpath.format("-{:%H:%M}".format(t))
+	else: logpath = logpath.format("")
+
+	logging.basicConfig(
+			#filename=logpath,
+			level=logval,
+			format="%(asctime)s %(module)s [%(levelname)-5.5s]  %(message)s",
+		    handlers=[
+		        logging.FileHandler(logpath),
+		        logging.StreamHandler()
+		    ])
 
 def main():
 	'''Modify the CanSNPer2 database, if it doesn´t exist (create is added create database from files)'''
+	parser = get_parser()
+	args = parser.parse_args()
+	if len(sys.argv)==1:
+		parser.print_help()
+		parser.exit()
+
+	if args.version:
+		print("CanSNPer2 - version {version}".format(version=__version__))
+		exit()
+
+	if args.tree:
+		supported_input = set(get_read_modules())
+		if args.source_type not in supported_input:
+			parser.error("argument --source_type: invalid choice: '{source}' (choose from {choices})".format(source=args.source_type,choices=", ".join(sorted(supported_input))))
+
+	setup_logging(args)
 	logger.debug(args)
+	if args.optimize:
+		from CanSNPer2.modules.DatabaseConnection import CanSNPdbFunctions
+		if not args.database or not os.path.exists(args.database):
+			parser.error("argument --optimize requires an existing --database")
+		before,after = CanSNPdbFunctions(args.database).optimize()
+		print("Query\tBefore (ms)\tAfter (ms)")
+		for name in before:
+			print("{query}\t{before:.2f}\t{after:.2f}".format(query=name,before=before[name]*1000,after=after[name]*1000))
+		exit()
+	if args.bundle:
+		from CanSNPer2.modules.Bundle import create_bundle,BundleError
+		if not args.database or not os.path.exists(args.database):
+			parser.error("argument --bundle requires an existing --database")
+		try:
+			checksum = create_bundle(args.database,args.refdir,args.bundle)
+		except BundleError as e:
+			parser.error(str(e.value))
+		print("{bundle}\tsha256:{checksum}".format(bundle=args.bundle,checksum=checksum))
+		exit()
 	if args.export: ## Dump database to file
 		if args.export_format == "newick":
 			logger.info("Export Newick tree!")
+			from CanSNPer2.modules.NewickTree import NewickTree
 			NT = NewickTree(args.database, outdir=args.outdir)
 			NT.print()
 		else:
 			logger.info("Export CanSNPer2 database")
+			from flextaxd.modules.WriteTaxonomy import WriteTaxonomy
 			WriteObj = WriteTaxonomy( args.outdir,database=args.database, minimal=True, separator="\t", prefix="annotation,snptree",desc=True)
 			WriteObj.set_order(True)
 			WriteObj.names()
@@ -126,17 +161,27 @@ def main():
 		exit()
 	if not args.create:
 		'''This should be reprogrammed so that one can add annotations without supplying a mod file!'''
+		from CanSNPer2.modules.ModifyDatabase import ModifyCanSNPer2Database
 		CanSNPer2Mod_DB = ModifyCanSNPer2Database(**vars(args))
 		CanSNPer2Mod_DB.update_database()
+		if args.references:
+			'''New genomes are loaded first so that new annotations can refer to them'''
+			logger.info("Load new genomes!")
+			CanSNPer2Mod_DB.load_genome_reference_file(args.references)
 		if args.annotation:
 			'''Update for snp annotations supplied, run load annotation file function'''
 			logger.info("Load new SNP annotations!")
 			CanSNPer2Mod_DB.load_annotation_file(args.annotation)
-		if args.references:
-			logger.info("Load new genomes!")
-			CanSNPer2Mod_DB.load_genome_reference_file(args.references)
 	elif args.annotation:
+		from CanSNPer2.modules.InitiateDatabase import CanSNPDatabase
 		CanSNPDB = CanSNPDatabase(**vars(args))
 	else:
 		logger.error("No datafile supplied, nothing to process!")
 		exit()
+	'''The database was modified, update the compiled tree and SNP catalogue (only the parts changed according to the journal)'''
+	from CanSNPer2.modules.CompiledDatabase import cache_path,get_compiled
+	if os.path.exists(cache_path(args.database)):
+		get_compiled(args.database)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,143 @@
+'''
+AlignmentMap stores the part of a progressiveMauve alignment needed to type SNPs
+
+For every aligned block the reference interval, orientation and query start is kept together with
+the query base aligned to each reference position (gaps in the reference removed). The map of a
+sample and reference is a small zlib compressed file, SNP positions added to the database later
+can be typed from it without aligning the sample again.
+
+	File layout
+		magic 				8 bytes
+		header length 		8 bytes (little endian)
+		header 				json (version, reference, blocks [start, end, sign, query start, offset, length])
+		bases 				zlib compressed query bases of all blocks
+'''
+
+import os
+import re
+import json
+import zlib
+import tempfile
+from bisect import bisect_right
+import logging
+logger = logging.getLogger(__name__)
+
+MAGIC = b"CSNPM\x00\x00\x01"
+MAP_VERSION = 1
+complement = str.maketrans("ATCGatcg-Nn","TAGCTAGC-NN")
+gaps = re.compile("-+")
+
+def map_path(directory,reference,query):
+	'''Return the path of the alignment map of a query aligned to a reference'''
+	return os.path.join(directory,"{reference}_{query}.map".format(reference=reference,query=query))
+
+def read_map(path):
+	'''Read an alignment map file'''
+	with open(path, "rb") as f:
+		data = f.read()
+	if data[:len(MAGIC)] != MAGIC:
+		raise ValueError("{path} is not an alignment map".format(path=path))
+	start = len(MAGIC)+8
+	length = int.from_bytes(data[len(MAGIC):start], "little")
+	header = json.loads(data[start:start+length].decode("utf-8"))
+	if header["version"] != MAP_VERSION:
+		raise ValueError("{path} was written by another version of CanSNPer2".format(path=path))
+	alignment_map = AlignmentMap(header["reference"])
+	alignment_map.blocks = [tuple(block) for block in header["blocks"]]
+	alignment_map.bases = zlib.decompress(data[start+length:]).decode("ascii")
+	return alignment_map
+
+class AlignmentMap(object):
+	"""AlignmentMap of one query aligned to one reference
+			blocks 		(reference start, reference end, sign, query start, offset and length in bases) of each aligned block
+			bases 		query bases at each reference position of all blocks
+	"""
+	def __init__(self, reference):
+		super(AlignmentMap, self).__init__()
+		self.reference = reference
+		self.blocks = []
+		self._bases = []
+		self._length = 0
+		self._starts = []		## block starts (sorted) used to look up positions
+
+	def __repr__(self):
+		return "AlignmentMap({reference})".format(reference=self.reference)
+
+	@property
+	def bases(self):
+		if len(self._bases) != 1:
+			self._bases = ["".join(self._bases)]
+		return self._bases[0]
+
+	@bases.setter
+	def bases(self,bases):
+		self._bases = [bases]
+		self._length = len(bases)
+
+	def add_block(self,ref,target,head,target_head):
+		'''Add an aligned block (sequences as in the xmfa file), the query bases are stored in the order of the reference positions
+			the same way as ParseXMFA.find_snps reads them
+		'''
+		if head["sign"] == "-":
+			ref,target = ref[::-1],target[::-1]
+		## Remove the query bases aligned to gaps in the reference
+		parts,last = [],0
+		for gap in gaps.finditer(ref):
+			parts.append(target[last:gap.start()])
+			last = gap.end()
+		parts.append(target[last:])
+		bases = "".join(parts).upper()
+		if head["sign"] == "-":
+			bases = bases.translate(complement)
+		self.blocks.append((head["start"],head["end"],head["sign"],target_head["start"],self._length,len(bases)))
+		self._bases.append(bases)
+		self._length += len(bases)
+
+	def write(self,path):
+		'''Write the map (atomically) to path'''
+		blocks = sorted(self.blocks)
+		header = json.dumps({"version": MAP_VERSION, "reference": self.reference, "blocks": blocks}).encode("utf-8")
+		fd,tmp = tempfile.mkstemp(prefix=os.path.basename(path)+".", dir=os.path.dirname(os.path.abspath(path)))
+		try:
+			with os.fdopen(fd, "wb") as f:
+				f.write(MAGIC+len(header).to_bytes(8,"little")+header)
+				f.write(zlib.compress(self.bases.encode("ascii"),6))
+			os.chmod(tmp, 0o644)
+			os.replace(tmp, path)
+		except BaseException:
+			os.remove(tmp)
+			raise
+		return path
+
+	def get_base(self,position):
+		'''Return the query base aligned to a reference position, False if the position is not inside an aligned block'''
+		if len(self._starts) != len(self.blocks):
+			self.blocks.sort()
+			self._starts = [block[0] for block in self.blocks]
+		i = bisect_right(self._starts,position)-1
+		if i < 0:
+			return False
+		start,end,sign,query_start,offset,length = self.blocks[i]
+		if not start < position < end or position-start >= length:		## the same limits as used when parsing the xmfa
+			return False
+		return self.bases[offset+position-start]
+
+	def type_snps(self,snps):
+		'''Type SNPs ({position: (position, ancestral base, derived base, snp_id)}) the same way as ParseXMFA
+			returns SNPS, SNP_info and called_snps
+		'''
+		SNPS,SNP_info,called_snps = {},[],[]
+		for pos in sorted(snps):
+			snppos,rbase,tbase,snp_id = snps[pos]
+			_snp = self.get_base(snppos)
+			if not _snp:
+				continue
+			SNP_info.append([snp_id,self.reference,str(snppos),rbase,tbase,_snp])
+			if tbase == _snp:
+				SNPS[snp_id] = 1
+				called_snps.append(snp_id)
+			elif rbase == _snp:
+				SNPS[snp_id] = 2
+			else:
+				SNPS[snp_id] = 3
+		return SNPS,SNP_info,called_snps
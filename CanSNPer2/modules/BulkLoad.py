@@ -0,0 +1,143 @@
+'''
+BulkLoad contains functions to load CanSNPer2 annotation, reference and tree files into a database
+
+The source file is read and validated in memory before anything is written, all rows are then
+inserted with executemany in a single transaction with temporary PRAGMA settings for the load.
+'''
+
+from contextlib import contextmanager
+from datetime import date
+from time import time
+import logging
+logger = logging.getLogger(__name__)
+
+## Columns of the CanSNPer2 tables filled from source files
+annotation_columns = ["node_id","snp_id","position","ancestral_base","derived_base","reference","date","genome_i"]
+reference_columns = ["genome","strain","genbank_id","refseq_id","assembly_name"]
+
+class BulkLoadError(Exception):
+	def __init__(self, value):
+		self.value = value
+	def __str__(self):
+		return repr(self.value)
+
+def read_table(source_file,required=[]):
+	'''Read a tab separated source file with a header line, returns a list of dictionaries (one per row)
+		all rows are validated before returning, rows with missing columns raise a BulkLoadError
+	'''
+	with open(source_file) as f:
+		headers = f.readline().lstrip("#").strip().split("\t")
+		logger.debug(headers)
+		missing = [column for column in required if column not in headers]
+		if missing:
+			raise BulkLoadError("{file} is missing column(s): {missing}".format(file=source_file,missing=", ".join(missing)))
+		records = []
+		errors = []
+		for line_number,row in enumerate(f,2):
+			if row.strip() == "":
+				continue
+			data = row.rstrip("\r\n").split("\t")
+			if len(data) < len(headers):
+				errors.append(line_number)
+				continue
+			records.append(dict(zip(headers,data)))
+	if errors:
+		raise BulkLoadError("{file}: wrong number of columns on line(s) {lines}".format(file=source_file,lines=", ".join(map(str,errors[:10]))))
+	return records
+
+def annotation_rows(records,nodes,genomes,today=False):
+	'''Validate snp annotations against the tree nodes and reference genomes, returns the rows to insert (annotation_columns)
+		annotations of snps not in the tree or without a reference genome are skipped with a warning, as are duplicates
+	'''
+	if not today:
+		today = date.today().strftime("%d/%m/%y")
+	rows = []
+	added = set()
+	for ddict in records:
+		try:
+			_id = nodes[ddict["snp_id"]]
+		except KeyError:
+			logger.warning("WARNING: {id} was not found in the tree, check your source files!".format(id=ddict["snp_id"]))
+			continue
+		try:
+			genome_i = genomes[ddict["genome"]]
+		except KeyError:
+			logger.warning("No genome annotation could be found for given reference, please add {genome}!".format(genome=ddict["genome"]))
+			continue
+		try:
+			position = int(ddict["position"])
+		except ValueError:
+			raise BulkLoadError("Position of {id} is not an integer: {pos}".format(id=ddict["snp_id"],pos=ddict["position"]))
+		if _id in added:
+			logger.warning("Duplicate annotation of {id}, only the first is loaded!".format(id=ddict["snp_id"]))
+			continue
+		added.add(_id)
+		rows.append((_id,ddict["snp_id"],position,ddict["ancestral_base"],ddict["derived_base"],ddict["reference"],ddict.get("date",today),genome_i))
+	return rows
+
+def reference_rows(records):
+	'''Return the reference genome rows to insert (reference_columns)'''
+	return [tuple(ddict[column] for column in reference_columns) for ddict in records]
+
+@contextmanager
+def tuned_pragmas(conn,journal_mode="MEMORY",synchronous="OFF"):
+	'''Temporarily change journal_mode and synchronous of a connection, the original settings are restored afterwards'''
+	conn.commit()	## journal mode cannot be changed inside a transaction
+	old_journal_mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+	old_synchronous = conn.execute("PRAGMA synchronous").fetchone()[0]
+	conn.execute("PRAGMA journal_mode={mode}".format(mode=journal_mode))
+	conn.execute("PRAGMA synchronous={mode}".format(mode=synchronous))
+	try:
+		yield conn
+	finally:
+		conn.commit()
+		conn.execute("PRAGMA journal_mode={mode}".format(mode=old_journal_mode))
+		conn.execute("PRAGMA synchronous={mode}".format(mode=old_synchronous))
+
+def bulk_write(conn,inserts):
+	'''Insert rows into one or more tables in a single transaction
+		inserts is a list of (table, columns, rows, ignore), returns the number of rows added to each table
+	'''
+	added = []
+	with tuned_pragmas(conn):
+		try:
+			for table,columns,rows,ignore in inserts:
+				INSERT = "INSERT {ignore}INTO {table}({columns}) VALUES ({values})".format(
+							ignore="OR IGNORE " if ignore else "",table=table,columns=",".join(columns),values=",".join(["?"]*len(columns)))
+				start = time()
+				before = conn.total_changes
+				conn.executemany(INSERT,rows)
+				added.append(conn.total_changes - before)
+				seconds = time()-start
+				logger.info("Loaded {n} rows into {table} in {t:.2f}s ({rate:.0f} rows/sec)".format(n=added[-1],table=table,t=seconds,rate=added[-1]/max(seconds,1e-6)))
+		except Exception:
+			conn.rollback()
+			raise
+		conn.commit()
+	return added
+
+def bulk_insert(conn,table,columns,rows,ignore=False):
+	'''Insert all rows into table in one transaction, returns the number of rows added'''
+	return bulk_write(conn,[(table,columns,rows,ignore)])[0]
+
+def get_genome_ids(conn,table="snp_references"):
+	'''Return a dictionary of genome, genbank_id and refseq_id to the id of the reference'''
+	genomes = {}
+	for id,genome,genbank_id,refseq_id in conn.execute("SELECT id,genome,genbank_id,refseq_id FROM {table}".format(table=table)).fetchall():
+		genomes[genome] = id
+		genomes[genbank_id] = id
+		genomes[refseq_id] = id
+	return genomes
+
+def load_annotations(conn,annotation_file,nodes,genomes):
+	'''Validate and load a snp annotation file, returns the records read from file'''
+	records = read_table(annotation_file,required=["snp_id","genome","position","ancestral_base","derived_base","reference"])
+	rows = annotation_rows(records,nodes,genomes)
+	bulk_insert(conn,"snp_annotation",annotation_columns,rows,ignore=True)
+	return records
+
+def load_references(conn,reference_file):
+	'''Load a reference genome file, returns the genome to id dictionary of the database'''
+	records = read_table(reference_file,required=reference_columns)
+	bulk_insert(conn,"snp_references",reference_columns,reference_rows(records))
+	return get_genome_ids(conn)
@@ -0,0 +1,187 @@
+'''
+Bundle packs a CanSNPer2 database, its compiled tree and SNP catalogue and the reference genomes
+into one file that can be copied to a cluster node and used in place of --database and --refdir
+
+	File layout
+		magic 				8 bytes
+		header length 		8 bytes (little endian)
+		header 				json (version, database, references and sections)
+		sections 			raw file content (8 byte aligned)
+		checksum 			sha256 of everything before it (32 bytes)
+
+The bundle is opened with mmap and unpacked once per node into a directory named by its checksum,
+later runs on the node reuse the unpacked files without reading the bundle.
+'''
+
+import os
+import json
+import mmap
+import shutil
+import sqlite3
+import hashlib
+import tempfile
+import logging
+logger = logging.getLogger(__name__)
+
+from CanSNPer2.modules.CompiledDatabase import CompiledDatabase,cache_path
+
+MAGIC = b"CSNPB\x00\x00\x01"
+BUNDLE_VERSION = 1
+CHECKSUM_SIZE = 32
+
+class BundleError(Exception):
+	def __init__(self, value):
+		self.value = value
+	def __str__(self):
+		return repr(self.value)
+
+def is_bundle(path):
+	'''Check if a file is a CanSNPer2 bundle'''
+	try:
+		with open(path, "rb") as f:
+			return f.read(len(MAGIC)) == MAGIC
+	except (OSError,TypeError):
+		return False
+
+def create_bundle(database,refdir,bundle,blocksize=1<<20):
+	'''Write database, compiled cache and the reference genomes ({refdir}/{genome}.fna) of all genomes in the database to bundle
+		returns the checksum of the bundle
+	'''
+	tmpdir = tempfile.mkdtemp(prefix="CanSNPer2-bundle.")
+	try:
+		'''Copy the database (consistent even if the database is in use) and compile the copy'''
+		snapshot = os.path.join(tmpdir,"database.db")
+		source = sqlite3.connect("file:{database}?mode=ro".format(database=os.path.abspath(database)), uri=True)
+		target = sqlite3.connect(snapshot)
+		try:
+			source.backup(target)
+			genomes = [genome for genome, in target.execute("SELECT genome FROM snp_references ORDER BY genome")]
+		finally:
+			target.close()
+			source.close()
+		compiled = CompiledDatabase(snapshot)
+		sections = [("database",snapshot),("compiled",cache_path(snapshot))]
+		references = []
+		for genome in genomes:
+			path = os.path.join(refdir,"{genome}.fna".format(genome=genome))
+			if not os.path.exists(path):	## follows the symlinks created by CanSNPer2-download
+				logger.warning("Reference {genome} was not found in {refdir}, it is not added to the bundle".format(genome=genome,refdir=refdir))
+				continue
+			sections.append(("references/{genome}.fna".format(genome=genome),os.path.realpath(path)))
+			references.append(genome)
+		if len(references) == 0:
+			raise BundleError("No reference genomes found in {refdir}, run CanSNPer2-download first".format(refdir=refdir))
+
+		header = {"version": BUNDLE_VERSION,
+				"database": {"mtime_ns": compiled.header["fingerprint"]["mtime_ns"]},
+				"references": references,
+				"sections": {}}
+		offset = 0
+		for name,path in sections:
+			size = os.path.getsize(path)
+			header["sections"][name] = (offset,size)
+			offset += size + (-size % 8)
+		header = json.dumps(header).encode("utf-8")
+		header += b" "*(-(len(MAGIC)+8+len(header)) % 8)
+
+		'''Write to a temporary file next to the bundle and move it in place when complete'''
+		fd,tmp = tempfile.mkstemp(prefix=os.path.basename(bundle)+".", dir=os.path.dirname(os.path.abspath(bundle)))
+		sha = hashlib.sha256()
+		try:
+			with os.fdopen(fd, "wb") as out:
+				def write(data):
+					sha.update(data)
+					out.write(data)
+				write(MAGIC+len(header).to_bytes(8,"little")+header)
+				for name,path in sections:
+					size = 0
+					with open(path, "rb") as f:
+						for block in iter(lambda: f.read(blocksize), b""):
+							write(block)
+							size += len(block)
+					write(b"\0"*(-size % 8))
+					logger.debug("Added {name} ({size} bytes)".format(name=name,size=size))
+				out.write(sha.digest())
+			os.chmod(tmp, 0o644)
+			os.replace(tmp, bundle)
+		except BaseException:
+			os.remove(tmp)
+			raise
+	finally:
+		shutil.rmtree(tmpdir, ignore_errors=True)
+	logger.info("Bundle {bundle} created with {n} references".format(bundle=bundle,n=len(references)))
+	return sha.hexdigest()
+
+class Bundle(object):
+	"""Bundle maps a CanSNPer2 bundle and unpacks it to a directory
+			database 	path of the unpacked database
+			refdir 		path of the unpacked reference genomes
+	"""
+	def __init__(self, bundle):
+		super(Bundle, self).__init__()
+		self.path = os.path.abspath(bundle)
+		with open(self.path, "rb") as f:
+			self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		if bytes(self.buffer[:len(MAGIC)]) != MAGIC:
+			raise BundleError("{bundle} is not a CanSNPer2 bundle".format(bundle=bundle))
+		start = len(MAGIC)+8
+		length = int.from_bytes(self.buffer[len(MAGIC):start], "little")
+		self.header = json.loads(bytes(self.buffer[start:start+length]).decode("utf-8"))
+		if self.header["version"] != BUNDLE_VERSION:
+			raise BundleError("{bundle} was created with another version of CanSNPer2".format(bundle=bundle))
+		self.data_start = start+length
+		self.checksum = bytes(self.buffer[-CHECKSUM_SIZE:]).hex()
+		self.database = False
+		self.refdir = False
+
+	def __repr__(self):
+		return "Bundle({path})".format(path=self.path)
+
+	def verify(self,blocksize=1<<24):
+		'''Check the checksum of the bundle'''
+		sha = hashlib.sha256()
+		view = memoryview(self.buffer)
+		end = len(self.buffer)-CHECKSUM_SIZE
+		for start in range(0,end,blocksize):
+			sha.update(view[start:min(start+blocksize,end)])
+		view.release()
+		return sha.hexdigest() == self.checksum
+
+	def section(self,name):
+		'''Return the content of a section as a memoryview of the mapped bundle'''
+		offset,size = self.header["sections"][name]
+		return memoryview(self.buffer)[self.data_start+offset:self.data_start+offset+size]
+
+	def unpack(self,directory,verify=True):
+		'''Unpack the bundle to {directory}/bundle-{checksum}, an already unpacked bundle is reused
+			returns the path of the database and the reference directory
+		'''
+		target = os.path.join(os.path.abspath(directory),"bundle-{checksum}".format(checksum=self.checksum[:16]))
+		if not os.path.exists(os.path.join(target,"database.db")):
+			if verify and not self.verify():
+				raise BundleError("Checksum of {bundle} does not match, the file is damaged".format(bundle=self.path))
+			os.makedirs(directory, exist_ok=True)
+			tmp = tempfile.mkdtemp(prefix=".bundle-", dir=directory)
+			try:
+				os.makedirs(os.path.join(tmp,"references"))
+				database = os.path.join(tmp,"database.db")
+				for name,path in [("database",database),("compiled",cache_path(database))]+[
+								(name,os.path.join(tmp,name)) for name in self.header["sections"] if name.startswith("references/")]:
+					with open(path, "wb") as f:
+						f.write(self.section(name))
+				## The compiled cache is keyed by the modification time of the database
+				mtime_ns = self.header["database"]["mtime_ns"]
+				os.utime(database, ns=(mtime_ns,mtime_ns))
+				os.rename(tmp, target)
+				logger.info("Bundle unpacked to {target}".format(target=target))
+			except OSError:
+				shutil.rmtree(tmp, ignore_errors=True)
+				if not os.path.exists(os.path.join(target,"database.db")):	## another process may have unpacked the bundle first
+					raise
+		self.database = os.path.join(target,"database.db")
+		self.refdir = os.path.join(target,"references")
+		return self.database,self.refdir
+
+def open_bundle(bundle,directory,verify=True):
+	'''Unpack bundle to directory (if not already unpacked), returns the path of the database and the reference directory'''
+	return Bundle(bundle).unpack(directory,verify=verify)
@@ -4,12 +4,24 @@ Copyright (C) 2019 David Sundell @ FOI bioinformatics group
 '''
 
 import os
+import json
 import logging
 logger = logging.getLogger(__name__)
 
 ## import CanSNPer2 specific modules
 from CanSNPer2.modules.ParseXMFA import ParseXMFA
 from CanSNPer2.modules.NewickTree import NewickTree
+from CanSNPer2.modules.TreeRenderer import RenderPool
+from CanSNPer2.modules.CompiledDatabase import get_compiled
+from CanSNPer2.modules.DatabaseConnection import DatabaseConnection,get_statistics
+from CanSNPer2.modules.Journal import get_version,get_changes
+from CanSNPer2.modules.AlignmentMap import map_path,read_map
+from CanSNPer2.modules.FastaIndex import FastaFile
+from CanSNPer2.modules.ReadTyping import ReadTyper,pair_read_files,read_sample_name
+from CanSNPer2.modules.SamTyping import SamTyper,sam_sample_name
+from CanSNPer2.modules.VcfTyping import VcfTyper,vcf_sample_name
+from CanSNPer2.modules.ContigConcat import concatenate_contigs
+from CanSNPer2.modules.ProfileValidation import compare_snp_info,write_validation
 from CanSNPer2.CanSNPerTree import __version__
 
 
@@ -18,6 +30,16 @@ from subprocess import Popen,PIPE,STDOUT
 from multiprocessing import Process, Queue
 from time import sleep,time
 
+'''progressiveMauve options of each alignment profile, typing only needs the bases at the SNP positions
+	fast 		no iterative refinement or backbone output, longer seeds (fewer anchors to chain)
+	sensitive 	shorter seeds, more anchors for distant relatives
+'''
+ALIGN_PROFILES = {
+	"fast": ["--skip-refinement","--seed-weight=19","--disable-backbone"],
+	"default": [],
+	"sensitive": ["--seed-weight=11"],
+}
+
 class Error(Exception):
 	"""docstring for Error"""
 	def __init__(self, value):
@@ -77,8 +99,27 @@ class CanSNPer2(object):
 		'''Fetch other key word arguments'''
 		self.skip_mauve = kwargs["skip_mauve"]
 		self.save_tree = kwargs["save_tree"]
+		self.tree_format = kwargs["tree_format"]
+		self.render_workers = kwargs["render_workers"]	## Number of processes rendering trees outside of the sample loop (0 render inline)
+		self.render_pool = False
 		self.keep_temp = kwargs["keep_temp"]
 		self.keep_going = keep_going
+		self.incremental = kwargs["incremental"]		## Only type the references that changed since the last run of a sample
+		self.read_input = kwargs["read_input"]			## Queries are reads (fastq), typed from k-mers around the SNPs without alignment
+		self.read_options = kwargs["read_options"]
+		self.sam_input = kwargs["sam_input"]			## Queries are reads mapped to one of the references (sorted SAM)
+		self.sam_options = kwargs["sam_options"]
+		self.vcf_input = kwargs["vcf_input"]			## Queries are variant calls against one of the references (VCF)
+		self.uncalled = kwargs["uncalled"]
+		self.mates = {}
+		self.concat_contigs = kwargs["concat_contigs"]		## Contigs of a query are joined to one sequence before alignment
+		self.min_contig_length = kwargs["min_contig_length"]
+		self.align_profile = kwargs["align_profile"]		## progressiveMauve options (ALIGN_PROFILES), recorded in the snps output
+		self.map_dir = False
+		if kwargs["alignment_maps"]:
+			'''Alignment maps are kept with the results, changed references are typed from them with --incremental'''
+			self.map_dir = os.path.abspath("{outdir}/alignment_maps".format(outdir=self.outdir))
+			os.makedirs(self.map_dir,exist_ok=True)
 
 		if kwargs["summary"]:
 			self.summary_set = set()
@@ -88,6 +129,7 @@ class CanSNPer2(object):
 			self.summary = False
 
 		self.no_export = False
+		self.fasta_files = {}		## Indexed reference and query files (FastaFile) opened by get_fasta
 
 	'''CanSNPer2 get functions'''
 
@@ -99,6 +141,105 @@ class CanSNPer2(object):
 		'''references must be available in the refdir'''
 		return [ref for ref in os.listdir(self.refdir) if ref.endswith(".fna")]
 
+	def get_fasta(self,path):
+		'''Return random access (FastaFile) to a reference or query, indexes of files in read-only folders are kept in outdir/fasta_index'''
+		path = os.path.abspath(path)
+		if path not in self.fasta_files:
+			self.fasta_files[path] = FastaFile(path,cachedir=os.path.join(self.outdir,"fasta_index"))
+		return self.fasta_files[path]
+
+	def get_query_name(self,query):
+		'''Return the name of a query (file name without ending, sample name of read files)'''
+		if self.read_input:
+			return read_sample_name(query)
+		if self.sam_input:
+			return sam_sample_name(query)
+		if self.vcf_input:
+			return vcf_sample_name(query)
+		return os.path.basename(query).rsplit(".",1)[0]
+
+	def get_reference_fasta(self):
+		'''Return random access to all references {reference: FastaFile}'''
+		if self.vcf_input and not os.path.isdir(self.refdir):		## the reference genomes are optional for variant calls
+			return {}
+		return dict((ref.rsplit(".",1)[0],self.get_fasta(os.path.join(self.refdir,ref))) for ref in self.get_references())
+
+	def no_alignment(self):
+		'''Queries are typed without alignments (reads, mapped reads or variant calls)'''
+		return self.read_input or self.sam_input or self.vcf_input
+
+	def get_read_typer(self,xmfa_obj):
+		'''Create the read typer (k-mer index of all references and the pool of processes counting reads)'''
+		return ReadTyper(xmfa_obj,self.get_reference_fasta(),**self.read_options)
+
+	def get_state_path(self):
+		'''Return the path of the incremental state of the current query'''
+		return "{outdir}/{query}.state.json".format(outdir=self.outdir,query=self.query_name)
+
+	def get_query_stat(self,query):
+		st = os.stat(query)
+		return [st.st_size,st.st_mtime_ns]
+
+	def get_state(self,query,conn):
+		'''Compare the saved state of a query with the database journal and the reference folder
+			returns the results of references that are still valid (False if the sample is up to date) and the references to align
+		'''
+		references = dict((ref.rsplit(".",1)[0],ref) for ref in self.get_references())
+		try:
+			with open(self.get_state_path()) as f:
+				state = json.load(f)
+		except (FileNotFoundError,ValueError):
+			return {},sorted(references.values())
+		if self.rerun or state["query"] != self.get_query_stat(query):
+			return {},sorted(references.values())
+		changes = get_changes(conn,state["database_version"])
+		if changes["all"]:
+			return {},sorted(references.values())
+		stale = (changes["references"] | (set(references) - set(state["references"]))) & set(references)
+		if not stale and not changes["tree"] and changes["version"] == state["database_version"] and set(state["references"]) == set(references):
+			return False,[]
+		stored = dict((ref,results) for ref,results in state["references"].items() if ref in references and ref not in stale)
+		logger.info("{query}: database version {old} -> {new}, align {n} of {total} references".format(
+						query=self.query_name,old=state["database_version"],new=changes["version"],n=len(stale),total=len(references)))
+		return stored,[references[ref] for ref in sorted(stale)]
+
+	def save_state(self,query,xmfa_obj,references,SNPS,SNP_info,called_snps,stored):
+		'''Save the results of each reference for the current query, stored are the results kept from the previous state'''
+		state = {"database_version": self.database_version, "query": self.get_query_stat(query), "references": dict(stored)}
+		for ref in references:
+			reference = ref.rsplit(".",1)[0]
+			snp_ids = xmfa_obj.get_reference_snp_ids(reference)
+			state["references"][reference] = {
+				"snps": dict((snp,value) for snp,value in SNPS.items() if snp in snp_ids),
+				"snp_info": [snp for snp in SNP_info if snp[1] == reference],
+				"called_snps": [snp for snp in called_snps if snp in snp_ids]
+			}
+		tmp = self.get_state_path()+".tmp"
+		with open(tmp,"w") as f:
+			json.dump(state,f)
+		os.replace(tmp,self.get_state_path())
+
+	def type_from_maps(self,query,xmfa_obj,references):
+		'''Type references from the saved alignment maps of the current query
+			returns the results of each reference typed and the references that have no map (have to be aligned)
+		'''
+		typed,missing = {},[]
+		for ref in references:
+			reference = ref.rsplit(".",1)[0]
+			path = map_path(self.map_dir,reference,self.query_name)
+			try:
+				if os.stat(path).st_mtime_ns < os.stat(query).st_mtime_ns:	## the query changed after it was aligned
+					raise FileNotFoundError(path)
+				alignment_map = read_map(path)
+			except (FileNotFoundError,ValueError):
+				missing.append(ref)
+				continue
+			SNPS,SNP_info,called_snps = alignment_map.type_snps(xmfa_obj.get_reference_snps(reference))
+			typed[reference] = {"snps": SNPS, "snp_info": SNP_info, "called_snps": called_snps}
+		if typed:
+			logger.info("{query}: {n} references typed from alignment maps".format(query=self.query_name,n=len(typed)))
+		return typed,missing
+
 	def get_tempfiles(self):
 		'''List all files in the tmp directory'''
 		return [ref for ref in os.listdir(self.tmpdir)]
@@ -176,8 +317,9 @@ class CanSNPer2(object):
 			log_file = "{logdir}/{ref}_{target}.mauve.log".format(logdir=self.logdir,ref=ref_name,target=self.query_name)
 
 			'''Create run command for mauve'''
-			command = "{mauve_path}progressiveMauve --output {xmfa} {ref_fasta} {target_fasta}".format(
+			command = "{mauve_path}progressiveMauve {options}--output {xmfa} {ref_fasta} {target_fasta}".format(
 							mauve_path	  = self.mauve_path,
+							options		 = "".join(option+" " for option in ALIGN_PROFILES[self.align_profile]),
 							xmfa			= xmfa_output,
 							ref_fasta	   = ref_file,
 							target_fasta	= query
@@ -187,8 +329,19 @@ class CanSNPer2(object):
 			self.xmfa_files.append(xmfa_output) ## Store the path to xmfa files as they will be used later
 		return commands,logs
 
+	def concatenate_query(self,query):
+		'''Join the contigs of a query to one sequence (tmpdir), the interval map of the contigs is saved to outdir/{query}_contigs.txt'''
+		concatenated = "{tmpdir}/{query}.concat.fna".format(tmpdir=self.tmpdir.rstrip("/"),query=self.query_name)
+		contig_map = concatenate_contigs(query,concatenated,min_length=self.min_contig_length)
+		if not contig_map:
+			return query
+		contig_map.write("{outdir}/{query}_contigs.txt".format(outdir=self.outdir,query=self.query_name))
+		return concatenated
+
 	def align(self, query, references=[]):
 		'''Align sequences and run mauve as subprocess'''
+		if self.concat_contigs and not self.skip_mauve:
+			query = self.concatenate_query(query)
 		commands,logs = self.create_mauve_command(query,references)
 		if not self.skip_mauve: ### If mauve command was already run before don´t run mauve return xmfa paths
 			ret = self.run_mauve(commands,logs)
@@ -208,15 +361,63 @@ class CanSNPer2(object):
 			logger.info("Alignments for {query} complete!".format(query=query))
 		return self.xmfa_files
 
+	def validate_profile(self,database):
+		'''Align each query with the default profile and with align_profile and compare the bases typed at every SNP,
+			the per SNP concordance and the speedup are written to outdir/profile_validation_{profile}.txt (and .summary)
+		'''
+		query = self.query
+		if len(query) > 0 and query[0].endswith(".txt"):
+			query = self.read_query_textfile_input(query[0])
+		catalogue = get_compiled(database)
+		if catalogue:
+			catalogue.preload()
+		parse_xmfa_obj = ParseXMFA(database=database,catalogue=catalogue,export=True,map_dir=False,verbose=self.verbose)
+		profile,results = self.align_profile,[]
+		print("Validate the {profile} alignment profile against default on {n} queries".format(profile=profile,n=len(query)))
+		for q in query:
+			self.query_name = self.get_query_name(q)
+			typed,seconds = {},{}
+			for align_profile in ["default",profile]:
+				self.align_profile = align_profile
+				tic = time()
+				xmfa_files = self.align(q)
+				seconds[align_profile] = time()-tic
+				self.xmfa_files = []
+				if len(xmfa_files) == 0:
+					break
+				typed[align_profile] = self.find_snps_multiproc(xmfa_obj=parse_xmfa_obj,xmfa_files=xmfa_files,export=True)[1]
+			self.align_profile = profile
+			if len(typed) < 2:
+				logger.warning("Mauve error, {query} is left out of the validation".format(query=q))
+				continue
+			rows = compare_snp_info(self.query_name,typed["default"],typed[profile])
+			results.append((self.query_name,rows,seconds["default"],seconds[profile]))
+			logger.info("{query}: {concordant}/{n} SNPs concordant, {default:.1f}s default, {t:.1f}s {profile}".format(query=self.query_name,
+							concordant=sum(row[6] == "yes" for row in rows),n=len(rows),default=seconds["default"],t=seconds[profile],profile=profile))
+		path = "{outdir}/profile_validation_{profile}.txt".format(outdir=self.outdir,profile=profile)
+		total = write_validation(path,profile,results)
+		print("{profile}: {concordant}/{n} SNPs concordant ({concordance}), speedup {speedup} ({path})".format(profile=profile,
+						concordant=total[2],n=total[1],concordance=total[3],speedup=total[6],path=path))
+		if not self.keep_temp:
+			self.cleanup()
+		return total
+
 	'''Functions'''
 
 	def create_tree(self,SNPS,name,called_snps,save_tree,min_required_hits,strictness=0.7, summary=False):
-		'''This function uses ETE3 to color the SNP tree in the database with SNPS found in the reference database
-			and outputs a pdf file
+		'''This function colors the SNP tree in the database with SNPS found in the reference database
+			and outputs the tree in the requested formats (svg, newick, json or pdf using ETE3)
 		'''
 		newickTree = NewickTree(self.database,name,self.outdir,min_required_hits=min_required_hits, strictness=strictness)
-		final_snp = newickTree.draw_ete3_tree(SNPS,called_snps,save_tree,summary=summary)
-		logger.info("{outdir}/{name}_tree.pdf".format(outdir =self.outdir, name=name))
+		if save_tree and self.render_workers > 0:
+			'''Queue the tree in the render pool, the calls are returned without waiting for the tree'''
+			if not self.render_pool:
+				self.render_pool = RenderPool(newickTree.get_renderer(),processes=self.render_workers)
+			self.render_pool.submit(newickTree.tree_prefix,SNPS,called_snps,self.tree_format)
+			if summary:
+				return
+			return newickTree.call_snps(SNPS,called_snps)
+		final_snp = newickTree.draw_tree(SNPS,called_snps,save_tree,summary=summary,tree_format=self.tree_format)
 		return final_snp
 
 	def read_query_textfile_input(self,query_file):
@@ -275,7 +476,8 @@ class CanSNPer2(object):
 			p = Process(target=self.find_snps, args=(xmfa_obj,xmfa_file ,result_queue,export_queue,called_queue))
 			p.start()
 			jobs.append(p)
-			sleep(0.05) ## A short sleep to make sure all threads do not initiate access to the database file simultanously
+			if not xmfa_obj.catalogue:
+				sleep(0.05) ## A short sleep to make sure all threads do not initiate access to the database file simultanously
 		
 		## Parse output queues from jobs continuously
 		finish_signals = {'SNPS':set(),'SNP_info':set(),'called_snps':set()} # will keep track when all workers are finished
@@ -365,6 +567,11 @@ class CanSNPer2(object):
 			if self.query[0].endswith(".txt"):
 				logger.info("Textfile input was found, parsing filepaths in {q} file".format(q=self.query[0]))
 				self.query=self.read_query_textfile_input(self.query)
+			if self.read_input:
+				'''Paired read files are typed together, the first file of each pair is used as the query'''
+				samples = pair_read_files(self.query)
+				self.mates = dict(samples)
+				self.query = [first for first,mates in samples]
 
 			'''Main function of CanSNPer2
 					1. Align sequences with progressiveMauve
@@ -374,47 +581,90 @@ class CanSNPer2(object):
 					4. Clean up tmp directory
 					'''
 
+			'''Load the SNP catalogue once, it is shared (copy-on-write) by the processes parsing the alignments'''
+			catalogue = get_compiled(database)
+			if catalogue:
+				catalogue.preload()
 			''' Create ParseXMFA object'''
 			parse_xmfa_obj = ParseXMFA(
 						database=database,
+						catalogue=catalogue,
 						export=self.export,
-						verbose=self.verbose)  ## Create XMFA object and connect to database
+						map_dir=self.map_dir,
+						verbose=self.verbose)  ## Create XMFA object (connects to the database only if the catalogue could not be loaded)
+			if self.incremental:
+				'''The journal of the database tells which references changed since a sample was typed'''
+				journal = DatabaseConnection(database,readonly=True).conn
+				self.database_version = get_version(journal)
 			'''Walk through the list of queries supplied'''
-			if not self.skip_mauve: print("Run {n} alignments to references using progressiveMauve".format(n=len(self.query)))
+			if self.read_input:
+				read_typer = self.get_read_typer(parse_xmfa_obj)
+			elif self.sam_input:
+				sam_typer = SamTyper(parse_xmfa_obj,self.get_reference_fasta(),**self.sam_options)
+			elif self.vcf_input:
+				vcf_typer = VcfTyper(parse_xmfa_obj,self.get_reference_fasta(),references=catalogue.header["references"] if catalogue else [],uncalled=self.uncalled)
+			elif not self.skip_mauve: print("Run {n} alignments to references using progressiveMauve".format(n=len(self.query)))
 			for q in self.query:			## For each query file_path
 				try:
-					self.query_name = os.path.basename(q).rsplit(".",1)[0]  ## get name of file and remove ending
+					self.query_name = self.get_query_name(q)  ## get name of file and remove ending
 
 					qfile = q.rsplit("/")[-1]   ## Remove path from query name
 					if not os.path.exists(q):
 						raise FileNotFoundError("Input file: {qfile} was not found!".format(qfile=q))
 
 					outputfile = "{outdir}/{xmfa}_snps.txt".format(outdir=self.outdir,xmfa=self.query_name)
-					if os.path.exists(outputfile) and not self.rerun:
+					stored,references = {},[]	## Results kept from the previous run and references to align (all if empty)
+					if self.incremental:
+						stored,references = self.get_state(q,journal)
+						if stored is False:
+							logger.info("{query} is up to date with database version {version}, skip!".format(query=qfile,version=self.database_version))
+							continue
+						if self.map_dir and not self.rerun and not self.no_alignment():		## Use the alignment maps saved when the sample was aligned before
+							typed,references = self.type_from_maps(q,parse_xmfa_obj,references)
+							stored.update(typed)
+					elif os.path.exists(outputfile) and not self.rerun:
 						logger.debug("{outputfile} already exits, skip!".format(outputfile=outputfile))
 						continue
 					logger.info("Running CanSNPer2 on {query}".format(query=qfile))
-					if not self.skip_mauve: ### If mauve command was already run before skip step
+					if not self.skip_mauve and not self.no_alignment(): ### If mauve command was already run before skip step
 						logger.info("Run mauve alignments")
 
 					'''For each query fasta align to all CanSNP references the reference folder
 						if skip_mauve parameter is True this the align function will only format xmfa file paths
 					'''
-					xmfa_files = self.align(q)
-					logger.debug(xmfa_files)
-					if len(xmfa_files) == 0: ## if keep going is set and mauve exits with an error continue to next sequence
-						logger.debug("Mauve exited with a non zero exit status, continue with next sample!")
-						logger.warning("Mauve error skip {sample}".format(q))
-						self.xmfa_files = []
-						continue
-					'''Parse Mauve XMFA output and find SNPs; returns SNPS (for the visual tree) and SNP_info (text file output)'''
-					logger.info("Find SNPs")
-					try:
-						SNPS,SNP_info,called_snps = self.find_snps_multiproc(xmfa_obj=parse_xmfa_obj,xmfa_files=xmfa_files,export=True)
-					except FileNotFoundError:
-						logger.warning("One or several xmfa files were not found for {qfile} continue with next file".format(qfile=qfile))
-						self.xmfa_files = []
-						continue
+					if self.incremental and len(references) == 0:
+						SNPS,SNP_info,called_snps = {},[],[]	## Only the tree changed, the SNPs of all references are kept
+					elif self.read_input:
+						logger.info("Type SNPs from reads")
+						SNPS,SNP_info,called_snps = read_typer.type_reads([q]+self.mates[q],references)
+					elif self.sam_input:
+						logger.info("Type SNPs from mapped reads")
+						SNPS,SNP_info,called_snps = sam_typer.type_sam(q,references)
+					elif self.vcf_input:
+						SNPS,SNP_info,called_snps = vcf_typer.type_vcf(q,references)
+					else:
+						xmfa_files = self.align(q,references)
+						logger.debug(xmfa_files)
+						if len(xmfa_files) == 0: ## if keep going is set and mauve exits with an error continue to next sequence
+							logger.debug("Mauve exited with a non zero exit status, continue with next sample!")
+							logger.warning("Mauve error skip {sample}".format(sample=q))
+							self.xmfa_files = []
+							continue
+						'''Parse Mauve XMFA output and find SNPs; returns SNPS (for the visual tree) and SNP_info (text file output)'''
+						logger.info("Find SNPs")
+						try:
+							SNPS,SNP_info,called_snps = self.find_snps_multiproc(xmfa_obj=parse_xmfa_obj,xmfa_files=xmfa_files,export=True)
+						except FileNotFoundError:
+							logger.warning("One or several xmfa files were not found for {qfile} continue with next file".format(qfile=qfile))
+							self.xmfa_files = []
+							continue
+					if self.incremental:
+						typed = (SNPS,SNP_info,called_snps)
+						SNPS,SNP_info,called_snps = dict(SNPS),list(SNP_info),list(called_snps)
+						for results in stored.values():		## Add the results of references that did not change
+							SNPS.update(results["snps"])
+							SNP_info += results["snp_info"]
+							called_snps += results["called_snps"]
 					'''If file export is requested print the result for each SNP location to file'''
 					if self.export:
 						outputfile = "{outdir}/{xmfa}_not_called.txt".format(outdir=self.outdir,xmfa=self.query_name)
@@ -431,7 +681,7 @@ class CanSNPer2(object):
 								else:
 									print("\t".join(snp),file=snplist_out)
 
-					'''If save tree is requested print tree using ETE3 prints a pdf tree output'''
+					'''If save tree is requested print tree (svg by default, pdf output requires ETE3)'''
 					SNP = "NA" ## Default message if SNP cannot be confirmed
 					final_snp,message,called = self.create_tree(SNPS,self.query_name,called_snps,self.save_tree,min_required_hits=self.min_required_hits,strictness=self.strictness)
 					if final_snp:
@@ -446,17 +696,23 @@ class CanSNPer2(object):
 										print("\t".join(self.csnpdict[snp[1]]),file=called_out)
 								print("SNP path: {path}".format(path=";".join([snp[1] for snp in called])),file=called_out)
 								print("Final SNP: {snp} found/depth: {found}/{depth}".format(snp=SNP,depth=int(final_snp[0]),found=final_snp[2][1]),file=called_out)
+								if not self.no_alignment():
+									print("Alignment profile: {profile}".format(profile=self.align_profile),file=called_out)
 						logger.info("Final SNP: {snp} found/depth: {found}/{depth}".format(snp=SNP,depth=int(final_snp[0]),found=final_snp[2][1]))
 					else:
 						if self.export:
 							with open(outputfile2, "a") as called_out:
 								print("Final SNP: {snp}".format(snp=SNP), file=called_out)
+								if not self.no_alignment():
+									print("Alignment profile: {profile}".format(profile=self.align_profile),file=called_out)
 						logger.info(message)
 					if self.summary and SNP != "NA":
 						self.summary_set |= set([SNP])
 						self.called_genome[SNP] = self.query_name
 					if self.export:
 						print("{query}: {SNP}".format(query=self.query_name, SNP=SNP))
+					if self.incremental:
+						self.save_state(q,parse_xmfa_obj,references,*typed,stored)
 					'''Clean references to aligned xmfa files between queries if several was supplied'''
 					self.xmfa_files = []
 				except:
@@ -464,10 +720,19 @@ class CanSNPer2(object):
 						raise CanSNPer2Error("A file did not run correctly exit CanSNPer2 (use --keep_going to continue with next file!)")
 					logger.debug("An error occured during processing of {file}".format(file=self.query_name))
 
+			if self.read_input:
+				read_typer.close()
+
 		if self.summary:
 			self.print_summary()
+		if self.render_pool:
+			'''Wait for the queued trees before temporary files are removed'''
+			logger.info("Waiting for queued trees to be rendered")
+			self.render_pool.close()
 		'''Finally clean up temporary folder when all alignments and trees has been printed!'''
 		if not self.keep_temp and len(self.query) > 0: ## if keep temp is turned on do not remove away alignments also if no input files were given
 			self.cleanup()
 
+		dbstats = get_statistics()
+		logger.info("Database: {n} statements executed in {t:.3f}s".format(n=dbstats["statements"],t=dbstats["seconds"]))
 		logger.info("CanSNPer2 finished successfully, files can be found in {outdir}".format(outdir=self.outdir+"/"))
@@ -0,0 +1,325 @@
+'''
+CompiledDatabase stores the tree and the SNP catalogue of a CanSNPer2 database as flat arrays
+in a cache file next to the database ({database}.cache), databases in folders that are not writable
+(shared installs) are cached per user ($XDG_CACHE_HOME/CanSNPer2, default ~/.cache/CanSNPer2)
+
+The cache is keyed by a fingerprint of the database (size, mtime and sha256 of the content) and
+is rebuilt automatically when the database changes. Warm starts map the file (mmap) and read the
+arrays without running any SQL. If the database changes were recorded in the journal only the tree
+and the references that changed are read from the database, the rest is copied from the old cache.
+
+	File layout
+		magic 				8 bytes
+		header length 		8 bytes (little endian)
+		header 				json (version, fingerprint, references and sections)
+		sections 			raw array data, strings are utf-8 joined by \\0
+'''
+
+import os
+import sys
+import json
+import mmap
+import sqlite3
+import hashlib
+import tempfile
+from array import array
+from urllib.parse import quote
+from CanSNPer2.modules.Journal import get_version,get_changes
+import logging
+logger = logging.getLogger(__name__)
+
+MAGIC = b"CSNPC\x00\x00\x01"
+CACHE_VERSION = 2
+INT_TYPE = "q"			## 64 bit signed integers
+
+## Compiled databases opened by this process (the mmap is shared by all objects using the same database)
+_compiled = {}
+
+def cache_path(database):
+	'''Return the path of the cache file of a database'''
+	return "{database}.cache".format(database=database)
+
+def user_cache_path(database):
+	'''Return the path of the per user cache of a database (used when the database folder is not writable)'''
+	cachedir = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"),".cache")
+	key = hashlib.sha1(os.path.abspath(database).encode("utf-8")).hexdigest()[:16]
+	return os.path.join(cachedir,"CanSNPer2","{key}_{name}".format(key=key,name=os.path.basename(cache_path(database))))
+
+def invalidate(database):
+	'''Remove the cache of a database, it will be recompiled the next time the database is used'''
+	_compiled.pop(os.path.abspath(database),None)
+	for path in [cache_path(database),user_cache_path(database)]:
+		try:
+			os.remove(path)
+			logger.debug("Removed compiled database {path}".format(path=path))
+		except FileNotFoundError:
+			pass
+		except OSError as e:
+			logger.warning("Compiled database {path} could not be removed ({e})".format(path=path,e=e))
+
+def get_compiled(database):
+	'''Return the CompiledDatabase of database, False if the database could not be compiled'''
+	key = os.path.abspath(database)
+	if key not in _compiled:
+		try:
+			_compiled[key] = CompiledDatabase(database)
+		except Exception as e:
+			logger.warning("Database {database} could not be compiled, use sqlite ({e})".format(database=database,e=e))
+			_compiled[key] = False
+	compiled = _compiled[key]
+	if compiled and not compiled.is_current():
+		compiled.load()
+	return compiled
+
+def file_checksum(path,blocksize=1<<20):
+	'''Return the sha256 of a file'''
+	sha = hashlib.sha256()
+	with open(path, "rb") as f:
+		for block in iter(lambda: f.read(blocksize), b""):
+			sha.update(block)
+	return sha.hexdigest()
+
+class CompiledDatabase(object):
+	"""CompiledDatabase loads (and if needed compiles) the tree and SNP catalogue of a CanSNPer2 database
+			links 		parent and child id of every link in the tree (ordered by child)
+			nodes 		node id and the name used in trees (snp_id or -name- if the node has no annotation)
+			snps 		per reference positions (sorted), ancestral base, derived base and snp_id
+	"""
+	def __init__(self, database):
+		super(CompiledDatabase, self).__init__()
+		self.database = database
+		self.path = cache_path(database)
+		self.buffer = False
+		self.load()
+
+	def __repr__(self):
+		return "CompiledDatabase()"
+
+	'''Fingerprint functions'''
+
+	def stat(self):
+		st = os.stat(self.database)
+		return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+	def fingerprint(self):
+		'''Return the fingerprint of the database'''
+		fingerprint = self.stat()
+		fingerprint["sha256"] = file_checksum(self.database)
+		return fingerprint
+
+	def is_current(self):
+		'''Check if the loaded cache belongs to the current database, the checksum is only calculated if size or mtime changed'''
+		if not self.buffer:
+			return False
+		stored = self.header["fingerprint"]
+		stat = self.stat()
+		if stat["size"] == stored["size"] and stat["mtime_ns"] == stored["mtime_ns"]:
+			return True
+		if stat["size"] == stored["size"] and file_checksum(self.database) == stored["sha256"]:
+			logger.debug("Database {database} was touched but not modified".format(database=self.database))
+			return True
+		return False
+
+	'''Read functions'''
+
+	def load(self):
+		'''Map the cache file, compile the database if the cache is missing or does not match the database'''
+		if not os.path.exists(self.database):
+			raise FileNotFoundError("Database {database} does not exist".format(database=self.database))
+		self.buffer = False
+		for path in [cache_path(self.database),user_cache_path(self.database)]:
+			if not os.path.exists(path):
+				continue
+			try:
+				with open(path, "rb") as f:
+					self.set_buffer(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+				self.path = path
+			except (ValueError,OSError) as e:
+				logger.debug("Compiled database {path} could not be read ({e})".format(path=path,e=e))
+			if self.is_current():
+				break
+		if not self.is_current():
+			logger.info("Compile database {database}".format(database=self.database))
+			self.set_buffer(self.compile(previous=self.buffer))
+		return self
+
+	def set_buffer(self,buffer):
+		'''Parse the header of a compiled database buffer'''
+		if bytes(buffer[:len(MAGIC)]) != MAGIC:
+			raise ValueError("not a compiled CanSNPer2 database")
+		start = len(MAGIC)+8
+		length = int.from_bytes(buffer[len(MAGIC):start], "little")
+		header = json.loads(bytes(buffer[start:start+length]).decode("utf-8"))
+		if header["version"] != CACHE_VERSION or header["byteorder"] != sys.byteorder:
+			raise ValueError("compiled with another version")
+		self.header = header
+		self.data_start = start+length
+		self.buffer = buffer
+		self.view = memoryview(buffer)
+		self.snps = {}		## SNPs of each reference, filled on first request (or by preload)
+
+	def section(self,name):
+		'''Return a section of the cache, integers are returned as a memoryview (no copy)'''
+		typecode,offset,length,count = self.header["sections"][name]
+		data = self.view[self.data_start+offset:self.data_start+offset+length]
+		if typecode == "s":
+			if count == 0:
+				return []
+			return bytes(data).decode("utf-8").split("\0")
+		return data.cast(typecode)
+
+	def get_tree(self):
+		'''Return the links (parent,child) of the tree'''
+		return list(zip(self.section("tree.parent"),self.section("tree.child")))
+
+	def get_nodes(self):
+		'''Return the tree node names as a dictionary {id: name}'''
+		return dict(zip(self.section("nodes.id"),self.section("nodes.name")))
+
+	def get_snps(self, reference):
+		'''Return the SNPs of a reference the same way as XMFAFunctions.get_snps,
+			returns False if the reference was not compiled (no SNPs or invalid annotation)
+		'''
+		if reference not in self.header["references"]:
+			return False
+		if reference not in self.snps:
+			key = "snps.{reference}.".format(reference=reference)
+			positions = self.section(key+"position").tolist()
+			SNPs = dict((pos,(pos,rbase,tbase,snp)) for pos,rbase,tbase,snp in zip(
+							positions,self.section(key+"ancestral_base"),self.section(key+"derived_base"),self.section(key+"snp_id")))
+			self.snps[reference] = (SNPs,positions)
+		SNPs,positions = self.snps[reference]
+		return SNPs,list(positions)		## the position list is consumed by the parser, return a copy
+
+	def preload(self):
+		'''Read the SNPs of all references, called before worker processes are forked so that they share the catalogue'''
+		for reference in self.header["references"]:
+			self.get_snps(reference)
+		return self
+
+	'''Compile functions'''
+
+	def reusable(self,changes):
+		'''Return the sections of the loaded cache that are not affected by changes'''
+		sections = {}
+		if changes["all"]:
+			return sections
+		if not changes["tree"]:
+			for name in ["tree.parent","tree.child"]:
+				sections[name] = array(INT_TYPE,self.section(name).tobytes())
+		for reference in self.header["references"]:
+			if reference in changes["references"]:
+				continue
+			key = "snps.{reference}.".format(reference=reference)
+			sections[key+"position"] = array(INT_TYPE,self.section(key+"position").tobytes())
+			for name in ["ancestral_base","derived_base","snp_id"]:
+				sections[key+name] = self.section(key+name)
+		return sections
+
+	def compile(self,previous=False):
+		'''Read the database and write the cache, returns the compiled buffer
+			previous is the loaded (outdated) cache, sections not changed since it was compiled are copied from it
+		'''
+		fingerprint = self.fingerprint()
+		conn = sqlite3.connect("file:{database}?mode=ro".format(database=quote(os.path.abspath(self.database))), uri=True)
+		sections = []
+		try:
+			journal_version = get_version(conn)
+			reuse = {}
+			if previous and self.header.get("journal_version",0) < journal_version:
+				changes = get_changes(conn,self.header["journal_version"])
+				reuse = self.reusable(changes)
+				logger.info("Database changed from version {old} to {new}, {n} sections are reused".format(
+								old=self.header["journal_version"],new=journal_version,n=len(reuse)))
+			if "tree.parent" in reuse:
+				sections.append(("tree.parent", reuse["tree.parent"]))
+				sections.append(("tree.child", reuse["tree.child"]))
+			else:
+				links = conn.execute("SELECT parent,child FROM tree ORDER BY child ASC").fetchall()
+				sections.append(("tree.parent", array(INT_TYPE,[link[0] for link in links])))
+				sections.append(("tree.child", array(INT_TYPE,[link[1] for link in links])))
+			ids,names = [],[]
+			for id,name,snp_id in conn.execute("SELECT id,name,snp_id FROM nodes LEFT JOIN snp_annotation on (snp_annotation.node_id = nodes.id)"):
+				ids.append(id)
+				names.append(snp_id if snp_id != None else "-"+name+"-")
+			sections.append(("nodes.id", array(INT_TYPE,ids)))
+			sections.append(("nodes.name", names))
+			snps = {}
+			QUERY = '''SELECT genome, position, derived_base, ancestral_base, snp_id
+							FROM snp_annotation
+							LEFT JOIN snp_references on (snp_references.id = snp_annotation.genome_i)
+							WHERE genome IS NOT NULL ORDER BY genome,position'''
+			reused = set(name[len("snps."):-len(".position")] for name in reuse if name.endswith(".position"))
+			if reused:
+				## Only read the references that changed (or could not be compiled before)
+				genomes = [genome for genome, in conn.execute("SELECT DISTINCT genome FROM snp_references WHERE genome IS NOT NULL") if genome not in reused]
+				QUERY = QUERY.replace("WHERE genome IS NOT NULL","WHERE genome IN ({genomes})".format(genomes=",".join("?"*len(genomes))))
+			else:
+				genomes = []
+			for genome,pos,tbase,rbase,snp in conn.execute(QUERY,genomes):
+				snps.setdefault(genome,[]).append((pos,rbase,tbase,snp))
+		finally:
+			conn.close()
+		references = []
+		for reference in sorted(reused):
+			key = "snps.{reference}.".format(reference=reference)
+			for name in ["position","ancestral_base","derived_base","snp_id"]:
+				sections.append((key+name, reuse[key+name]))
+			references.append(reference)
+		for reference,rows in snps.items():
+			positions = [row[0] for row in rows]
+			if len(set(positions)) != len(positions):
+				logger.debug("Reference {reference} has duplicate SNP positions, not compiled".format(reference=reference))
+				continue
+			key = "snps.{reference}.".format(reference=reference)
+			sections.append((key+"position", array(INT_TYPE,positions)))
+			sections.append((key+"ancestral_base", [row[1] for row in rows]))
+			sections.append((key+"derived_base", [row[2] for row in rows]))
+			sections.append((key+"snp_id", [row[3] for row in rows]))
+			references.append(reference)
+		buffer = self.serialize(fingerprint,references,sections,journal_version)
+		self.write(buffer)
+		return buffer
+
+	def serialize(self,fingerprint,references,sections,journal_version=0):
+		'''Return the cache as bytes'''
+		header = {"version": CACHE_VERSION, "byteorder": sys.byteorder, "fingerprint": fingerprint, "journal_version": journal_version,
+					"references": references, "sections": {}}
+		data = []
+		offset = 0
+		for name,values in sections:
+			if isinstance(values,array):
+				typecode,raw = values.typecode,values.tobytes()
+			else:
+				typecode,raw = "s","\0".join(str(value) for value in values).encode("utf-8")
+			header["sections"][name] = (typecode,offset,len(raw),len(values))
+			## Align all sections to 8 bytes so that integer arrays can be cast without copy
+			padding = -len(raw) % 8
+			data.append(raw+b"\0"*padding)
+			offset += len(raw)+padding
+		header = json.dumps(header).encode("utf-8")
+		header += b" "*(-(len(MAGIC)+8+len(header)) % 8)
+		return b"".join([MAGIC,len(header).to_bytes(8,"little"),header]+data)
+
+	def write(self,buffer):
+		'''Write the cache atomically next to the database, or to the per user cache if the database folder is read only
+			(the run continues without a cache file if neither can be written)
+		'''
+		for path in [cache_path(self.database),user_cache_path(self.database)]:
+			tmp = False
+			try:
+				os.makedirs(os.path.dirname(os.path.abspath(path)),exist_ok=True)
+				fd,tmp = tempfile.mkstemp(prefix=os.path.basename(path)+".", dir=os.path.dirname(os.path.abspath(path)))
+				with os.fdopen(fd, "wb") as f:
+					f.write(buffer)
+				os.chmod(tmp, 0o644)		## mkstemp files are private, the cache is shared like the database
+				os.replace(tmp, path)
+				self.path = path
+				logger.info("Compiled database written to {path}".format(path=path))
+				return True
+			except OSError as e:
+				logger.debug("Compiled database could not be written to {path} ({e})".format(path=path,e=e))
+				if tmp and os.path.exists(tmp):
+					os.remove(tmp)
+		logger.warning("Compiled database of {database} could not be written (folder and user cache are read only)".format(database=self.database))
+		return False
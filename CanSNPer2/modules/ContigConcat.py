@@ -0,0 +1,105 @@
+'''
+ContigConcat joins the contigs of a draft assembly into one pseudo-molecule before alignment
+
+progressiveMauve aligns a fragmented assembly block by block, thousands of contigs give thousands of short
+LCBs to align and parse. The contigs are ordered by length (longest first) and joined by runs of N (spacer),
+contigs shorter than min_length can be left out (SNPs on them are then not typed). Dashes in the sequence
+are replaced by N (progressiveMauve fails on them).
+
+The interval map of the contigs in the pseudo-molecule is kept so that query positions (xmfa files and
+alignment maps) can be traced back to the original contigs.
+
+	Interval map (tab separated)
+		Contig 	Start 	End 	Length 		start and end in the pseudo-molecule (1-based, inclusive)
+'''
+
+import os
+from bisect import bisect_right
+import logging
+logger = logging.getLogger(__name__)
+
+SPACER = 100
+LINE_LENGTH = 80
+
+def read_contigs(path):
+	'''Return the contigs of a fasta file [(name, sequence)]'''
+	contigs,name,lines = [],False,[]
+	with open(path) as f:
+		for line in f:
+			if line.startswith(">"):
+				if name:
+					contigs.append((name,"".join(lines)))
+				name,lines = (line[1:].split() or ["contig_{n}".format(n=len(contigs)+1)])[0],[]
+			else:
+				lines.append(line.strip())
+	if name:
+		contigs.append((name,"".join(lines)))
+	return contigs
+
+def read_contig_map(path):
+	'''Read an interval map written by ContigMap.write'''
+	contig_map = ContigMap()
+	with open(path) as f:
+		next(f)		## header
+		for line in f:
+			contig,start,end,length = line.rstrip("\n").split("\t")
+			contig_map.add(contig,int(start),int(end))
+	return contig_map
+
+class ContigMap(object):
+	"""Intervals (start, end, contig) of the contigs in a pseudo-molecule"""
+	def __init__(self):
+		super(ContigMap, self).__init__()
+		self.intervals = []
+		self._starts = []
+
+	def __repr__(self):
+		return "ContigMap({n} contigs)".format(n=len(self.intervals))
+
+	def add(self,contig,start,end):
+		'''Add a contig at start-end (1-based, inclusive) of the pseudo-molecule, contigs are added in order'''
+		self.intervals.append((start,end,contig))
+		self._starts.append(start)
+
+	def to_contig(self,position):
+		'''Return (contig, position in the contig) of a pseudo-molecule position, False if the position is in a spacer'''
+		i = bisect_right(self._starts,position)-1
+		if i < 0 or position > self.intervals[i][1]:
+			return False
+		start,end,contig = self.intervals[i]
+		return contig,position-start+1
+
+	def write(self,path):
+		with open(path, "w") as f:
+			print("\t".join(["Contig","Start","End","Length"]),file=f)
+			for start,end,contig in self.intervals:
+				print("\t".join([contig,str(start),str(end),str(end-start+1)]),file=f)
+		return path
+
+def concatenate_contigs(query,output,spacer=SPACER,min_length=0):
+	'''Join the contigs of query (fasta) into one pseudo-molecule written to output, returns the ContigMap
+		(False if the query has a single contig and is used as it is)
+	'''
+	contigs = read_contigs(query)
+	if len(contigs) < 2:
+		return False
+	kept = sorted([contig for contig in contigs if len(contig[1]) >= min_length],key=lambda contig: -len(contig[1]))
+	if not kept:
+		logger.warning("All contigs of {query} are shorter than {min_length}, none are removed".format(query=query,min_length=min_length))
+		kept = sorted(contigs,key=lambda contig: -len(contig[1]))
+	contig_map,parts,position = ContigMap(),[],1
+	for name,sequence in kept:
+		if parts:
+			parts.append("N"*spacer)
+			position += spacer
+		contig_map.add(name,position,position+len(sequence)-1)
+		parts.append(sequence.replace("-","N"))
+		position += len(sequence)
+	sequence = "".join(parts)
+	with open(output, "w") as f:
+		print(">{name}".format(name=os.path.basename(query).rsplit(".",1)[0]),file=f)
+		for i in range(0,len(sequence),LINE_LENGTH):
+			print(sequence[i:i+LINE_LENGTH],file=f)
+	logger.info("{n} contigs of {query} joined ({dropped} shorter than {min_length} left out, {length} bases)".format(
+					n=len(kept),query=os.path.basename(query),dropped=len(contigs)-len(kept),min_length=min_length,length=len(sequence)))
+	return contig_map
@@ -1,5 +1,8 @@
 import sys, os
 import sqlite3
+import time
+import threading
+from urllib.parse import quote
 
 '''
 DatabaseConnections and CanSNPdbFunctions are classes written to simplify database work using sqlite3
@@ -20,6 +23,98 @@ __partof__ = "CanSNPer2"
 import logging
 logger = logging.getLogger(__name__)
 
+from CanSNPer2.modules.CompiledDatabase import get_compiled
+
+'''Secondary indexes of a CanSNPer2 database, created with the database and added to existing databases by CanSNPer2-database --optimize
+	snp_annotation is covered for the get_snps query (all selected columns are in the index), tree lookups on parent
+	are already covered by the unique(parent,child) index of the tree table
+'''
+CANSNP_INDEXES = [
+	"CREATE INDEX IF NOT EXISTS snp_annotation_genome_position ON snp_annotation (genome_i, position, derived_base, ancestral_base, snp_id)",
+	"CREATE INDEX IF NOT EXISTS snp_references_genome ON snp_references (genome)",
+	"CREATE INDEX IF NOT EXISTS tree_child ON tree (child)",
+]
+
+'''Options of read only connections (the typing path), set from the command line with set_read_only_options
+	immutable 	the database is not modified while it is open (no locks or journal checks, only safe for downloaded databases)
+	mmap_size 	bytes of the database file read through mmap (shared by all processes through the page cache)
+	cache_size 	page cache of each connection (KiB)
+'''
+read_only_options = {
+	"immutable": False,
+	"mmap_size": 256*1024*1024,
+	"cache_size": 16*1024
+}
+
+'''Connections are pooled per process, thread, database and mode so that all objects using the same database share
+	one connection (and its statement cache), a forked process or a new thread always opens its own connection
+'''
+_pool = {}
+connection_options = {
+	"cached_statements": 256		## Compiled statements kept by each connection (sqlite3 default is 128)
+}
+## Number of statements executed and the time spent in them (this process), see get_statistics
+statistics = {
+	"statements": 0,
+	"seconds": 0.0
+}
+## SQL of insert/update/delete/select statements, reused by all calls with the same table and columns
+_statements = {}
+
+def set_cached_statements(n):
+	'''Set the number of compiled statements cached by new connections'''
+	connection_options["cached_statements"] = n
+
+def get_statistics():
+	'''Return the number of statements executed and the seconds spent executing them'''
+	return dict(statistics)
+
+def close_connections():
+	'''Close all pooled connections of this process and thread'''
+	key = (os.getpid(),threading.get_ident())
+	for pool_key in [pool_key for pool_key in _pool if pool_key[:2] == key]:
+		_pool.pop(pool_key)[0].close()
+
+def set_read_only_options(immutable=False,mmap_size=256,cache_size=16):
+	'''Set the options of read only connections, sizes are given in MB'''
+	read_only_options["immutable"] = immutable
+	read_only_options["mmap_size"] = int(mmap_size*1024*1024)
+	read_only_options["cache_size"] = int(cache_size*1024)
+
+def apply_tree_update(conn,delete_links=[],delete_nodes=[],add_links=[],commit=True):
+	'''Apply a tree modification with a constant number of set based statements in one transaction
+		The links (parent,child[,rank]) and nodes are staged in temporary tables, links and nodes are
+		deleted before new links are added (existing links are ignored).
+		Returns: the links added (parent,child,rank) and the set of nodes in the added links
+	'''
+	norm = lambda links: [(link[0],link[1],link[2] if len(link) > 2 else None) for link in links]
+	cursor = conn.cursor()
+	try:
+		cursor.execute("CREATE TEMP TABLE IF NOT EXISTS stage_delete_links (parent INTEGER, child INTEGER, rank_i INTEGER)")
+		cursor.execute("CREATE TEMP TABLE IF NOT EXISTS stage_delete_nodes (id INTEGER)")
+		cursor.execute("CREATE TEMP TABLE IF NOT EXISTS stage_add_links (parent INTEGER, child INTEGER, rank_i INTEGER)")
+		for table in ["stage_delete_links","stage_delete_nodes","stage_add_links"]:
+			cursor.execute("DELETE FROM temp.{table}".format(table=table))
+		cursor.executemany("INSERT INTO temp.stage_delete_links VALUES (?,?,?)",norm(delete_links))
+		cursor.executemany("INSERT INTO temp.stage_delete_nodes VALUES (?)",[(node,) for node in delete_nodes])
+		cursor.executemany("INSERT INTO temp.stage_add_links VALUES (?,?,?)",norm(add_links))
+		cursor.execute("DELETE FROM tree WHERE (parent,child) IN (SELECT parent,child FROM temp.stage_delete_links)")
+		cursor.execute("DELETE FROM nodes WHERE id IN (SELECT id FROM temp.stage_delete_nodes)")
+		added = cursor.execute('''SELECT DISTINCT parent,child,rank_i FROM temp.stage_add_links AS new
+									WHERE NOT EXISTS (SELECT 1 FROM tree WHERE tree.parent = new.parent AND tree.child = new.child)''').fetchall()
+		cursor.execute("INSERT OR IGNORE INTO tree(parent,child,rank_i) SELECT parent,child,rank_i FROM temp.stage_add_links")
+		if commit:
+			conn.commit()
+	except Exception:
+		conn.rollback()
+		raise
+	nodes = set()
+	for parent,child,rank in added:
+		nodes.add(parent)
+		nodes.add(child)
+	logger.debug("Tree update: {dl} links and {dn} nodes deleted, {al} links added".format(dl=len(delete_links),dn=len(delete_nodes),al=len(added)))
+	return added,nodes
+
 class ConnectionError(Exception):
 	def __init__(self, value):
 		self.value = value
@@ -28,15 +123,36 @@ class ConnectionError(Exception):
 
 class DatabaseConnection(object):
 	"""docstring for DatabaseConnection"""
-	def __init__(self, database, verbose=False):
+	def __init__(self, database, verbose=False, readonly=False):
 		super().__init__()
 		self.verbose = verbose
 		self.database = database
+		self.readonly = readonly		## Open the database read only (see read_only_options)
 		logging.debug("DatabaseConnection variables database: {database}, verbose: {verbose}".format(database=database,verbose=verbose))
-		self.conn = self.connect(self.database)
-		self.cursor = self.create_cursor(self.conn)
+		self.conn 						## Connect (or reuse the pooled connection)
 		logging.debug("Database connected!")
 
+	def _pool_key(self):
+		return (os.getpid(),threading.get_ident(),os.path.abspath(self.database),self.readonly)
+
+	def _pooled(self):
+		'''Return the pooled connection and cursor of this process and thread, connect if there is none'''
+		key = self._pool_key()
+		try:
+			return _pool[key]
+		except KeyError:
+			conn = self.connect(self.database)
+			_pool[key] = (conn,self.create_cursor(conn))
+			return _pool[key]
+
+	@property
+	def conn(self):
+		return self._pooled()[0]
+
+	@property
+	def cursor(self):
+		return self._pooled()[1]
+
 	def __str__(self):
 		return "Object of class DatabaseConnection, connected to {database}".format(database=self.database)
 
@@ -49,15 +165,36 @@ class DatabaseConnection(object):
 	def connect(self,database):
 		'''Create database connection'''
 		try:
-			conn = sqlite3.connect(database)
+			if self.readonly:
+				conn = self.connect_read_only(database)
+			else:
+				conn = sqlite3.connect(database, cached_statements=connection_options["cached_statements"])
 			logging.info("{database} opened successfully... ".format(database=database))
 			return conn
 		except Exception as e:
 			sys.stderr.write(str(e))
 		raise ConnectionError("Count not connect to the database {database} see above message for details!".format(database=database))
 
+	def connect_read_only(self,database):
+		'''Open the database through a read only uri (mode=ro and optionally immutable=1) with mmap and cache size set,
+			read only connections never take write locks so any number of processes can share the database
+		'''
+		if not os.path.exists(database):
+			raise ConnectionError("The database {database} does not exist!".format(database=database))
+		uri = "file:{path}?mode=ro".format(path=quote(os.path.abspath(database)))
+		if read_only_options["immutable"]:
+			uri += "&immutable=1"
+		conn = sqlite3.connect(uri, uri=True, cached_statements=connection_options["cached_statements"])
+		conn.execute("PRAGMA mmap_size={size}".format(size=read_only_options["mmap_size"]))
+		conn.execute("PRAGMA cache_size=-{size}".format(size=read_only_options["cache_size"]))
+		logging.debug("Read only connection {uri} mmap_size: {mmap_size} cache_size: {cache_size}KiB".format(uri=uri,**read_only_options))
+		return conn
+
 	def disconnect(self):
-		self.conn.close()
+		'''Close the connection (it is removed from the pool, other objects using it will reconnect)'''
+		conn,cursor = _pool.pop(self._pool_key(),(False,False))
+		if conn:
+			conn.close()
 
 	def create_cursor(self,conn):
 		'''Create a db cursor'''
@@ -77,6 +214,7 @@ class DatabaseConnection(object):
 		res = False
 		if not cursor:
 			cursor = self.cursor
+		start = time.perf_counter()
 		try:
 			if insert_val:
 				res = cursor.execute(query,insert_val)
@@ -94,43 +232,65 @@ class DatabaseConnection(object):
 				logging.debug(str(e))
 				raise
 			return(e)
+		finally:
+			statistics["statements"] += 1
+			statistics["seconds"] += time.perf_counter()-start
 
 	def insert(self,data,table):
 		'''Insert function
 				data is a dictionary with keys matching
 				table columns with respective value to be inserted
 		'''
-		INSERT_QUERY = '''
-			INSERT INTO {table}({columns})
-			VALUES ({values})
-		'''
-
-		columns = data.keys()
+		columns = tuple(data.keys())
 		values = tuple([data[col] for col in columns])
-		insertStr = INSERT_QUERY.format(
-				columns=",".join(columns),
-				values=','.join(["?" for x in values]),
-				table=table
-		)
-		return self.query(insertStr,insert_val=values)
+		return self.query(self.statement("insert",table,columns),insert_val=values)
+
+	def statement(self,kind,table,columns=(),where=()):
+		'''Return the parameterized SQL of a statement, the SQL is created once for each table and set of columns
+			so that the connection statement cache is reused
+		'''
+		key = (kind,table,columns,where)
+		try:
+			return _statements[key]
+		except KeyError:
+			pass
+		WHERE = " AND ".join("{column} = ?".format(column=column) for column in where)
+		if kind == "insert":
+			SQL = "INSERT INTO {table}({columns}) VALUES ({values})".format(table=table,columns=",".join(columns),values=",".join(["?"]*len(columns)))
+		elif kind == "update":
+			SQL = "UPDATE {table} SET {columns} WHERE {where}".format(table=table,columns=", ".join("{column} = ?".format(column=column) for column in columns),where=WHERE)
+		elif kind == "delete":
+			SQL = "DELETE FROM {table} WHERE {where}".format(table=table,where=WHERE)
+		elif kind == "select":
+			SQL = "SELECT {columns} FROM {table}".format(table=table,columns=",".join(columns) or "*")
+			if where:
+				SQL += " WHERE {where}".format(where=WHERE)
+		else:
+			raise ValueError("Unknown statement {kind}".format(kind=kind))
+		_statements[key] = SQL
+		return SQL
 
 	def update(self,data,table):
 		'''Update function requires table column which column to identify row with and value to replace'''
-		columns = []
-		colkeys = list(data["set_column"].keys())
-		for col in colkeys:
-			if col != "snp_id":
-				columns.append("{set_column}='{val}'".format(set_column=col, val=data["set_column"][col]))
-		set_query = ", ".join(columns)
-		UPDATE_QUERY = '''
-			UPDATE {table}
-			SET {columns}
-			WHERE {where_column} = ?
-		'''.format(table=table,columns=set_query,where_column=data["where_column"])
+		columns = tuple(col for col in data["set_column"] if col != "snp_id")
+		values = tuple(data["set_column"][col] for col in columns) + (data["set_value"],)
 		###  UPDATE genomes SET id = newnode WHERE genome = oldname
-		logging.debug(UPDATE_QUERY,data)
-		datasend = tuple([data["set_value"]])
-		return self.query(UPDATE_QUERY,datasend,getres=True)
+		UPDATE_QUERY = self.statement("update",table,columns,(data["where_column"],))
+		logging.debug(UPDATE_QUERY)
+		return self.query(UPDATE_QUERY,values,getres=True)
+
+	def delete(self,where,table):
+		'''Delete rows matching all columns in the where dictionary'''
+		columns = tuple(where.keys())
+		return self.query(self.statement("delete",table,where=columns),tuple(where[col] for col in columns),getres=True)
+
+	def select(self,table,columns=(),where={}):
+		'''Select columns from table of rows matching all columns in the where dictionary, returns all rows'''
+		where_columns = tuple(where.keys())
+		SELECT_QUERY = self.statement("select",table,tuple(columns),where_columns)
+		if where_columns:
+			return self.query(SELECT_QUERY,tuple(where[col] for col in where_columns),getres=True).fetchall()
+		return self.query(SELECT_QUERY).fetchall()
 
 class LoadCanSNPAnnotation(DatabaseConnection):
 	def __init__(self, database, verbose=False):
@@ -182,8 +342,8 @@ class LoadCanSNPAnnotation(DatabaseConnection):
 class CanSNPdbFunctions(DatabaseConnection):
 	"""CanSNPerdb database function class contains multiple additional database
 		functions to simplify data access related to the website, its a subclass of DatabaseConnection"""
-	def __init__(self, database,  verbose=False):
-		super().__init__(database,verbose)
+	def __init__(self, database,  verbose=False, readonly=False):
+		super().__init__(database,verbose,readonly)
 		logging.info("Load CanSNPdbFunctions")
 		### store DatabaseConnection object reference
 
@@ -196,8 +356,7 @@ class CanSNPdbFunctions(DatabaseConnection):
 	def set_database(self, database):
 		'''Change the database object default in class'''
 		self.database = database
-		self.conn = self.connect(self.database)
-		self.cursor = self.create_cursor(self.conn)
+		self.conn 						## Connect (or reuse the pooled connection)
 
 	'''
 		Get functions of class
@@ -287,17 +446,9 @@ class CanSNPdbFunctions(DatabaseConnection):
 		return rank_id
 
 	def add_links(self,links, table="tree",hold=False):
-		'''Add links from a list to tree'''
-		added_links = 0
-		for parent,child in links:
-			res = self.add_link(parent,child,table=table)
-			### Check if the link already exist in the database, this overlap may occur when a large new branch is added
-			if "UNIQUE constraint failed" not in str(res):
-				added_links +=1
-		## Commit changes
-		if not hold:
-			self.commit()
-		return added_links
+		'''Add links (parent,child) from a list to tree, links that already exist are ignored'''
+		added_links,nodes = apply_tree_update(self.conn,add_links=links,commit=not hold)
+		return len(added_links)
 
 	def add_nodes(self,nodes, table="Tree",hold=False):
 		'''Add nodes from a list of nodes'''
@@ -317,33 +468,69 @@ class CanSNPdbFunctions(DatabaseConnection):
 	'''
 	def delete_links(self,links, table="Tree",hold=False):
 		'''This function deletes all links given in links'''
-		QUERY = "DELETE FROM {table} WHERE parent = {parent} AND child = {child}"
-		for parent,child in links:
-			res = self.query(QUERY.format(table=table, parent=parent, child=child))
-		## Commit changes
-		if not hold:
-			self.commit()
+		apply_tree_update(self.conn,delete_links=links,commit=not hold)
 
 	def delete_nodes(self, nodes, table="nodes",hold=False):
 		'''This function deletes all nodes given in nodes'''
-		QUERY = "DELETE FROM {table} WHERE node_i = {node}"
-		for node in nodes:
-			res = self.query(QUERY.format(table=table, node=node))
-		## Commit changes
-		if not hold:
-			self.commit()
+		apply_tree_update(self.conn,delete_nodes=nodes,commit=not hold)
 
 	def num_rows(self,table):
 		'''Return the number of rows in a table'''
 		QUERY = '''SELECT Count(*) FROM {table}'''
 		return self.query(QUERY.format(table=table)).fetchall()[0][0]
 
+	'''
+		Optimize functions
+	'''
+	def time_queries(self,repeats=5):
+		'''Return the time (best of repeats) of the queries used when running CanSNPer2'''
+		timings = {}
+		genomes = [row[0] for row in self.query("SELECT genome FROM snp_references").fetchall()]
+		nodes = [row[0] for row in self.query("SELECT child FROM tree LIMIT 100").fetchall()]
+		QUERIES = {
+			"get_snps": ("""SELECT genome, position, derived_base, ancestral_base, snp_id
+								FROM snp_annotation
+								LEFT JOIN snp_references on (snp_references.id = snp_annotation.genome_i)
+								WHERE genome = ?""", genomes),
+			"get_parent": ("SELECT parent,child,rank_i FROM tree WHERE child = ?", nodes),
+			"get_child": ("SELECT parent,child,rank_i FROM tree WHERE parent = ?", nodes)
+		}
+		for name,(QUERY,values) in QUERIES.items():
+			best = False
+			for i in range(repeats):
+				start = time.perf_counter()
+				for value in values:
+					self.query(QUERY,(value,),getres=True).fetchall()
+				seconds = time.perf_counter()-start
+				if not best or seconds < best:
+					best = seconds
+			timings[name] = best
+		return timings
+
+	def create_indexes(self):
+		'''Add the CanSNPer2 indexes (if missing) and update the query planner statistics'''
+		for INDEX in CANSNP_INDEXES:
+			logger.debug(INDEX)
+			self.query(INDEX)
+		self.query("ANALYZE")
+		self.commit()
+
+	def optimize(self):
+		'''Add indexes to an existing database, returns the query timings before and after'''
+		before = self.time_queries()
+		self.create_indexes()
+		after = self.time_queries()
+		for name in before:
+			logger.info("{query}: {before:.2f} ms -> {after:.2f} ms".format(query=name,before=before[name]*1000,after=after[name]*1000))
+		return before,after
+
 class XMFAFunctions(DatabaseConnection):
 	"""CanSNPerdb database function class contains multiple additional database
 		functions to simplify data access related to the website, its a subclass of DatabaseConnection"""
-	def __init__(self, database, verbose=False):
+	def __init__(self, database, verbose=False, cache=True, readonly=True):
 		import time
-		super().__init__(database,verbose)
+		super().__init__(database,verbose,readonly)
+		self.cache = cache		## Read SNPs from the compiled database ({database}.cache) if possible
 		logging.info("Load XMFAFunctions")
 		### store DatabaseConnection object reference
 
@@ -369,6 +556,11 @@ class XMFAFunctions(DatabaseConnection):
 		returns: results as a dictionary with tuple SNP for each position {pos: (pos, refBase, TargetBase, SNPid)}
 				 and a list of positions sorted ASC
 		'''
+		if self.cache:
+			compiled = get_compiled(self.database)
+			snps = compiled and compiled.get_snps(reference)
+			if snps:
+				return snps
 		snp_string = """SELECT genome, position, derived_base, ancestral_base, snp_id
 										FROM snp_annotation
 										LEFT JOIN snp_references on (snp_references.id = snp_annotation.genome_i)
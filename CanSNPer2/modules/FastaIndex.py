@@ -0,0 +1,204 @@
+'''
+FastaIndex creates and reads FASTA indexes (.fai, the samtools faidx format)
+
+	name 		contig name (first word of the header)
+	length 		number of bases
+	offset 		byte offset of the first base
+	linebases 	bases per line
+	linewidth 	bytes per line (including the newline)
+
+The index can be built from a stream of data (FastaIndexer.update) so that a reference
+is indexed while it is written. FastaFile fetches regions of an indexed fasta file through mmap
+(the file is never read as a whole), indexes are built once and reused while the fasta is unchanged.
+'''
+
+import os
+import mmap
+import hashlib
+import logging
+logger = logging.getLogger(__name__)
+
+def index_path(fasta):
+	'''Return the path of the index of a fasta file'''
+	return "{fasta}.fai".format(fasta=fasta)
+
+def read_index(path):
+	'''Read a fasta index, returns a list of (name, length, offset, linebases, linewidth)'''
+	records = []
+	with open(path) as f:
+		for row in f:
+			name,length,offset,linebases,linewidth = row.rstrip("\n").split("\t")[:5]
+			records.append((name,int(length),int(offset),int(linebases),int(linewidth)))
+	return records
+
+def write_index(records,path):
+	'''Write a fasta index (atomically)'''
+	tmp = path+".tmp"
+	with open(tmp, "w") as f:
+		for record in records:
+			print("\t".join(map(str,record)),file=f)
+	os.replace(tmp, path)
+	return path
+
+def index_fasta(fasta,path=False,blocksize=1<<20):
+	'''Index a fasta file and write the index next to it (or to path)'''
+	indexer = FastaIndexer()
+	with open(fasta, "rb") as f:
+		if f.read(2) == b"\x1f\x8b":
+			raise ValueError("{fasta} is compressed, only uncompressed fasta files can be indexed".format(fasta=fasta))
+		f.seek(0)
+		for block in iter(lambda: f.read(blocksize), b""):
+			indexer.update(block)
+	if not path:
+		path = index_path(fasta)
+	return indexer.write(path)
+
+def is_current(index,fasta):
+	'''Check if an index exists and is not older than the fasta file'''
+	return os.path.exists(index) and os.path.getmtime(index) >= os.path.getmtime(fasta)
+
+def get_index(fasta,cachedir=False):
+	'''Return the index of a fasta file, the index is built if it is missing or older than the fasta file
+		indexes of files in folders that are not writable are kept in cachedir
+	'''
+	path = index_path(fasta)
+	if is_current(path,fasta):
+		return read_index(path)
+	if cachedir and not os.access(os.path.dirname(os.path.abspath(fasta)), os.W_OK):
+		os.makedirs(cachedir,exist_ok=True)
+		key = hashlib.sha1(os.path.abspath(fasta).encode("utf-8")).hexdigest()[:16]
+		path = os.path.join(cachedir,"{key}_{name}".format(key=key,name=os.path.basename(index_path(fasta))))
+		if is_current(path,fasta):
+			return read_index(path)
+	logger.debug("Indexing {fasta}".format(fasta=fasta))
+	return read_index(index_fasta(fasta,path))
+
+class FastaIndexer(object):
+	"""FastaIndexer builds the index of a fasta file from the data written to it (in any block size)"""
+	def __init__(self):
+		super(FastaIndexer, self).__init__()
+		self.offset = 0
+		self.remainder = b""
+		self.records = []
+		self.current = False
+
+	def __repr__(self):
+		return "FastaIndexer()"
+
+	def update(self,data):
+		'''Index the next block of data'''
+		lines = (self.remainder+data).split(b"\n")
+		self.remainder = lines.pop()
+		for line in lines:
+			self._line(line,len(line)+1)
+
+	def _line(self,line,width):
+		if line.startswith(b">"):
+			self.current = [line[1:].split()[0].decode("utf-8") if line[1:].split() else "",0,self.offset+width,0,0]
+			self.records.append(self.current)
+		elif self.current:
+			bases = len(line.rstrip(b"\r"))
+			if self.current[3] == 0:
+				self.current[3] = bases
+				self.current[4] = width
+			self.current[1] += bases
+		self.offset += width
+
+	def close(self):
+		'''Index the last line (if the file does not end with a newline), returns the records'''
+		if self.remainder:
+			self._line(self.remainder,len(self.remainder))
+			self.remainder = b""
+		return [tuple(record) for record in self.records]
+
+	def write(self,path):
+		'''Write the index'''
+		return write_index(self.close(),path)
+
+class FastaFile(object):
+	"""FastaFile gives random access to the sequences of an indexed fasta file
+		regions are given as samtools faidx (1-based positions, start and end included)
+	"""
+	def __init__(self, fasta, cachedir=False):
+		super(FastaFile, self).__init__()
+		self.fasta = fasta
+		self.records = {}
+		self.names = []
+		for name,length,offset,linebases,linewidth in get_index(fasta,cachedir):
+			self.records[name] = (length,offset,linebases,linewidth)
+			self.names.append(name)
+		self._file = False
+		self._data = False
+
+	def __repr__(self):
+		return "FastaFile({fasta})".format(fasta=self.fasta)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self,*args):
+		self.close()
+
+	@property
+	def data(self):
+		'''The fasta file mapped to memory (opened on first use)'''
+		if self._data is False:
+			self._file = open(self.fasta, "rb")
+			if os.fstat(self._file.fileno()).st_size == 0:
+				self._data = b""
+			else:
+				self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+		return self._data
+
+	def close(self):
+		if self._data:
+			self._data.close()
+		if self._file:
+			self._file.close()
+		self._file,self._data = False,False
+
+	def length(self,name):
+		return self.records[name][0]
+
+	def _offset(self,record,position):
+		'''Byte offset of a (0-based) position'''
+		length,offset,linebases,linewidth = record
+		return offset + position // linebases * linewidth + position % linebases
+
+	def _span(self,name,start,end):
+		'''Return the byte offsets of a region, False if the region is empty'''
+		try:
+			record = self.records[name]
+		except KeyError:
+			raise KeyError("{name} is not a sequence in {fasta}".format(name=name,fasta=self.fasta))
+		start = max(start,1)
+		end = record[0] if end is None else min(end,record[0])
+		if end < start:
+			return False
+		return self._offset(record,start-1),self._offset(record,end-1)+1
+
+	def fetch(self,name,start=1,end=None):
+		'''Return the sequence of a region (positions outside the sequence are ignored)'''
+		span = self._span(name,start,end)
+		if not span:
+			return ""
+		return self.data[span[0]:span[1]].replace(b"\n",b"").replace(b"\r",b"").decode("ascii")
+
+	def fetch_many(self,regions):
+		'''Return the sequences of a list of regions (name, start, end) in the same order
+			regions are read in file order so that the pages of the file are visited once
+		'''
+		spans = [self._span(*region) for region in regions]
+		sequences = [""]*len(regions)
+		data = self.data
+		for i in sorted(range(len(spans)), key=lambda i: spans[i] or (0,0)):
+			if spans[i]:
+				sequences[i] = data[spans[i][0]:spans[i][1]].replace(b"\n",b"").replace(b"\r",b"").decode("ascii")
+		return sequences
+
+	def get_base(self,name,position):
+		'''Return the (upper case) base at a position, False if the position is outside the sequence'''
+		record = self.records[name]
+		if not 0 < position <= record[0]:
+			return False
+		return chr(self.data[self._offset(record,position-1)]).upper()
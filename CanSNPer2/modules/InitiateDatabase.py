@@ -2,6 +2,11 @@ import sys, os, inspect
 import sqlite3
 
 #from CanSNPer2.modules.DatabaseConnection import DatabaseConnection
+from CanSNPer2.modules.DatabaseConnection import CANSNP_INDEXES
+from CanSNPer2.modules.BulkLoad import load_annotations,load_references,get_genome_ids
+from CanSNPer2.modules.Journal import SQL_CREATE_CHANGES,record_change
+from CanSNPer2.modules.ReadTaxonomy import ReadTaxonomy
+from CanSNPer2.modules.ReadCanSNP_tables import ReadCanSNPer
 
 
 import logging
@@ -12,6 +17,9 @@ from importlib import import_module
 from datetime import date
 #script_path = os.path.dirname(os.path.abspath(__file__))  ## Retrieve the abspath of the location of this script
 
+'''Tree formats read in memory and written in one transaction by CanSNPer2, other source types are read by flextaxd'''
+read_modules = {"CanSNPer": ReadCanSNPer, "tab": ReadTaxonomy}
+
 def dynamic_import(abs_module_path, class_name):
 	module = import_module(".".join([abs_module_path,class_name]))
 	target_class = getattr(module, class_name)
@@ -59,6 +67,12 @@ class CreateSNPDatabase(CreateDatabase):
 		self.add_table(sql_create_SNP_table)
 		logger.info("Add SNP reference table")
 		self.add_table(sql_create_snp_references_table)
+		logger.info("Add SNP indexes")
+		for sql_create_index in CANSNP_INDEXES:
+			self.add_table(sql_create_index)
+		logger.info("Add change journal")
+		for sql_create_journal in SQL_CREATE_CHANGES:
+			self.add_table(sql_create_journal)
 		return
 
 class CanSNPDatabase(DatabaseFunctions):
@@ -66,6 +80,7 @@ class CanSNPDatabase(DatabaseFunctions):
 	def __init__(self,*args,**kwargs):
 		super().__init__(kwargs["database"],verbose=kwargs["verbose"])
 		logger.debug(kwargs)
+		self.genomes = {}
 		'''Connect to database'''
 		if kwargs["create"]:
 			logger.debug("Create: {create}".format(create=kwargs["create"]))
@@ -75,7 +90,12 @@ class CanSNPDatabase(DatabaseFunctions):
 		#CanSNPdatabase_obj.create_cansnptable(kwargs["create"])
 		source_type = kwargs["source_type"]
 		self.today = date.today()
-		if kwargs["tree"]:
+		if kwargs["tree"] and source_type in read_modules:
+			logger.debug("Loading module {module}".format(module=read_modules[source_type].__name__))
+			read_obj = read_modules[source_type](database=kwargs["database"],verbose=kwargs["verbose"])
+			logger.info("Parse taxonomy")
+			read_obj.parse_taxonomy(kwargs["tree"])												## Parse taxonomy file (one transaction)
+		elif kwargs["tree"]:
 			logger.debug("Loading module ReadTaxonomy{type}".format(type=source_type))
 			read_module = dynamic_import("flextaxd.modules", "ReadTaxonomy{type}".format(type=source_type))
 			read_obj = read_module(kwargs["tree"], database=kwargs["database"],root_name=False,rank="family",verbose=kwargs["verbose"])
@@ -88,6 +108,7 @@ class CanSNPDatabase(DatabaseFunctions):
 		if kwargs["annotation"]:
 			logger.info("Load annotation file!")
 			self.load_cansnp_annotation(kwargs["annotation"])
+		record_change(self.conn,"create")		## Everything loaded is new to samples typed with an earlier version
 
 	def add_annotation(self, data, id=False,genome_i=False):
 		'''Add snp annotation to annotation table'''
@@ -125,60 +146,18 @@ class CanSNPDatabase(DatabaseFunctions):
 		return self.insert(info, table="snp_references")
 
 	def load_genome_annotation_file(self,annotation_file):
-		self.genomes = {}
-		with open(annotation_file) as f:
-			headers = f.readline().lstrip("#").strip().split("\t")
-			#dataArr = []
-			logging.debug(headers)
-			for row in f:
-				data = row.strip().split("\t")
-				ddict = {}
-				for i in range(len(headers)):
-					head,val = headers[i],data[i]
-					ddict[head] = val
-				genome_i = self.add_genome(ddict)
-				self.genomes[ddict["genome"]] = genome_i
-				self.genomes[ddict["genbank_id"]] = genome_i
-				self.genomes[ddict["refseq_id"]] = genome_i
-		self.conn.commit()
+		'''Load all reference genomes in one transaction'''
+		self.genomes = load_references(self.conn,annotation_file)
 		return self.genomes
 
 	def load_annotation_file(self,annotation_file):
-		'''Read the annotation source file'''
+		'''Read the annotation source file, validate all rows and load them in one transaction'''
 		nodes = self.get_nodes()
-		logger.info(nodes)
 		logger.debug("nodes: {nnodes}".format(nnodes=len(nodes)/2))
 		if len(self.genomes) == 0:
-			self.genomes = self.get_genomes(table="snp_references")
+			self.genomes = get_genome_ids(self.conn)
 		logger.debug(self.genomes)
-		with open(annotation_file) as af:
-			headers = af.readline().lstrip("#").strip().split("\t")
-			logging.debug(headers)
-			dataArr = []
-			for row in af:
-				data = row.strip().split("\t")
-				ddict = {}
-				for i in range(len(headers)):
-					head,val = headers[i],data[i]
-					ddict[head] = val
-				dataArr.append(ddict)
-				try:
-					_id = nodes[ddict["snp_id"]]
-				except KeyError:
-					logging.warning("WARNING: {id} was not found in the tree, check your source files!".format(id=ddict["snp_id"]))
-					_id = False
-				try:
-					genome_i = self.genomes[ddict["genome"]]
-				except KeyError:
-					logger.warning("No genome annotation could be found add a genome annotation file to command!")
-					logger.debug(ddict)
-					_id = False
-				if _id:
-					logger.debug("Add annotation: {dic}, {_id}, {gid}".format(dic=ddict,_id=_id,gid=genome_i))
-					self.add_annotation(ddict, id=_id, genome_i=genome_i)
-		### commit changes to database
-		self.conn.commit()
-		return dataArr
+		return load_annotations(self.conn,annotation_file,nodes,self.genomes)
 
 	def load_cansnp_annotation(self,annotation_file):
 		'''Function that loads data into the cansnp annotation table'''
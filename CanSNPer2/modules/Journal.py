@@ -0,0 +1,87 @@
+'''
+Journal keeps track of the changes made to a CanSNPer2 database
+
+Every modification made through CanSNPer2-database is given a new version (increasing by one) and
+the references and nodes it affected are stored in the snp_changes table. CanSNPer2 uses the journal
+to update compiled caches and previous results of samples (--incremental) for the changed parts only.
+
+	action 		reference 		node_id
+	create 		NULL 			NULL 			everything has changed
+	tree 		NULL 			node 			the tree changed, SNP calls have to be redone
+	annotation 	genome 			node 			SNPs of a reference were added or changed
+	reference 	genome 			NULL 			a reference genome was added
+'''
+
+import sqlite3
+from datetime import datetime
+import logging
+logger = logging.getLogger(__name__)
+
+SQL_CREATE_CHANGES = [
+	'''CREATE TABLE IF NOT EXISTS snp_changes (
+			id INTEGER PRIMARY KEY,
+			version INTEGER NOT NULL,
+			date DATETIME,
+			action VARCHAR(20),
+			reference VARCHAR(20),
+			node_id INTEGER
+		);''',
+	"CREATE INDEX IF NOT EXISTS snp_changes_version ON snp_changes (version)"
+]
+
+def create_journal(conn):
+	'''Add the journal table to a database (databases created before the journal have version 0)'''
+	for sql in SQL_CREATE_CHANGES:
+		conn.execute(sql)
+
+def get_version(conn):
+	'''Return the current version of the database, 0 if the database has no journal'''
+	try:
+		version = conn.execute("SELECT MAX(version) FROM snp_changes").fetchone()[0]
+	except sqlite3.OperationalError:	## no such table
+		return 0
+	return version or 0
+
+def genome_names(conn,ids):
+	'''Return the genome names of reference ids'''
+	names = dict(conn.execute("SELECT id,genome FROM snp_references").fetchall())
+	return set(names[id] for id in ids if id in names)
+
+def record_change(conn,action,references=[],nodes=[],commit=True):
+	'''Store a change to the database, returns the new version
+		a change without references and nodes affects the whole database
+	'''
+	create_journal(conn)
+	version = get_version(conn)+1
+	date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+	rows = [(version,date,action,reference,None) for reference in sorted(set(references))]
+	rows += [(version,date,action,None,node) for node in sorted(set(nodes))]
+	if len(rows) == 0:
+		rows = [(version,date,action,None,None)]
+	conn.executemany("INSERT INTO snp_changes(version,date,action,reference,node_id) VALUES (?,?,?,?,?)",rows)
+	if commit:
+		conn.commit()
+	logger.info("Database version {version} ({action}: {n} references, {n2} nodes)".format(version=version,action=action,n=len(set(references)),n2=len(set(nodes))))
+	return version
+
+def get_changes(conn,since):
+	'''Return the changes made after version since
+		{"version": current version, "all": True if everything changed, "tree": True if the tree changed,
+			"references": changed references, "nodes": changed nodes}
+	'''
+	changes = {"version": get_version(conn), "all": False, "tree": False, "references": set(), "nodes": set()}
+	if changes["version"] <= since:
+		return changes
+	if since == 0:	## no journal when the previous version was made
+		changes["all"] = True
+		return changes
+	for action,reference,node in conn.execute("SELECT action,reference,node_id FROM snp_changes WHERE version > ?",(since,)):
+		if reference is None and node is None:
+			changes["all"] = True
+		if action == "tree":
+			changes["tree"] = True
+		if reference is not None:
+			changes["references"].add(reference)
+		if node is not None:
+			changes["nodes"].add(node)
+	return changes
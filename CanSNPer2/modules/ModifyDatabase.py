@@ -4,6 +4,9 @@
 
 from flextaxd.modules.ModifyTree import ModifyTree
 from flextaxd.modules.database.DatabaseConnection import DatabaseFunctions
+from CanSNPer2.modules.BulkLoad import load_annotations,load_references,get_genome_ids
+from CanSNPer2.modules.DatabaseConnection import apply_tree_update
+from CanSNPer2.modules.Journal import record_change,genome_names
 from datetime import date
 import logging
 logger = logging.getLogger(__name__)
@@ -12,16 +15,24 @@ class ModifyCanSNPer2Database(ModifyTree):
 	"""ModifyCanSNPer2Database adds a few important functions only nessesary when modifying a database"""
 	def __init__(self, database, mod_database=False, mod_file=False, separator="\t",verbose=False,parent=False,replace=False,snp_annotation=False,**kwargs):
 		logger.info("Load ModifyFunctions")
+		self.added_nodes = set()		## Nodes inserted while the modification is parsed (links may also join existing nodes)
 		super().__init__(database, mod_database, mod_file, separator,verbose,parent,replace)
 		self.genomes = {}
 		self.today = date.today()
 
+	def add_node(self, description):
+		'''Add node to tree and keep its id'''
+		taxid = super().add_node(description)
+		if isinstance(taxid,int):		## a failed insert returns False or the error
+			self.added_nodes.add(taxid)
+		return taxid
+
 	def get_nodes(self, database=False,col=False):
 		'''Retrieve the whole node info table of the database to decrease the number of database calls!'''
 		return self.taxonomydb.get_nodes()
 
 	def get_genomes(self, table):
-		return self.taxonomydb.get_genomes(table="snp_references")
+		return get_genome_ids(self.taxonomydb.conn,table=table)
 
 	def add_annotation(self, data, id=False,genome_i=False):
 		'''Add snp annotation to annotation table'''
@@ -45,7 +56,6 @@ class ModifyCanSNPer2Database(ModifyTree):
 			info["node_id"] = id
 		logger.debug(info)
 		taxid_base = self.taxonomydb.insert(info, table="snp_annotation")
-		self.taxonomydb.commit()
 		return taxid_base
 
 	def add_genome(self,data):
@@ -63,73 +73,42 @@ class ModifyCanSNPer2Database(ModifyTree):
 		return self.insert(info, table="snp_references")
 
 	def load_annotation_file(self,annotation_file):
-		'''Read the annotation source file'''
+		'''Read the annotation source file, validate all rows and load them in one transaction'''
 		nodes = self.get_nodes()
 		if len(self.genomes) == 0:
 			self.genomes = self.get_genomes(table="snp_references")
-		with open(annotation_file) as af:
-			headers = af.readline().lstrip("#").strip().split("\t")
-			logging.debug(headers)
-			dataArr = []
-			for row in af:
-				data = row.strip().split("\t")
-				ddict = {}
-				for i in range(len(headers)):
-					head,val = headers[i],data[i]
-					ddict[head] = val
-					dataArr.append(ddict)
-				try:
-					_id = nodes[ddict["snp_id"]]
-				except KeyError:
-					logging.warning("WARNING: {id} was not found in the tree, check your source files!".format(id=ddict["snp_id"]))
-					_id = False
-				try:
-					genome_i = self.genomes[ddict["genome"]]
-				except KeyError:
-					logger.warning("No genome annotation could be found for given reference, please add {genome}!".format(genome=ddict["genome"]))
-
-					_id = False
-				logger.debug(ddict)
-				if _id:
-					self.add_annotation(ddict, id=_id, genome_i=genome_i)
-		self.taxonomydb.commit()
-		return dataArr
+		records = load_annotations(self.taxonomydb.conn,annotation_file,nodes,self.genomes)
+		record_change(self.taxonomydb.conn,"annotation",
+						references=genome_names(self.taxonomydb.conn,[self.genomes[r["genome"]] for r in records if r["genome"] in self.genomes]),
+						nodes=[nodes[r["snp_id"]] for r in records if r["snp_id"] in nodes])
+		return records
 
 	def load_genome_reference_file(self,reference_file):
 		'''Add new reference genomes from file!'''
-		logger.critical("The load reference modification function is not yet completed!")
-		with open(annotation_file) as af:
-			headers = af.readline().lstrip("#").strip().split("\t")
-			logging.debug(headers)
-			dataArr = []
-			for row in af:
-				data = row.strip().split("\t")
-				ddict = {}
-				for i in range(len(headers)):
-					head,val = headers[i],data[i]
-					ddict[head] = val
-				dataArr.append(ddict)
-		return
+		before = set(self.get_genomes(table="snp_references").values())
+		self.genomes = load_references(self.taxonomydb.conn,reference_file)
+		record_change(self.taxonomydb.conn,"reference",references=genome_names(self.taxonomydb.conn,set(self.genomes.values())-before))
+		return self.genomes
 
 
 	def update_database(self):
 		'''Update the database file'''
+		'''All changes are staged and applied in one transaction (a constant number of statements independent of branch size)'''
+		delete_links,delete_nodes = [],[]
+		if self.replace:
+			delete_links = list(self.modified_links | (self.existing_links-set(self.parent_link)))  ## delete existing links from old nodes, except parent
+			delete_nodes = list(self.old_nodes)
+		links,nodes = apply_tree_update(self.taxonomydb.conn,delete_links=delete_links,delete_nodes=delete_nodes,add_links=self.new_links)
 		if self.replace:
-			self.taxonomydb.delete_links(self.modified_links)
-			self.taxonomydb.delete_links(self.existing_links-set(self.parent_link))  ## delete existing links from old nodes, except parent
-			self.taxonomydb.delete_nodes(self.old_nodes)
 			logger.info("Deleted nodes {nodes}".format(nodes=self.old_nodes))
-		links,nodes = self.taxonomydb.add_links(self.new_links)
 		logger.debug("Added nodes {nodes}, added links {links}".format(nodes=nodes,links=links))
 
 		if len(links) + len(nodes) + len(self.modified_links) > 0:
 			if self.replace:
 				logger.info("Deleting {n} links and {n2} nodes that are no longer valid".format(n=len(self.modified_links | self.existing_links),n2=len(self.old_nodes)))
-			logger.info("Adding {n} new nodes".format(n=len(nodes)))
+			logger.info("Adding {n} new nodes".format(n=len(self.added_nodes)))
 			logger.info("Adding {n} updated and/or new links".format(n=len(links)))
-
-			''' Commit changes (only commit once both deletion and addition of new nodes and links are completed!)'''
-			self.taxonomydb.commit()
+			record_change(self.taxonomydb.conn,"tree",nodes=nodes|set(delete_nodes))
 			self.nodeDict = self.taxonomydb.get_nodes()
 			if self.mod_genomes:
 				logger.info("Transfering genomeid2taxid annotation from incoming database")
@@ -2,12 +2,12 @@
 Module to read and write newick trees
 
 '''
-from flextaxd.modules.database.DatabaseConnection import DatabaseFunctions
 from CanSNPer2.modules.DatabaseConnection import CanSNPdbFunctions
-import ete3
-'''Temporary fix for conda that refuses to select the correct version of ete3 during test installation.
-	It fails due to faces not being available in that ete3 version on import, but it works when ete3 is
-	 being installed manually using conda.
+from CanSNPer2.modules.CompiledDatabase import get_compiled
+from CanSNPer2.modules.SVGTree import SVGTree
+from CanSNPer2.modules.TreeRenderer import TreeRenderer,CanSNPer_tree_layout,tree_extensions
+'''ete3 (and the Qt stack it pulls in) is imported inside the functions that draw trees,
+	importing it at module level makes every CLI call pay for it (also --help and --version)
 '''
 
 import sys
@@ -45,7 +45,7 @@ class NewickNode(object):
 		self.id         = id            	## Node id
 		self.name       = name          	## Node name
 		self.parent     = parent        	## Parent id False for root
-		self.children   = set()         	## Set of newick children
+		self.children   = []         		## List of newick children (in the order they were added)
 		self.__class__.print_opt = "newick" ## The default behaviour of this class is to print out a
 											## 		newick tree from the given node (as root)
 
@@ -57,17 +57,9 @@ class NewickNode(object):
 		if self.__class__.print_opt == "name":
 			return "{name}".format(name=self.name)
 		elif self.__class__.print_opt == "lineage":
-			if self.parent:
-				return "{parent};{name}".format(name=self.name, parent=self.parent)
-			else:
-				return "root"
+			return ";".join(self.lineage())
 		elif self.__class__.print_opt == "newick":
-			if len(self.children) > 0 and self.parent:
-				return "({children}){name}".format(name=self.name,children=",".join(str(child) for child in self.children))
-			elif not self.parent:  #Only the root node has this property
-				return "(({children}){parent})ROOT;".format(children=",".join(str(child) for child in self.children),parent=self.name)
-			else:
-				return "{name}".format(name=self.name)
+			return "".join(self.newick())
 		else:
 			return "{id}: {name}; children: {nchildren} ".format(id=self.id, name=self.name, nchildren = len(self.children))
 
@@ -76,9 +68,53 @@ class NewickNode(object):
 
 	def add_child(self,child):
 		'''Add a NewickNode object as child'''
-		self.children.add(child)
+		self.children.append(child)
 		return
 
+	def lineage(self):
+		'''Return the names from root to this node (the root is named root)'''
+		lineage = []
+		node = self
+		while node.parent:
+			lineage.append(node.name)
+			node = node.parent
+		lineage.append("root")
+		return lineage[::-1]
+
+	def newick(self):
+		'''Generator of the newick tree below this node, the tree is walked with an explicit stack
+			so that the depth of the tree is not limited by the recursion limit
+		'''
+		stack = [self]
+		while stack:
+			node = stack.pop()
+			if isinstance(node,str):
+				yield node
+				continue
+			if not node.parent:  #Only the root node has this property
+				yield "(("
+				stack.append("){name})ROOT;".format(name=node.name))
+			elif len(node.children) > 0:
+				yield "("
+				stack.append("){name}".format(name=node.name))
+			else:
+				yield "{name}".format(name=node.name)
+				continue
+			for i in range(len(node.children)-1,-1,-1):
+				stack.append(node.children[i])
+				if i > 0:
+					stack.append(",")
+
+	def write_newick(self,out,chunksize=4096):
+		'''Stream the newick tree below this node to an open file'''
+		chunk = []
+		for token in self.newick():
+			chunk.append(token)
+			if len(chunk) >= chunksize:
+				out.write("".join(chunk))
+				chunk = []
+		out.write("".join(chunk)+"\n")
+
 	def set_print(self,_type):
 		'''Set the variable that controls the print style
 			name
@@ -98,16 +134,19 @@ class NewickTree(object):
 
 	"""
 
-	def __init__(self, database,name="newick",outdir="./",min_required_hits=3,strictness=0.7):
+	def __init__(self, database,name="newick",outdir="./",min_required_hits=3,strictness=0.7,cache=True):
 		super(NewickTree, self).__init__()
-		self.database = CanSNPdbFunctions(database) ## Initiate database connection with CanSNPdbFunctions
+		self.database = CanSNPdbFunctions(database,readonly=True) ## Initiate a read only database connection with CanSNPdbFunctions
+		self.cache = cache							## Read the tree from the compiled database ({database}.cache) if possible
 		self.nodeDict = {}							## Dictionary to store references to all newick nodes
-		self.c_p_set = set()
-		self.tree_file = "{outdir}/{name}_tree.pdf".format(outdir=outdir.rstrip("/"),name=name) ## output file
+		self.tree_prefix = "{outdir}/{name}_tree".format(outdir=outdir.rstrip("/"),name=name) ## output file prefix
+		self.tree_file = self.get_tree_file("pdf")
 		self.min_required_hits = min_required_hits
 		self.strictness = strictness
+		self.renderer = False						## TreeRenderer of this tree, created on first use
 		## Build the newick tree
 		self.newickTree = str(self.build_tree())
+		self.nameDict = dict((node.name,node) for key,node in self.nodeDict.items() if key != "root")
 		## Tree colors
 		self.snp_colors = {
 			"derived": "#63e563", 			## Green
@@ -119,8 +158,13 @@ class NewickTree(object):
 	def __repr__(self):
 		return "NewickTree()"
 
-	def print(self):
-		print(self.newickTree)
+	def print(self,out=sys.stdout):
+		'''Write the newick tree to out (default stdout)'''
+		self.nodeDict["root"].write_newick(out)
+
+	def get_tree_file(self,tree_format="svg"):
+		'''Return the output path of a tree with the given format'''
+		return "{prefix}.{ext}".format(prefix=self.tree_prefix,ext=tree_extensions[tree_format])
 
 	def get_tree(self,table="tree"):
 		'''Function that returns the whole tree in the database the script expects
@@ -154,30 +198,6 @@ class NewickTree(object):
 		res = self.database.query(QUERY).fetchone()
 		return res
 
-	def new_node(self,child,nodes,parent):
-		'''Function that adds a new node to the newick tree'''
-		try:
-			if len(self.c_p_set & set([(child,parent)])) == 0:
-				node = NewickNode(child, nodes[child], self.nodeDict[parent])  		## this works also for root as root has itself as child
-				'''Make sure link to parent was not made before'''
-				self.c_p_set |= set([(child,parent)])
-				self.c_p_set |= set([(parent,child)])
-				self.nodeDict[child] = node
-			else:
-				logger.debug("Link {child}-{parent} already exists, retrieve node!".format(child=child,parent=parent))
-				node = self.nodeDict[child]										## add a reference to the node so that children can be added
-			pnode = self.nodeDict[parent]										## add child to the parent node
-			pnode.add_child(node)
-		except KeyError:
-			logger.debug("Error in adding NewickNode parent: {parent} does not exist, trying to add parent".format(parent=parent))
-			t_parent,t_child,rank = self.get_parent(parent)
-			logger.debug("Adding parent: {parent} of parent: {child}".format(parent=t_parent,child=t_child))
-			self.new_node(t_child,nodes,t_parent)
-			self.new_node(child,nodes,parent)
-			return
-		logger.debug("NewickNode p:{parent} c: {child} added".format(parent=parent,child=child))
-		return
-
 	def build_tree(self):
 		'''Build newick tree from database
 			This function walks through a database of nodes and creates NewickNode objects
@@ -185,28 +205,51 @@ class NewickTree(object):
 			Returns: The root of the tree, however all nodes are accesible from the
 						NewickTree nodeDict by their node name
 		'''
-		tree = self.get_tree()
-		nodes = self.get_nodes()
+		compiled = False
+		if self.cache:
+			compiled = get_compiled(self.database.database)
+		if compiled:
+			tree = compiled.get_tree()
+			nodes = compiled.get_nodes()
+		else:
+			tree = self.get_tree()
+			nodes = self.get_nodes()
 		logger.debug("Nodes: {n} Links: {l}".format(n=len(nodes),l=len(tree)))
-		logger.debug([nodes,tree])
+		newickTree = False
+		'''Create all nodes first, the links can then be added in any order without looking up missing parents'''
 		for parent,child in tree:
+			if child not in self.nodeDict:
+				self.nodeDict[child] = NewickNode(child, nodes[child], False)
 			if parent == child:  ## root
-				root = NewickNode(child, nodes[child], False)					## Create the root node
-				self.nodeDict[child] = root										## Add the root node to the node dictionary
-				self.nodeDict["root"] = root									## Also add this reference as "root"
-				newickTree = root  												## The master parent will contain the full tree
+				newickTree = self.nodeDict[child]								## The master parent will contain the full tree
+				self.nodeDict["root"] = newickTree								## Also add this reference as "root"
+		if not newickTree:
+			raise ValueError("The tree has no root (a node with itself as parent)")
+		for parent,child in tree:
+			if parent == child:
+				continue
+			node = self.nodeDict[child]
+			if node.parent:
+				logger.warning("Node {child} already has parent {parent}, link {child}-{new} ignored!".format(child=child,parent=node.parent.id,new=parent))
 				continue
-			self.new_node(child,nodes,parent)
-		## The newickTree is the same as the master parent (containing the full tree, the root node is defined on row 135)
+			node.parent = self.nodeDict[parent]
+			node.parent.add_child(node)
+		## The newickTree is the same as the master parent (containing the full tree)
 		logger.debug("Tree complete, return newickTree")
 		#logger.debug(newickTree)
 		return newickTree
 
 	def CanSNPer_tree_layout(self,node):
 		'''Layout function for ETE3 trees.'''
-		# Adds the name face to the image at the top side of the branch
-		if not node.is_root():
-			ete3.faces.add_face_to_node(ete3.AttrFace("name"), node, column=0, position="branch-top")
+		return CanSNPer_tree_layout(node)
+
+	def get_depth(self,node):
+		'''Return the distance from a node to the tree ROOT (the tree root node has distance 1)'''
+		dist = 0.0
+		while node:
+			dist += 1
+			node = node.parent
+		return dist
 
 	def _confirm_path(self,dist_list,called_snps,snplist):
 		'''Confirm path of snps'''
@@ -223,7 +266,7 @@ class NewickTree(object):
 					count +=1
 				else: ## If ancestral node is found in the path it means it is confirmed ancestral, therefore the current path is not correct!
 					count = 0
-				node = node.up
+				node = node.parent
 			quota = float(count)/dist
 			logger.debug("-- Confirm strictness: {quota}".format(quota=quota))
 			logger.debug("-- Min required hits: {minhit}, {count}".format(minhit= self.min_required_hits, count=count))
@@ -272,97 +315,25 @@ class NewickTree(object):
 				return f_dist,f_node,dlist
 		return False,False,dlist
 
-	def draw_ete3_tree(self,snplist,called_snps=False,save_tree=True,summary=False):
-		'''Draws a phylogenetic tree using ETE3
+	def call_snps(self,snplist,called_snps=False):
+		'''Call the final SNP by walking the tree from the deepest called SNP to root
 		Keyword arguments:
-		snplist -- a list of the SNP names, positions and state
+		snplist -- a dictionary with the state of each SNP
+		called_snps -- a list of derived SNPs
+		Returns: called (depth,snp,confirmed), message, list of [depth,snp] of called snps
 		'''
-		logger.debug("Draw tree from snplist")
-		try:
-			tree = ete3.Tree(self.newickTree, format=1)
-		except:
-			logger.debug(self.newickTree)
-		farthest_leaf, tree_depth = tree.get_farthest_leaf()
-		for n in tree.traverse():
-			# The ancestral node is set to have a red colour
-			nstyle = ete3.NodeStyle()
-			# If the SNP is missing due to a gap, make it grey
-			nstyle["fgcolor"] = self.snp_colors["non_aligned"]
-			nstyle["size"] = 10
-			nstyle["vt_line_color"] = "#DDDDDD"
-			nstyle["hz_line_color"] = "#DDDDDD"
-			nstyle["vt_line_type"] = 1
-			nstyle["hz_line_type"] = 1
-			nstyle["vt_line_width"] = 2
-			nstyle["hz_line_width"] = 2
-			if len(snplist) > 0:
-				try:
-					snpvalue = snplist[n.name]
-				except KeyError:
-					'''SNP not in list make grey'''
-					continue
-				if snpvalue == 2:
-					nstyle["fgcolor"] = self.snp_colors["ancestral"]
-					nstyle["size"] = 10
-					nstyle["vt_line_color"] = "#000000"
-					nstyle["hz_line_color"] = "#000000"
-					nstyle["vt_line_type"] = 0
-					nstyle["hz_line_type"] = 0
-					nstyle["vt_line_width"] = 2
-					nstyle["hz_line_width"] = 2
-				elif snpvalue == 1:
-					## If the SNP was derived make it green
-					nstyle["fgcolor"] = self.snp_colors["derived"]
-					nstyle["size"] = 15
-					nstyle["vt_line_color"] = "#000000"
-					nstyle["hz_line_color"] = "#000000"
-					nstyle["vt_line_type"] = 0
-					nstyle["hz_line_type"] = 0
-				elif snpvalue == 3:
-					## If the SNP was neither of ancestral or derived make it blue
-					nstyle["fgcolor"] = self.snp_colors["other_base"]
-					nstyle["size"] = 15
-					nstyle["vt_line_color"] = "#000000"
-					nstyle["hz_line_color"] = "#000000"
-					nstyle["vt_line_type"] = 0
-					nstyle["hz_line_type"] = 0
-			elif called_snps:
-				if set([n.name]) & set(called_snps):
-					### Only care about called SNPs and color all green
-					nstyle["fgcolor"] = self.snp_colors["derived"]
-					nstyle["size"] = 15
-				nstyle["vt_line_color"] = "#000000"
-				nstyle["hz_line_color"] = "#000000"
-				nstyle["vt_line_type"] = 0
-				nstyle["hz_line_type"] = 0
-
-			if n.name != "ROOT": ## Root should be just a line not a false "ancenstral node"
-				n.set_style(nstyle)
-		ts = ete3.TreeStyle()
-		ts.show_leaf_name = False  						# Do not print(leaf names, they are added in layout)
-		ts.show_scale = False  							# Do not show the scale
-		ts.layout_fn = self.CanSNPer_tree_layout  		# Use the custom layout
-		ts.optimal_scale_level = 'full' 			 	# Fully expand the branches of the tree
-		scale_factor = 500								# Tree scale factor, increases depth of tree to allow a higher resolution tree
-
-		## Render tree and save to pdf
-		if save_tree:
-			tree.render(self.tree_file, tree_style=ts, w=tree_depth * scale_factor)
-			if summary:
-				return
 		dlist = []
 		confirmed = [False,0]
 		final = "NA"
 		logger.info("Called snps: {called}".format(called=called_snps))
 		if called_snps:
 			try:
-				troot = tree.get_tree_root()
 				'''Calculate the distance from all nodes to the root'''
 				for tsnp in called_snps:
 					try:
-						dist = tree.get_distance(tsnp,troot)
+						dist = self.get_depth(self.nameDict[tsnp])
 						dlist.append([dist,tsnp])
-					except ValueError:
+					except KeyError:
 						if tsnp == "T/N.1":
 							dlist.append([0,tsnp])
 						else:
@@ -381,7 +352,7 @@ class NewickTree(object):
 					return False,msg,[]
 				else:#dist,node = dlist[0]
 					logger.debug("Calling SNP")
-					node = tree.search_nodes(name=node)[0]
+					node = self.nameDict[node]
 					### Loop different nodes
 					confirmed = self._confirm_path([dist,node],called_snps,snplist)
 					called = dlist[0]+[confirmed]
@@ -404,3 +375,32 @@ class NewickTree(object):
 			logger.debug(msg)
 			return False,msg,[]
 		return called,msg,dlist
+
+	def get_renderer(self):
+		'''Return the TreeRenderer of this tree (layout is calculated once)'''
+		if not self.renderer:
+			self.renderer = TreeRenderer(SVGTree(self.nodeDict["root"]),self.newickTree,self.snp_colors)
+		return self.renderer
+
+	def render_tree(self,snplist,called_snps=False,tree_format=["svg"]):
+		'''Render the tree in all requested formats, only pdf requires ete3'''
+		files = self.get_renderer().render(self.tree_prefix,snplist,called_snps,tree_format)
+		for path in files:
+			logger.info(path)
+		return files
+
+	def draw_tree(self,snplist,called_snps=False,save_tree=True,summary=False,tree_format=["svg"]):
+		'''Render the tree (if save_tree) and call the final SNP
+		Keyword arguments:
+		snplist -- a list of the SNP names, positions and state
+		'''
+		logger.debug("Draw tree from snplist")
+		if save_tree:
+			self.render_tree(snplist,called_snps,tree_format)
+			if summary:
+				return
+		return self.call_snps(snplist,called_snps)
+
+	def draw_ete3_tree(self,snplist,called_snps=False,save_tree=True,summary=False):
+		'''Draws a phylogenetic tree using ETE3 (pdf) and calls the final SNP'''
+		return self.draw_tree(snplist,called_snps,save_tree,summary,tree_format=["pdf"])
@@ -6,6 +6,7 @@ ParseXMFA is a script that parse xmfa files and extract all SNPs
 
 #__name__="ParseXMFA"
 from CanSNPer2.modules.DatabaseConnection import XMFAFunctions
+from CanSNPer2.modules.AlignmentMap import AlignmentMap
 import os
 import logging
 logger = logging.getLogger(__name__)
@@ -40,10 +41,17 @@ class ParseXMFA(object):
 			this option allows masking of SNPs placed within n bases of the edge of an alignment'''
 		#self.mask = kwargs["mask"]
 		kwargs["verbose"] = True
-		if "database" in kwargs:
+		'''A catalogue (CompiledDatabase) loaded before the worker processes are forked is shared by all workers,
+			the database is then never opened by the workers'''
+		self.catalogue = kwargs.get("catalogue",False)
+		self.database_path = kwargs.get("database",False)	## References left out of the catalogue are read from the database
+		if "database" in kwargs and not self.catalogue:
 			self.database = XMFAFunctions(kwargs["database"],verbose=self.verbose)
 		else:
 			self.database = False
+		'''If a map directory is given an AlignmentMap of each xmfa file is saved there (used to type new SNPs without aligning again)'''
+		self.map_dir = kwargs.get("map_dir",False)
+		self.alignment_map = False
 
 	def get_snp_info(self):
 		'''Return SNP_info'''
@@ -57,6 +65,30 @@ class ParseXMFA(object):
 		'''Return true snps'''
 		return self.called_snps
 
+	def get_reference_snps(self,reference):
+		'''Return the SNPs annotated on a reference {position: (position, ancestral base, derived base, snp_id)}'''
+		try:
+			snps = self.load_snps(reference)
+		except ValueError:
+			return {}
+		return snps[0]
+
+	def load_snps(self,reference):
+		'''Return the SNPs of a reference from the catalogue, references the catalogue does not hold (e.g. left out
+			when it was compiled) are read from the database
+		'''
+		snps = self.catalogue.get_snps(reference) if self.catalogue else False
+		if not snps:
+			'''Create connection to SNP database if it is not connected'''
+			if not self.database:
+				self.database = XMFAFunctions(self.database_path,verbose=self.verbose)
+			snps = self.database.get_snps(reference)
+		return snps
+
+	def get_reference_snp_ids(self,reference):
+		'''Return the snp_ids annotated on a reference'''
+		return set(snp[3] for snp in self.get_reference_snps(reference).values())
+
 	def reverse_complement(self,dna):
 		'''Complement and reverse DNA string'''
 		dna_rev = [ self.rcDict[x] for x in dna[::-1] ]
@@ -131,6 +163,8 @@ class ParseXMFA(object):
 			refHead = self.parse_head(refSeq.pop(0))		## parse reference header info
 			targetSeq = seqLines[2].split("\n")				## target sequence
 			targetHead = self.parse_head(targetSeq.pop(0))	## parse target sequence header
+			if self.alignment_map:
+				self.alignment_map.add_block("".join(refSeq),"".join(targetSeq),refHead,targetHead)
 			'''Parse aligned sequence pair '''
 			while int(self.current_snp) < int(refHead["start"]): ## Current SNP not aligned
 				# Keep iterating new canSNP-positions until the end of current alignment or until there are no more canSNPs to check
@@ -165,18 +199,22 @@ class ParseXMFA(object):
 	def run(self, xmfa, reference=False,database=False):
 		'''Parse XMFA file and return SNPS matching the given database'''
 		self.SNPS = {}  ## For each run SNPs has to be emtpy
-		'''Create connection to SNP database if it is not connected'''
-		if not self.database:
-			self.database = XMFAFunctions(database)
 		''' retrieve registered SNPs'''
 		if not reference:
 			reference = os.path.basename(xmfa).split("_")[0]
 		self.reference=reference
-		self.snplist, self.snp_positions = self.database.get_snps(reference)
+		if database:
+			self.database_path = database
+		self.snplist, self.snp_positions = self.load_snps(reference)
 		#if self.verbose: print(self.snplist)
 		'''save first snp to look for'''
 		self.current_snp = self.snp_positions.pop(0)
+		if self.map_dir:
+			self.alignment_map = AlignmentMap(reference)
 		snps = self.read_xmfa(xmfa)
+		if self.alignment_map and snps is not False:
+			self.alignment_map.write(os.path.join(self.map_dir,os.path.basename(xmfa).rsplit(".",1)[0]+".map"))
+		self.alignment_map = False
 		return snps
 
 if __name__=="__main__":
@@ -0,0 +1,53 @@
+'''
+ProfileValidation compares the SNPs typed with an alignment profile to the SNPs typed with the default profile
+
+Each query of a corpus is aligned with both profiles, the target base of every SNP is compared and the
+alignment time of the profiles is measured. A profile can be adopted when its concordance is (close to) 1.0.
+
+	Report (tab separated, one row per SNP typed by either profile)
+		Query 	SNP 	Reference 	Pos 	Default base 	Profile base 	Concordant
+	Summary (one row per query and the whole corpus)
+		Query 	SNPs 	Concordant 	Concordance 	Default time 	Profile time 	Speedup
+'''
+
+import logging
+logger = logging.getLogger(__name__)
+
+def compare_snp_info(query,default_info,profile_info):
+	'''Compare the SNP_info of a query typed with the default and another profile, returns the report rows
+		(SNPs typed by only one of the profiles are discordant, their missing base is "-")
+	'''
+	default = dict((snp[0],snp) for snp in default_info)
+	profile = dict((snp[0],snp) for snp in profile_info)
+	rows = []
+	for snp_id in sorted(set(default).union(profile)):
+		snp = default.get(snp_id,profile.get(snp_id))
+		default_base = default[snp_id][5] if snp_id in default else "-"
+		profile_base = profile[snp_id][5] if snp_id in profile else "-"
+		rows.append([query,snp_id,snp[1],snp[2],default_base,profile_base,"yes" if default_base == profile_base else "no"])
+	return rows
+
+def summarize(query,rows,default_time,profile_time):
+	'''Return the summary row of the report rows of a query (or all queries)'''
+	concordant = sum(row[6] == "yes" for row in rows)
+	return [query,str(len(rows)),str(concordant),
+			"{c:.4f}".format(c=concordant/len(rows)) if rows else "NA",
+			"{t:.1f}".format(t=default_time),"{t:.1f}".format(t=profile_time),
+			"{s:.2f}".format(s=default_time/profile_time) if profile_time > 0 else "NA"]
+
+def write_validation(path,profile,results):
+	'''Write the per SNP report of results [(query, rows, default time, profile time)] to path and the summary to
+		path.summary, returns the summary row of the whole corpus
+	'''
+	rows = [row for result in results for row in result[1]]
+	with open(path, "w") as f:
+		print("\t".join(["Query","SNP","Reference","Pos","Default base","{profile} base".format(profile=profile.capitalize()),"Concordant"]),file=f)
+		for row in rows:
+			print("\t".join(row),file=f)
+	total = summarize("all",rows,sum(result[2] for result in results),sum(result[3] for result in results))
+	with open(path+".summary", "w") as f:
+		print("\t".join(["Query","SNPs","Concordant","Concordance","Default time","{profile} time".format(profile=profile.capitalize()),"Speedup"]),file=f)
+		for result in results:
+			print("\t".join(summarize(*result)),file=f)
+		print("\t".join(total),file=f)
+	return total
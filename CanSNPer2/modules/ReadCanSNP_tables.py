@@ -29,22 +29,6 @@ class ReadCanSNPer(ReadTaxonomy):
 
 		self.version = version
 
-	def add_SNP(self,nodes,i):
-		'''Add name of node to database'''
-		name = nodes[i].strip()
-		#i-=1 ## Check next parent
-		try:
-			parent_i = self.annotation[nodes[i-1]]  ## check if current nodes parent exists
-		except KeyError:  						## Parent did not exist, keep walking up the tree and add all parents until root!
-			if i < -len(nodes):
-				return self.root				## The root has been reached return index of root
-			else:								## Parent didn't exist again, add parent to this node and then add the link to that parent
-				parent_i = self.add_SNP(nodes,i-1)## Add node of parent
-				#self.annotation[] = parent_i
-		node_i = self.add_node_annotation([name],["snp_id"],table="nodes")  ## Add node
-		self.add_link(node_i, parent_i)			## Add link to next parent
-		return node_i 	##  index of child
-
 	def add_node_annotation(self,data,headers = [], table="nodes"):
 		'''Add full annotation of a CanSNP'''
 		#print(self.taxid_base, data)
@@ -111,34 +95,31 @@ class ReadCanSNPer(ReadTaxonomy):
 		return
 
 	def parse_taxonomy(self,taxonomy_file):
-		'''Retrieve node description from CanSNPer formatted tree'''
+		'''Retrieve node description from CanSNPer formatted tree
+			The whole tree is built in memory, each row lists a node and all its parents (root first).
+			Parents missing in the file are added from the lineage (top down), a lineage that does not
+			start at root is linked to root. Nodes and links are then written in one transaction.
+		'''
 		if self.verbose: print("Parse CanSNP tree file")
+		self.init_tree()
+		self.annotation = self.names					## snp_id -> node id, also used when annotations are parsed
 		with open(taxonomy_file,"r") as f:
 			for row in f:
-				nodes = row.strip().split(";")  ## get node and all its parents in a list
-				child = nodes[-1]  ## get name of child node
-				if child == "":
+				nodes = [node.strip() for node in row.strip().split(";")]  ## get node and all its parents in a list
+				if nodes[-1] == "":
 					continue
-				'''If the tree was not properly formatted an a parent is missing make sure that function works anyway by adding any parent node above child'''
-				try:
-					parent_i = self.annotation[nodes[-2].strip()]  ## Check if parent of child node exists
-				except KeyError: ## parent node does not exist, add parent
-					#print(self.taxid_base)
-					parent_i = self.add_SNP(nodes,-2)
-				except IndexError: ## Should be first row with only one node (parent)
-					child_i = self.add_node_annotation([child],["snp_id"],table="nodes")
-					self.annotation[child] = self.root
-					parent_i = self.root
-					self.database.add_link(parent_i,parent_i)
-
-					#self.taxid_base = self.root+1
+				if len(nodes) == 1:  ## Should be first row with only one node (root)
+					self.root = self.new_node(nodes[0])
+					self.new_links[(self.root,self.root)] = True
 					continue
-				'''Now all parents exists, add new child node and add the link'''
-				try:
-					child_i = self.annotation[child]
-				except KeyError:
-					child_i = self.add_node_annotation([child],["snp_id"],table="nodes")
-				self.database.add_link(child_i,parent_i)
-		self.database.commit()									## Commit changes to database
-		self.length = self.taxid_base - self.root				## Check number of new nodes added
+				parent_i = self.root
+				for node in nodes:
+					new = node not in self.names
+					node_i = self.new_node(node)
+					if (new or node == nodes[-1]) and node_i != parent_i:  ## link the child and any parent that was missing
+						self.new_links[(parent_i,node_i)] = True
+					parent_i = node_i
+		self.write_tree()
+		self.taxid_base = self.next_id
+		self.length = len(self.new_nodes)						## Check number of new nodes added
 		print("New taxonomy ids assigned {taxidnr}".format(taxidnr=self.length))
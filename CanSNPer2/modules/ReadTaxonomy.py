@@ -3,6 +3,7 @@ Read NCBI taxonomy dmp files (nodes or names) and holds a dictionary
 '''
 
 from CanSNPer2.modules.DatabaseConnection import CanSNPdbFunctions
+from CanSNPer2.modules.BulkLoad import bulk_write
 import logging
 logger = logging.getLogger(__name__)
 
@@ -60,6 +61,38 @@ class ReadTaxonomy(object):
 		self.taxonomy[description] = self.taxid_base
 		return self.taxid_base
 
+	def get_next_id(self):
+		'''Return the next free node id of the database'''
+		return self.database.query("SELECT COALESCE(MAX(id),0) FROM nodes").fetchone()[0]+1
+
+	def new_node(self,name):
+		'''Assign an id to a node name (in memory), existing names keep their id'''
+		try:
+			return self.names[name]
+		except KeyError:
+			self.names[name] = self.next_id
+			self.new_nodes.append((self.next_id,name))
+			self.next_id += 1
+			self.ids +=1
+			return self.names[name]
+
+	def init_tree(self):
+		'''Prepare in memory import of a tree, existing nodes of the database keep their ids'''
+		for id,name in self.database.query("SELECT id,name FROM nodes").fetchall():
+			self.names[name] = id
+		self.next_id = self.get_next_id()
+		self.new_nodes = []
+		self.new_links = {}						## (parent,child) in the order they were read, duplicates are ignored
+
+	def write_tree(self):
+		'''Write all new nodes and links in one transaction'''
+		nodes,links = bulk_write(self.database.conn,[
+				("nodes",["id","name"],self.new_nodes,False),
+				("tree",["parent","child"],list(self.new_links),True)
+			])
+		logger.info("Added {nodes} nodes and {links} links".format(nodes=nodes,links=links))
+		return nodes,links
+
 	def parse_taxonomy(self,treefile=False):
 		'''Parse taxonomy information'''
 		self.read_nodes(treefile=treefile)
@@ -76,20 +109,16 @@ class ReadTaxonomy(object):
 				raise InputError("Your input tree file does not contain the headers to specify child and parent!")
 			if headers[0] == "child":
 				swap = True
+			self.init_tree()
 			for tree_row in _treefile:
 				data = tree_row.strip().split(self.sep)
-				if swap:
-					data[0],data[1] = data[1],data[0]
-				'''Add nodes into database'''
 				if data[0] == "":
 					'''Check for empty rows'''
 					continue
-				for node in data:
-					try:
-						self.names[node]
-					except KeyError:
-						self.names[node] = self.database.add_node(node)
-						self.ids +=1
-				self.database.add_link(child=data[0],parent=data[1])
+				if swap:
+					data[0],data[1] = data[1],data[0]
+				'''Add nodes (in memory)'''
+				parent,child = self.new_node(data[0]),self.new_node(data[1])  ## columns are parent, child (after swap)
+				self.new_links[(parent,child)] = True
 				self.length +=1
-			self.database.commit()
+		self.write_tree()
@@ -0,0 +1,262 @@
+'''
+ReadTyping types SNPs directly from sequencing reads (fastq, gzipped or not) without assembly or alignment
+
+For every SNP in the catalogue the k-mers covering the SNP position are taken from the reference genome,
+once with the ancestral and once with the derived base at the SNP (both strands). Reads are streamed in
+chunks to a pool of processes that look up k-mers sampled along each read (every base of a read is covered
+by at least one sampled k-mer), each read (or read pair) adds at most one count to an allele of a SNP.
+
+	depth 			ancestral + derived counts of a SNP
+	SNP state 		1 derived, 2 ancestral, 3 mixed (no allele reaches the allele fraction), missing if depth < min_depth
+
+SNPs closer than the k-mer size are matched with all combinations of their alleles, a k-mer counts for
+every SNP it covers. K-mers found with both alleles of a SNP are not used for that SNP.
+'''
+
+import os
+import re
+import gzip
+from bisect import bisect_left,bisect_right
+from itertools import product
+from multiprocessing import Pool
+from time import time
+import logging
+logger = logging.getLogger(__name__)
+
+DERIVED = 1
+ANCESTRAL = 2
+OTHER = 3
+complement = bytes.maketrans(b"ACGTN",b"TGCAN")
+read_file_pattern = re.compile(r"^(.+?)(?:[._]R?([12]))?(?:_001)?\.(?:fastq|fq)(?:\.gz)?$")
+
+def read_sample_name(path):
+	'''Return the sample name of a read file (file name without mate number and fastq ending)'''
+	name = os.path.basename(path)
+	match = read_file_pattern.match(name)
+	if match:
+		return match.group(1)
+	return name.rsplit(".",1)[0]
+
+def pair_read_files(files):
+	'''Group read files by sample, returns a list of (first file, mate files), mates are matched by the _1/_2 (or _R1/_R2) in the file names'''
+	samples,order = {},[]
+	for path in files:
+		match = read_file_pattern.match(os.path.basename(path))
+		key = (os.path.dirname(path),read_sample_name(path)) if match and match.group(2) else path
+		if key not in samples:
+			samples[key] = []
+			order.append(key)
+		samples[key].append(path)
+	return [(sorted(samples[key])[0],sorted(samples[key])[1:]) for key in order]
+
+def call_snp(derived,ancestral,depth,min_depth=3,min_fraction=0.8):
+	'''Return the state of a SNP from the reads supporting each allele (depth all reads covering the SNP), False if depth is below min_depth'''
+	if depth < max(min_depth,1):
+		return False
+	if derived >= min_fraction*depth:
+		return DERIVED
+	if ancestral >= min_fraction*depth:
+		return ANCESTRAL
+	return OTHER
+
+def open_reads(path):
+	'''Open a fastq file (gzipped or not) for binary reading'''
+	with open(path, "rb") as f:
+		gzipped = f.read(2) == b"\x1f\x8b"
+	if gzipped:
+		return gzip.open(path, "rb")
+	return open(path, "rb")
+
+def cut_records(data,lines,records):
+	'''Return the position after the first records (4 lines each) of data with lines complete lines'''
+	position = len(data)
+	for line in range(lines-4*records+1):
+		position = data.rfind(b"\n",0,position)
+	return position+1
+
+def read_chunks(files,chunk_size=1<<24):
+	'''Stream single (one file) or paired (two files) reads in chunks of about chunk_size bytes (per file) of complete
+		records, the chunks of paired files hold the same reads
+	'''
+	handles = [open_reads(path) for path in files]
+	rest = [b""]*len(handles)
+	try:
+		while True:
+			blocks = [f.read(chunk_size) for f in handles]
+			data = [r+b if b or not r or r.endswith(b"\n") else r+b"\n" for r,b in zip(rest,blocks)]	## the last line may lack a newline
+			if not any(data):
+				break
+			lines = [d.count(b"\n") for d in data]
+			records = min(lines)//4
+			if records == 0:
+				if not all(blocks):		## end of a file
+					if any(d.strip() for d in data):
+						logger.warning("Incomplete fastq record or different number of reads at the end of {files}".format(files=", ".join(files)))
+					break
+				rest = data
+				continue
+			cuts = [cut_records(d,n,records) for d,n in zip(data,lines)]
+			rest = [d[cut:] for d,cut in zip(data,cuts)]
+			yield [d[:cut] for d,cut in zip(data,cuts)]
+	finally:
+		for f in handles:
+			f.close()
+
+def _init_worker(index,kmer_size,step):
+	global _index,_kmer_size,_step
+	_index,_kmer_size,_step = index,kmer_size,step
+
+def count_chunk(chunk):
+	'''Count the alleles found in a chunk of reads (fastq records of each mate), returns the number of reads and {allele key: reads}'''
+	counts = {}
+	get,k,step = _index.get,_kmer_size,_step
+	sequences = [data.split(b"\n")[1::4] for data in chunk]
+	if len(sequences) == 1:
+		reads = sequences[0]
+	else:		## mates are joined by an N so that a pair is looked up as one read
+		reads = [a+b"N"+b for a,b in zip(*sequences)]
+	reads = b"\n".join(reads).upper().split(b"\n")
+	for read in reads:
+		last = len(read)-k
+		if last < 0:
+			continue
+		hits = set()
+		for i in range(0,last,step):
+			hit = get(read[i:i+k])
+			if hit:
+				hits.update(hit)
+		hit = get(read[last:last+k])
+		if hit:
+			hits.update(hit)
+		for hit in hits:
+			counts[hit] = counts.get(hit,0)+1
+	return len(sequences[0]),counts
+
+class ReadTyper(object):
+	"""ReadTyper types SNPs from reads using the k-mers around the SNPs of the references
+			xmfa_obj 		ParseXMFA object (gives the SNPs of each reference from the catalogue)
+			fasta_files 	{reference: FastaFile} reference genomes
+	"""
+	def __init__(self, xmfa_obj, fasta_files, kmer_size=31, min_depth=3, min_fraction=0.8, workers=4, chunk_size=1<<24):
+		super(ReadTyper, self).__init__()
+		self.xmfa_obj = xmfa_obj
+		self.fasta_files = fasta_files
+		self.kmer_size = kmer_size
+		self.step = max(kmer_size//2,1)		## every base of a read is covered by at least one sampled k-mer (most bases by two)
+		self.min_depth = min_depth
+		self.min_fraction = min_fraction
+		self.workers = workers
+		self.chunk_size = chunk_size
+		self.max_neighbours = 4		## SNPs inside a k-mer combined with all alleles (at most 3**4 k-mers)
+		self.snps = []		## (reference, position, ancestral base, derived base, snp_id) of each allele key // 4
+		self.contig_starts = {}
+		self.index = self.build_index()
+		self.pool = Pool(workers, initializer=_init_worker, initargs=(self.index,self.kmer_size,self.step))
+
+	def __repr__(self):
+		return "ReadTyper({n} SNPs, k={k})".format(n=len(self.snps),k=self.kmer_size)
+
+	def get_window(self,reference,position):
+		'''Return the reference sequence within kmer_size-1 bases of a position (limited to the contig of the position)
+			and the offset of the position in the window, positions count over all contigs (as in the alignments)
+		'''
+		fasta = self.fasta_files[reference]
+		if reference not in self.contig_starts:
+			starts,start = [],0
+			for name in fasta.names:
+				starts.append(start)
+				start += fasta.length(name)
+			self.contig_starts[reference] = (starts,start)
+		starts,length = self.contig_starts[reference]
+		i = bisect_right(starts,position-1)-1
+		if i < 0 or position > length:
+			return "",0
+		local = position-starts[i]
+		first = max(local-self.kmer_size+1,1)
+		return fasta.fetch(fasta.names[i],first,local+self.kmer_size-1).upper(),local-first
+
+	def get_kmers(self,window,offset,base,neighbours):
+		'''Return the k-mers of a window covering offset with base at offset, k-mers covering
+			other SNPs (neighbours {offset: bases}) are added with each allele of those SNPs
+		'''
+		k,kmers = self.kmer_size,[]
+		sequence = window[:offset]+base+window[offset+1:]
+		for start in range(max(offset-k+1,0),min(offset,len(sequence)-k)+1):
+			kmer = sequence[start:start+k]
+			inside = sorted(o-start for o in neighbours if start <= o < start+k)[:self.max_neighbours]
+			for bases in product(*[neighbours[o+start] for o in inside]):
+				variant = list(kmer)
+				for o,b in zip(inside,bases):
+					variant[o] = b
+				kmers.append("".join(variant).encode("ascii"))
+		return kmers
+
+	def build_index(self):
+		'''Create the k-mer index {k-mer: allele keys}, the allele key is the SNP number * 4 + allele'''
+		index,k = {},self.kmer_size
+		for reference in sorted(self.fasta_files):
+			snps = sorted(self.xmfa_obj.get_reference_snps(reference).values())
+			positions = [snp[0] for snp in snps]
+			for snppos,rbase,tbase,snp_id in snps:
+				window,offset = self.get_window(reference,snppos)
+				if not window:
+					logger.warning("SNP {snp} at {pos} is outside of reference {reference}".format(snp=snp_id,pos=snppos,reference=reference))
+					continue
+				## SNPs close to each other are matched with any combination of their alleles
+				neighbours = {}
+				first = snppos-offset
+				for pos,nrbase,ntbase,nsnp_id in snps[bisect_left(positions,first):bisect_right(positions,first+len(window)-1)]:
+					if pos != snppos:
+						neighbours[pos-first] = sorted(set([window[pos-first],nrbase,ntbase]))
+				snp = len(self.snps)
+				self.snps.append((reference,snppos,rbase,tbase,snp_id))
+				for allele,base in [(ANCESTRAL,rbase),(DERIVED,tbase)]:
+					for kmer in self.get_kmers(window,offset,base,neighbours):
+						for key in (kmer,kmer.translate(complement)[::-1]):
+							index.setdefault(key,set()).add(snp*4+allele)
+		shared = 0
+		for key,alleles in list(index.items()):
+			snps = [allele//4 for allele in alleles]
+			alleles = tuple(allele for allele in alleles if snps.count(allele//4) == 1)	## k-mers found with both alleles of a SNP are not used for it
+			if alleles:
+				index[key] = alleles
+			else:
+				del index[key]
+				shared += 1
+		logger.info("Read typing index: {n} k-mers (k={k}) for {snps} SNPs, {shared} ambiguous k-mers removed".format(n=len(index),k=k,snps=len(self.snps),shared=shared))
+		return index
+
+	def count(self,files):
+		'''Count the reads supporting each allele in a (single or paired) read set'''
+		counts,reads,tic = {},0,time()
+		for chunk_reads,chunk_counts in self.pool.imap_unordered(count_chunk,read_chunks(files,self.chunk_size)):
+			reads += chunk_reads
+			for key,n in chunk_counts.items():
+				counts[key] = counts.get(key,0)+n
+		seconds = max(time()-tic,1e-6)
+		logger.info("{reads} reads in {files} typed in {t:.1f}s ({rate:.1f}M reads/min)".format(reads=reads,files=", ".join(map(os.path.basename,files)),t=seconds,rate=reads/seconds*60/1e6))
+		return counts
+
+	def type_reads(self,files,references=[]):
+		'''Type the SNPs of references (all if empty) from reads, returns SNPS, SNP_info and called_snps (as ParseXMFA)'''
+		counts = self.count(files)
+		references = set(ref.rsplit(".",1)[0] for ref in references)
+		SNPS,SNP_info,called_snps = {},[],[]
+		for snp,(reference,snppos,rbase,tbase,snp_id) in enumerate(self.snps):
+			if references and reference not in references:
+				continue
+			derived,ancestral = counts.get(snp*4+DERIVED,0),counts.get(snp*4+ANCESTRAL,0)
+			state = call_snp(derived,ancestral,derived+ancestral,self.min_depth,self.min_fraction)
+			if not state:
+				continue
+			SNPS[snp_id] = state
+			base = {DERIVED: tbase, ANCESTRAL: rbase, OTHER: "N"}[state]
+			if state == DERIVED:
+				called_snps.append(snp_id)
+			logger.debug("{snp}: {derived} derived, {ancestral} ancestral".format(snp=snp_id,derived=derived,ancestral=ancestral))
+			SNP_info.append([snp_id,reference,str(snppos),rbase,tbase,base])
+		return SNPS,SNP_info,called_snps
+
+	def close(self):
+		self.pool.close()
+		self.pool.join()
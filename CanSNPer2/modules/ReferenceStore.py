@@ -0,0 +1,132 @@
+'''
+ReferenceStore keeps one copy of each downloaded reference genome per host
+
+Genomes are stored by assembly accession and md5 (of the NCBI download) and linked (hardlink
+if possible, else symlink) into the reference folders of the databases using them. Each link
+is registered with the genome, a genome without any valid links is removed by gc.
+
+	{store}/objects/{accession}/{md5}/{file}.fna 		unpacked genome (and .fai index)
+	{store}/objects/{accession}/{md5}/users/{key} 		path of each link to the genome
+	{store}/tmp/ 										partial downloads and locks
+'''
+
+import os
+import shutil
+import fcntl
+import hashlib
+import tempfile
+from contextlib import contextmanager
+import logging
+logger = logging.getLogger(__name__)
+
+def link_file(source,link):
+	'''Hardlink source to link, symlink (absolute path) if source is on another file system'''
+	if os.path.lexists(link):
+		os.remove(link)
+	try:
+		os.link(source, link)
+	except OSError:
+		os.symlink(os.path.abspath(source), link)
+	return link
+
+class ReferenceStore(object):
+	"""ReferenceStore of unpacked reference genomes shared by all databases (reference folders) of a host"""
+	def __init__(self, path):
+		super(ReferenceStore, self).__init__()
+		self.path = os.path.abspath(path)
+		self.tmpdir = os.path.join(self.path,"tmp")
+		os.makedirs(os.path.join(self.path,"objects"), exist_ok=True)
+		os.makedirs(self.tmpdir, exist_ok=True)
+
+	def __repr__(self):
+		return "ReferenceStore({path})".format(path=self.path)
+
+	def object_dir(self,accession,md5):
+		return os.path.join(self.path,"objects",accession,md5)
+
+	def get(self,accession,md5,filename):
+		'''Return the path of a stored file, False if the genome is not in the store'''
+		path = os.path.join(self.object_dir(accession,md5),filename)
+		if os.path.exists(path):
+			return path
+		return False
+
+	@contextmanager
+	def lock(self,accession,md5):
+		'''Lock a genome while it is downloaded (other processes downloading the same genome wait)'''
+		with open(os.path.join(self.tmpdir,"{accession}_{md5}.lock".format(accession=accession,md5=md5)), "w") as f:
+			fcntl.flock(f, fcntl.LOCK_EX)
+			try:
+				yield f
+			finally:
+				fcntl.flock(f, fcntl.LOCK_UN)
+
+	def partial(self,accession,md5,filename):
+		'''Return the path used for the partial download of a genome'''
+		return os.path.join(self.tmpdir,"{accession}_{md5}_{filename}.part".format(accession=accession,md5=md5,filename=filename))
+
+	def add(self,accession,md5,files):
+		'''Move complete files ({name: path}) into the store, returns the object directory'''
+		target = self.object_dir(accession,md5)
+		os.makedirs(os.path.dirname(target), exist_ok=True)
+		tmp = tempfile.mkdtemp(prefix=".{md5}.".format(md5=md5), dir=os.path.dirname(target))
+		for name,path in files.items():
+			os.replace(path, os.path.join(tmp,name))
+			os.chmod(os.path.join(tmp,name), 0o644)
+		os.makedirs(os.path.join(tmp,"users"))
+		os.chmod(tmp, 0o755)
+		try:
+			os.rename(tmp, target)
+		except OSError:		## added by another process
+			shutil.rmtree(tmp, ignore_errors=True)
+		return target
+
+	def user_key(self,link):
+		return hashlib.sha1(os.path.abspath(link).encode("utf-8")).hexdigest()
+
+	def link(self,accession,md5,filename,link):
+		'''Link a stored file to link and register the link as a user of the genome'''
+		link_file(os.path.join(self.object_dir(accession,md5),filename), link)
+		with open(os.path.join(self.object_dir(accession,md5),"users",self.user_key(link)), "w") as f:
+			print(os.path.abspath(link),file=f)
+		return link
+
+	def users(self,object_dir,unregister=True):
+		'''Return the valid links to a genome (links that were removed or replaced are unregistered)'''
+		users = []
+		fasta = [f for f in os.listdir(object_dir) if f.endswith(".fna")]
+		for key in os.listdir(os.path.join(object_dir,"users")):
+			with open(os.path.join(object_dir,"users",key)) as f:
+				link = f.read().strip()
+			try:
+				valid = len(fasta) > 0 and os.path.samefile(link, os.path.join(object_dir,fasta[0]))
+			except OSError:
+				valid = False
+			if valid:
+				users.append(link)
+			elif unregister:
+				os.remove(os.path.join(object_dir,"users",key))
+		return users
+
+	def gc(self,dry_run=False):
+		'''Remove genomes that are no longer linked from any reference folder, returns the removed genomes and the bytes freed'''
+		removed,freed = [],0
+		objects = os.path.join(self.path,"objects")
+		for accession in sorted(os.listdir(objects)):
+			for md5 in sorted(os.listdir(os.path.join(objects,accession))):
+				object_dir = os.path.join(objects,accession,md5)
+				if md5.startswith(".") or not os.path.isdir(os.path.join(object_dir,"users")):
+					continue
+				with self.lock(accession,md5):
+					users = self.users(object_dir,unregister=not dry_run)
+					logger.info("{accession} ({md5}): {n} links".format(accession=accession,md5=md5,n=len(users)))
+					if users:
+						continue
+					size = sum(os.path.getsize(os.path.join(object_dir,f)) for f in os.listdir(object_dir) if os.path.isfile(os.path.join(object_dir,f)))
+					removed.append("{accession}/{md5}".format(accession=accession,md5=md5))
+					freed += size
+					if not dry_run:
+						shutil.rmtree(object_dir)
+			if not dry_run and not os.listdir(os.path.join(objects,accession)):
+				os.rmdir(os.path.join(objects,accession))
+		return removed,freed
@@ -0,0 +1,160 @@
+'''
+Lightweight tree renderer for CanSNPer2 trees
+
+SVGTree lays out the compiled NewickNode structure once (linear time, no recursion)
+and writes SVG, annotated Newick (NHX) or JSON files for each sample without ete3/Qt
+'''
+
+import json
+from xml.sax.saxutils import escape
+import logging
+logger = logging.getLogger(__name__)
+
+## ete3 line types (0 solid, 1 dashed, 2 dotted) translated to svg
+dasharray = {0: "", 1: "4,3", 2: "1,3"}
+
+class SVGTree(object):
+	"""SVGTree stores the layout of a tree as flat lists indexed in preorder
+			names 		node names
+			parents 	index of parent (-1 for root)
+			children 	list of child indexes
+			depth 		distance from the tree root (the root is 1 as the tree is drawn from a virtual ROOT)
+			y 			row of the node, leaves get one row each and parents are centered over their children
+	"""
+	def __init__(self, root, branch_length=80, row_height=20, margin=20):
+		super(SVGTree, self).__init__()
+		self.branch_length = branch_length
+		self.row_height = row_height
+		self.margin = margin
+		self.names = []
+		self.parents = []
+		self.children = []
+		self.depth = []
+		self.y = []
+		self.layout(root)
+
+	def __repr__(self):
+		return "SVGTree()"
+
+	def layout(self, root):
+		'''Walk the NewickNode tree with an explicit stack and calculate node positions'''
+		stack = [(root,-1)]
+		while stack:
+			node,parent = stack.pop()
+			index = len(self.names)
+			self.names.append(node.name)
+			self.parents.append(parent)
+			self.children.append([])
+			if parent < 0:
+				self.depth.append(1)
+			else:
+				self.depth.append(self.depth[parent]+1)
+				self.children[parent].append(index)
+			## Reverse sorted push so that children are visited (and drawn) in id order
+			for child in sorted(node.children, key=lambda n: n.id, reverse=True):
+				stack.append((child,index))
+		self.y = [0.0]*len(self.names)
+		row = 0
+		for index in range(len(self.names)):	## leaves are visited top down in preorder
+			if not self.children[index]:
+				self.y[index] = row
+				row += 1
+		for index in range(len(self.names)-1,-1,-1):	## children are always placed after their parent in preorder
+			if self.children[index]:
+				self.y[index] = (self.y[self.children[index][0]]+self.y[self.children[index][-1]])/2.0
+		self.rows = row
+		self.max_depth = max(self.depth)
+		logger.debug("Tree layout complete, {n} nodes on {rows} rows".format(n=len(self.names),rows=self.rows))
+
+	def _x(self, index):
+		return self.margin + self.depth[index]*self.branch_length
+
+	def _y(self, index):
+		return self.margin + self.y[index]*self.row_height + self.row_height/2.0
+
+	def _line(self, x1, y1, x2, y2, color, line_type, width):
+		dash = dasharray.get(line_type,"")
+		if dash:
+			dash = ' stroke-dasharray="{dash}"'.format(dash=dash)
+		return '<line x1="{x1:.1f}" y1="{y1:.1f}" x2="{x2:.1f}" y2="{y2:.1f}" stroke="{color}" stroke-width="{width}"{dash}/>'.format(
+					x1=x1,y1=y1,x2=x2,y2=y2,color=color,width=width,dash=dash)
+
+	def svg(self, style):
+		'''Return the tree as a list of svg lines
+			style is a function that returns a NodeStyle like dictionary for a node name
+		'''
+		width = self.margin*2 + (self.max_depth+1)*self.branch_length
+		height = self.margin*2 + self.rows*self.row_height
+		lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+				'<svg xmlns="http://www.w3.org/2000/svg" width="{w:.0f}" height="{h:.0f}" viewBox="0 0 {w:.0f} {h:.0f}" font-family="sans-serif" font-size="10">'.format(w=width,h=height),
+				'<rect width="100%" height="100%" fill="#FFFFFF"/>']
+		branches,nodes,labels = [],[],[]
+		for index,name in enumerate(self.names):
+			nstyle = style(name)
+			x,y = self._x(index),self._y(index)
+			if self.parents[index] < 0:
+				px = self.margin	## The root is drawn as a line from the virtual ROOT
+			else:
+				px = self._x(self.parents[index])
+			branches.append(self._line(px,y,x,y,nstyle["hz_line_color"],nstyle["hz_line_type"],nstyle["hz_line_width"]))
+			if len(self.children[index]) > 1:
+				y1,y2 = self._y(self.children[index][0]),self._y(self.children[index][-1])
+				branches.append(self._line(x,y1,x,y2,nstyle["vt_line_color"],nstyle["vt_line_type"],nstyle["vt_line_width"]))
+			nodes.append('<circle cx="{x:.1f}" cy="{y:.1f}" r="{r:.1f}" fill="{color}"/>'.format(x=x,y=y,r=nstyle["size"]/2.0,color=nstyle["fgcolor"]))
+			labels.append('<text x="{x:.1f}" y="{y:.1f}">{name}</text>'.format(x=px+3,y=y-3,name=escape(name)))
+		lines += branches + nodes + labels
+		lines.append("</svg>")
+		return lines
+
+	def write_svg(self, path, style):
+		'''Write svg tree to path'''
+		with open(path, "w") as svgout:
+			svgout.write("\n".join(self.svg(style))+"\n")
+		return path
+
+	def newick(self, state):
+		'''Return the tree as a newick string with the state of each node annotated (NHX)
+			state is a function that returns the state of a node name
+		'''
+		def label(index):
+			return "{name}[&&NHX:state={state}]".format(name=self.names[index],state=state(self.names[index]))
+		out = ["("]
+		stack = [0]
+		while stack:
+			item = stack.pop()
+			if isinstance(item,str):
+				out.append(item)
+				continue
+			children = self.children[item]
+			if children:
+				out.append("(")
+				stack.append(")"+label(item))
+				for k in range(len(children)-1,-1,-1):
+					stack.append(children[k])
+					if k:
+						stack.append(",")
+			else:
+				out.append(label(item))
+		out.append(")ROOT;")
+		return "".join(out)
+
+	def write_newick(self, path, state):
+		'''Write annotated newick tree to path'''
+		with open(path, "w") as nwkout:
+			print(self.newick(state),file=nwkout)
+		return path
+
+	def write_json(self, path, state):
+		'''Write the tree as a flat list of nodes (preorder) with state and layout position'''
+		nodes = []
+		for index,name in enumerate(self.names):
+			nodes.append({
+				"name": name,
+				"parent": self.names[self.parents[index]] if self.parents[index] >= 0 else None,
+				"depth": self.depth[index],
+				"row": self.y[index],
+				"state": state(name)
+			})
+		with open(path, "w") as jsonout:
+			json.dump({"nodes": nodes}, jsonout)
+		return path
@@ -0,0 +1,176 @@
+'''
+SamTyping types SNPs from reads already mapped to a CanSNPer2 reference (SAM text, gzipped or not)
+
+The records have to be sorted by position (samtools sort). The SAM file is read in a single pass, for each
+contig a pointer walks the sorted SNP positions of the reference along with the reads. The CIGAR string of
+a read is only walked when a SNP position lies within the read, the bases at SNP positions are counted if
+their base quality is at least min_base_quality. Memory use is bounded by the number of SNPs (the counts),
+not by the genome or the number of reads.
+
+Unmapped, secondary, supplementary, duplicate and QC failed records are not used. SNP positions count over
+all contigs of a reference (as in the alignments), contigs are identified by the names in the reference fasta.
+'''
+
+import os
+import re
+from bisect import bisect_left
+from time import time
+from CanSNPer2.modules.ReadTyping import call_snp,open_reads,DERIVED,ANCESTRAL,OTHER
+import logging
+logger = logging.getLogger(__name__)
+
+SKIP_FLAGS = 0x4 | 0x100 | 0x200 | 0x400 | 0x800		## unmapped, secondary, QC failed, duplicate, supplementary
+cigar_pattern = re.compile(rb"(\d+)([MIDNSHP=X])")
+
+class SamError(Exception):
+	def __init__(self, value):
+		self.value = value
+	def __str__(self):
+		return repr(self.value)
+
+def sam_sample_name(path):
+	'''Return the sample name of a SAM file (file name without .sam or .sam.gz)'''
+	name = os.path.basename(path)
+	for ending in [".gz",".sam"]:
+		if name.endswith(ending):
+			name = name[:-len(ending)]
+	return name
+
+def get_contigs(fasta_files):
+	'''Return {contig: (reference, position before the contig in the reference, length)} of the reference genomes {reference: FastaFile}'''
+	contigs = {}
+	for reference,fasta in fasta_files.items():
+		start = 0
+		for name in fasta.names:
+			contigs[name.encode("utf-8")] = (reference,start,fasta.length(name))
+			start += fasta.length(name)
+	return contigs
+
+def get_contig_snps(xmfa_obj,reference,start,length):
+	'''Return the sorted SNP positions of a contig (contig coordinates) and the SNPs [(reference, position, ancestral, derived, snp_id)]'''
+	snps = []
+	for snppos,rbase,tbase,snp_id in sorted(xmfa_obj.get_reference_snps(reference).values()):
+		if start < snppos <= start+length:
+			snps.append((snppos-start,(reference,snppos,rbase,tbase,snp_id)))
+	return [snp[0] for snp in snps],[snp[1] for snp in snps]
+
+def walk_cigar(pos,cigar,positions):
+	'''Return (index, read offset) of the reference positions (sorted) aligned to a read starting at pos,
+		positions deleted or skipped in the read are not returned
+	'''
+	offsets,ref,query,i = [],pos,0,0
+	for length,op in cigar_pattern.findall(cigar):
+		length = int(length)
+		if op in b"M=X":
+			while i < len(positions) and positions[i] < ref+length:
+				offsets.append((i,query+positions[i]-ref))
+				i += 1
+			ref += length
+			query += length
+		elif op in b"IS":
+			query += length
+		elif op in b"DN":
+			while i < len(positions) and positions[i] < ref+length:
+				i += 1
+			ref += length
+		if i == len(positions):
+			break
+	return offsets
+
+class SamTyper(object):
+	"""SamTyper types SNPs from SAM files mapped to one of the references
+			xmfa_obj 		ParseXMFA object (gives the SNPs of each reference from the catalogue)
+			fasta_files 	{reference: FastaFile} reference genomes (contig names and lengths)
+	"""
+	def __init__(self, xmfa_obj, fasta_files, min_depth=3, min_fraction=0.8, min_base_quality=20):
+		super(SamTyper, self).__init__()
+		self.xmfa_obj = xmfa_obj
+		self.min_depth = min_depth
+		self.min_fraction = min_fraction
+		self.min_base_quality = min_base_quality
+		self.contigs = get_contigs(fasta_files)
+		self.contig_snps = {}
+
+	def __repr__(self):
+		return "SamTyper({n} contigs)".format(n=len(self.contigs))
+
+	def get_contig_snps(self,contig):
+		if contig not in self.contig_snps:
+			self.contig_snps[contig] = get_contig_snps(self.xmfa_obj,*self.contigs[contig])
+		return self.contig_snps[contig]
+
+	def count(self,path):
+		'''Count the bases at the SNP positions in a sorted SAM file, returns {(reference, position, ancestral, derived, snp_id): {base: reads}}'''
+		counts,records,used,tic = {},0,0,time()
+		contig,positions,snps,first = False,[],[],0
+		done,unknown = set(),set()
+		last = 0
+		with open_reads(path) as f:
+			if f.peek(4)[:4] == b"BAM\x01":
+				raise SamError("{path} is a BAM file, convert it to SAM (samtools view -h)".format(path=path))
+			for line in f:
+				if line.startswith(b"@"):
+					continue
+				fields = line.split(b"\t",11)
+				records += 1
+				if int(fields[1]) & SKIP_FLAGS or fields[2] == b"*":
+					continue
+				if fields[9] == b"*":
+					continue		## no sequence stored (e.g. secondary alignments written without SEQ)
+				if fields[2] != contig:
+					if fields[2] in done:
+						raise SamError("{path} is not sorted by position ({contig} is found twice)".format(path=path,contig=fields[2].decode("utf-8")))
+					done.add(contig)
+					contig,last,first = fields[2],0,0
+					if contig in self.contigs:
+						positions,snps = self.get_contig_snps(contig)
+					else:
+						positions,snps = [],[]
+						unknown.add(contig)
+				pos = int(fields[3])
+				if pos < last:
+					raise SamError("{path} is not sorted by position ({contig}:{pos})".format(path=path,contig=contig.decode("utf-8"),pos=pos))
+				last = pos
+				'''SNPs before the start of this read are never covered by the following reads'''
+				while first < len(positions) and positions[first] < pos:
+					first += 1
+				if first == len(positions):
+					continue
+				seq,cigar = fields[9],fields[5]
+				if positions[first] >= pos+len(seq) and b"D" not in cigar and b"N" not in cigar:
+					continue		## the read can´t reach the next SNP
+				span = sum(int(n) for n,op in cigar_pattern.findall(cigar) if op in b"M=XDN")
+				end = bisect_left(positions,pos+span,first)
+				if end == first:
+					continue
+				qual = fields[10].rstrip(b"\r\n")
+				used += 1
+				for i,offset in walk_cigar(pos,cigar,positions[first:end]):
+					if qual != b"*" and qual[offset]-33 < self.min_base_quality:
+						continue
+					bases = counts.setdefault(snps[first+i],{})
+					base = chr(seq[offset]).upper()
+					bases[base] = bases.get(base,0)+1
+		for contig in unknown:
+			logger.warning("{contig} in {path} is not a contig of the references".format(contig=contig.decode("utf-8"),path=os.path.basename(path)))
+		logger.info("{records} records in {path} typed in {t:.1f}s ({used} reads covering SNPs)".format(records=records,path=os.path.basename(path),t=time()-tic,used=used))
+		return counts
+
+	def type_sam(self,path,references=[]):
+		'''Type the SNPs of references (all if empty) from a SAM file, returns SNPS, SNP_info and called_snps (as ParseXMFA)'''
+		counts = self.count(path)
+		references = set(ref.rsplit(".",1)[0] for ref in references)
+		SNPS,SNP_info,called_snps = {},[],[]
+		for (reference,snppos,rbase,tbase,snp_id),bases in sorted(counts.items(),key=lambda item: item[0][1]):
+			if references and reference not in references:
+				continue
+			state = call_snp(bases.get(tbase,0),bases.get(rbase,0),sum(bases.values()),self.min_depth,self.min_fraction)
+			if not state:
+				continue
+			SNPS[snp_id] = state
+			base = {DERIVED: tbase, ANCESTRAL: rbase, OTHER: max(bases,key=bases.get)}[state]
+			if state == DERIVED:
+				called_snps.append(snp_id)
+			logger.debug("{snp}: {bases}".format(snp=snp_id,bases=bases))
+			SNP_info.append([snp_id,reference,str(snppos),rbase,tbase,base])
+		return SNPS,SNP_info,called_snps
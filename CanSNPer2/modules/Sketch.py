@@ -0,0 +1,220 @@
+'''
+Sketch creates MinHash sketches of genomes to route queries to the database of their species
+
+A sketch holds the smallest hashes (bottom sketch_size) of the canonical k-mers of a genome, the Jaccard index of
+two genomes is estimated from their sketches and converted to a Mash distance (about 1 - average nucleotide identity).
+Each database keeps the sketches of its references in a small json file next to it ({database}.sketch), built when
+the references are downloaded (or on first use). Queries are sketched in one pass over the file and routed to the
+database holding the closest reference, queries not within max_distance of any reference are off target.
+'''
+
+import os
+import re
+import json
+from math import log
+import logging
+logger = logging.getLogger(__name__)
+try:
+	import numpy		## k-mers are hashed as arrays when numpy is installed (the same hashes are made without it)
+except ImportError:
+	numpy = False
+
+SKETCH_VERSION = 2
+KMER_SIZE = 21
+SKETCH_SIZE = 1000
+MASK64 = (1<<64)-1
+MULTIPLIER = 0x9E3779B97F4A7C15
+not_acgt = re.compile(rb"[^ACGT]+")
+encode = bytes.maketrans(b"ACGT",bytes([0,1,2,3]))		## 2-bit code of each base, the complement is 3-code
+
+def sketch_path(database):
+	'''Return the path of the reference sketches of a database'''
+	return "{database}.sketch".format(database=database)
+
+def kmer_hashes(sequence,k=KMER_SIZE,maximum=MASK64,size=None):
+	'''Return the 64 bit hashes below maximum of the canonical k-mers of a sequence (bytes, ACGT only, k <= 32),
+		only the smallest size distinct hashes if size is given. The k-mers are 2-bit encoded while rolling over the sequence
+	'''
+	if len(sequence) < k:
+		return []
+	codes = sequence.translate(encode)
+	if numpy:
+		return _kmer_hashes_numpy(codes,k,maximum,size)
+	mask,shift = (1<<2*k)-1,2*(k-1)
+	forward = reverse = 0
+	hashes = []
+	for i,code in enumerate(codes):
+		forward = ((forward << 2) | code) & mask
+		reverse = (reverse >> 2) | ((3-code) << shift)
+		if i >= k-1:
+			h = ((forward if forward < reverse else reverse)*MULTIPLIER) & MASK64
+			h ^= h >> 32
+			if h < maximum:
+				hashes.append(h)
+	if size:
+		return sorted(set(hashes))[:size]
+	return hashes
+
+def _kmer_hashes_numpy(codes,k,maximum,size):
+	'''kmer_hashes on arrays (same hashes)'''
+	codes = numpy.frombuffer(codes,dtype=numpy.uint8).astype(numpy.uint64)
+	n = len(codes)-k+1
+	forward = numpy.zeros(n,dtype=numpy.uint64)
+	reverse = numpy.zeros(n,dtype=numpy.uint64)
+	for j in range(k):
+		forward = (forward << numpy.uint64(2)) | codes[j:j+n]
+		reverse |= (numpy.uint64(3)-codes[j:j+n]) << numpy.uint64(2*j)
+	h = numpy.minimum(forward,reverse)*numpy.uint64(MULTIPLIER)		## wraps at 64 bits
+	h ^= h >> numpy.uint64(32)
+	if maximum < MASK64:
+		h = h[h < numpy.uint64(maximum)]
+	if size:
+		candidates = 2*size		## the smallest values are selected before they are made distinct (repeats take more)
+		while candidates < len(h):
+			smallest = numpy.unique(h[h <= numpy.partition(h,candidates)[candidates]])
+			if len(smallest) >= size:
+				return smallest[:size].tolist()
+			candidates *= 4
+		h = numpy.unique(h)[:size]
+	return h.tolist()
+
+class Sketch(object):
+	"""Sketch (bottom sketch_size hashes of the canonical k-mers) of a genome"""
+	def __init__(self, hashes=[], kmer_size=KMER_SIZE, sketch_size=SKETCH_SIZE):
+		super(Sketch, self).__init__()
+		self.kmer_size = kmer_size
+		self.sketch_size = sketch_size
+		self.hashes = sorted(set(hashes))[:sketch_size]
+
+	def __repr__(self):
+		return "Sketch({n} hashes, k={k})".format(n=len(self.hashes),k=self.kmer_size)
+
+	def update(self,sequence):
+		'''Add the k-mers of a sequence (bytes)'''
+		hashes = []
+		maximum = self.hashes[-1] if len(self.hashes) == self.sketch_size else MASK64		## only hashes below the sketch can enter it
+		for part in not_acgt.split(sequence.upper()):
+			if len(part) >= self.kmer_size:
+				hashes += kmer_hashes(part,self.kmer_size,maximum,self.sketch_size)
+		if hashes:
+			self.hashes = sorted(set(self.hashes).union(hashes))[:self.sketch_size]
+
+	def add_fasta(self,path,blocksize=1<<20):
+		'''Sketch a fasta file in one pass (the sequence of each record is read in blocks overlapping by k-1 bases)'''
+		block,size = [],0
+		with open(path, "rb") as f:
+			for line in f:
+				if line.startswith(b">"):
+					self.update(b"".join(block))
+					block,size = [],0
+					continue
+				block.append(line.rstrip())
+				size += len(block[-1])
+				if size >= blocksize:
+					sequence = b"".join(block)
+					self.update(sequence)
+					block = [sequence[-(self.kmer_size-1):]]
+					size = len(block[0])
+		self.update(b"".join(block))
+		return self
+
+	def distance(self,other):
+		'''Return the Mash distance to another sketch (1.0 if no k-mers are shared)'''
+		union = sorted(set(self.hashes).union(other.hashes))[:min(self.sketch_size,other.sketch_size)]
+		if not union:
+			return 1.0
+		shared = len(set(union).intersection(self.hashes).intersection(other.hashes))
+		if shared == len(union):
+			return 0.0
+		jaccard = shared/len(union)
+		if jaccard == 0:
+			return 1.0
+		return min(-1/self.kmer_size*log(2*jaccard/(1+jaccard)),1.0)
+
+def read_sketches(path):
+	'''Read the reference sketches of a database {reference: Sketch}, empty if the file is missing or outdated'''
+	try:
+		with open(path) as f:
+			data = json.load(f)
+	except (FileNotFoundError,ValueError):
+		return {}
+	if data.get("version") != SKETCH_VERSION:
+		return {}
+	return dict((reference,Sketch(hashes,data["kmer_size"],data["sketch_size"])) for reference,hashes in data["references"].items())
+
+def write_sketches(path,sketches):
+	'''Write the reference sketches of a database (atomically)'''
+	data = {"version": SKETCH_VERSION, "kmer_size": KMER_SIZE, "sketch_size": SKETCH_SIZE,
+			"references": dict((reference,sketch.hashes) for reference,sketch in sketches.items())}
+	tmp = path+".tmp"
+	with open(tmp, "w") as f:
+		json.dump(data,f)
+	os.replace(tmp,path)
+	return path
+
+def sketch_references(database,refdir):
+	'''Return the sketches of the references of a database {reference: Sketch}, references in refdir that
+		are missing or newer than the sketch file are sketched and the file is updated
+	'''
+	path = sketch_path(database)
+	sketches = read_sketches(path)
+	written = os.path.getmtime(path) if sketches else 0
+	changed = False
+	if not os.path.isdir(refdir):
+		logger.warning("Reference directory {refdir} of {database} could not be found".format(refdir=refdir,database=database))
+		return sketches
+	for ref in sorted(os.listdir(refdir)):
+		if not ref.endswith(".fna"):
+			continue
+		reference = ref.rsplit(".",1)[0]
+		if reference not in sketches or os.path.getmtime(os.path.join(refdir,ref)) > written:
+			logger.info("Sketch reference {reference}".format(reference=reference))
+			sketches[reference] = Sketch().add_fasta(os.path.join(refdir,ref))
+			changed = True
+	if changed:
+		try:
+			write_sketches(path,sketches)
+		except OSError as e:		## read-only database folder, the sketches are made again next time
+			logger.warning("Sketches could not be saved to {path} ({e})".format(path=path,e=e))
+	return sketches
+
+def route(sketch,databases,max_distance=0.1):
+	'''Return the database, reference and distance of the reference closest to a query sketch,
+		database is False if no reference is within max_distance (off target)
+			databases 	{database: {reference: Sketch}}
+	'''
+	best = (False,False,1.0)
+	for database,sketches in databases.items():
+		for reference,reference_sketch in sketches.items():
+			distance = sketch.distance(reference_sketch)
+			if distance < best[2]:
+				best = (database,reference,distance)
+	if best[2] > max_distance:
+		return False,best[1],best[2]
+	return best
+
+def route_queries(queries,databases,max_distance=0.1,outdir="."):
+	'''Route each query to the database of the closest reference, returns {database: [queries]} (off target queries are left out)
+			databases 	{database: reference folder}
+		the routes are written to {outdir}/routing.txt
+	'''
+	sketches = dict((database,sketch_references(database,refdir)) for database,refdir in databases.items())
+	routes = dict((database,[]) for database in databases)
+	os.makedirs(outdir,exist_ok=True)
+	with open(os.path.join(outdir,"routing.txt"), "w") as routing:
+		print("\t".join(["Query","Database","Reference","Distance"]),file=routing)
+		for query in queries:
+			try:
+				database,reference,distance = route(Sketch().add_fasta(query),sketches,max_distance)
+			except OSError as e:
+				logger.error("{query} could not be read ({e})".format(query=query,e=e))
+				continue
+			if database:
+				routes[database].append(query)
+				logger.info("{query}: {database} ({reference}, distance {distance:.3f})".format(query=query,database=database,reference=reference,distance=distance))
+			else:
+				logger.warning("{query} is off target (closest reference {reference}, distance {distance:.3f}), not aligned".format(query=query,reference=reference or "none",distance=distance))
+				print("{query}: off target".format(query=os.path.basename(query)))
+			print("\t".join([query,database or "off_target",reference or "",
+									"{distance:.4f}".format(distance=distance)]),file=routing)
+	return routes
@@ -0,0 +1,219 @@
+'''
+TreeRenderer renders CanSNPer2 trees (svg, newick, json or pdf using ETE3)
+
+The renderer only holds the tree layout, the newick string and the colors, so it can be
+sent once to each process of a RenderPool. The pool renders trees outside of the sample
+loop so that the calls are reported as soon as they are made.
+'''
+
+from multiprocessing import Pool
+from time import time
+import logging
+logger = logging.getLogger(__name__)
+
+## Supported tree output formats and their file endings, pdf requires ete3 (and Qt)
+tree_extensions = {
+	"svg": "svg",
+	"newick": "nwk",
+	"json": "json",
+	"pdf": "pdf"
+}
+
+## Node states as reported in annotated tree output (0 or missing means not aligned)
+snp_states = {
+	1: "derived",
+	2: "ancestral",
+	3: "other_base"
+}
+
+def CanSNPer_tree_layout(node):
+	'''Layout function for ETE3 trees.'''
+	import ete3
+	# Adds the name face to the image at the top side of the branch
+	if not node.is_root():
+		ete3.faces.add_face_to_node(ete3.AttrFace("name"), node, column=0, position="branch-top")
+
+class TreeRenderer(object):
+	"""TreeRenderer colors a CanSNPer2 tree given the SNP states of a sample and writes it to file"""
+	def __init__(self, svg_tree, newick, snp_colors):
+		super(TreeRenderer, self).__init__()
+		self.svg_tree = svg_tree			## SVGTree layout of the tree
+		self.newick = newick				## newick string used by ete3
+		self.snp_colors = snp_colors
+		self.ete3_tree = False				## ete3 tree parsed on first pdf render and then restyled for each sample
+
+	def __repr__(self):
+		return "TreeRenderer()"
+
+	def __getstate__(self):
+		'''The parsed ete3 tree is not sent to other processes, each process parses its own copy once'''
+		state = self.__dict__.copy()
+		state["ete3_tree"] = False
+		return state
+
+	def get_tree_file(self,prefix,tree_format="svg"):
+		'''Return the output path of a tree with the given format'''
+		return "{prefix}.{ext}".format(prefix=prefix,ext=tree_extensions[tree_format])
+
+	def get_node_style(self,name,snplist,called_snps=False):
+		'''Return the node style (ete3 NodeStyle keys) of a node given the snplist or the called snps,
+			returns False if the node should keep the default style
+		'''
+		nstyle = {
+			# If the SNP is missing due to a gap, make it grey
+			"fgcolor": self.snp_colors["non_aligned"],
+			"size": 10,
+			"vt_line_color": "#DDDDDD",
+			"hz_line_color": "#DDDDDD",
+			"vt_line_type": 1,
+			"hz_line_type": 1,
+			"vt_line_width": 2,
+			"hz_line_width": 2
+		}
+		if len(snplist) > 0:
+			try:
+				snpvalue = snplist[name]
+			except KeyError:
+				'''SNP not in list make grey'''
+				return False
+			if snpvalue == 2:
+				nstyle["fgcolor"] = self.snp_colors["ancestral"]
+				nstyle["size"] = 10
+				nstyle["vt_line_color"] = "#000000"
+				nstyle["hz_line_color"] = "#000000"
+				nstyle["vt_line_type"] = 0
+				nstyle["hz_line_type"] = 0
+				nstyle["vt_line_width"] = 2
+				nstyle["hz_line_width"] = 2
+			elif snpvalue == 1:
+				## If the SNP was derived make it green
+				nstyle["fgcolor"] = self.snp_colors["derived"]
+				nstyle["size"] = 15
+				nstyle["vt_line_color"] = "#000000"
+				nstyle["hz_line_color"] = "#000000"
+				nstyle["vt_line_type"] = 0
+				nstyle["hz_line_type"] = 0
+			elif snpvalue == 3:
+				## If the SNP was neither of ancestral or derived make it blue
+				nstyle["fgcolor"] = self.snp_colors["other_base"]
+				nstyle["size"] = 15
+				nstyle["vt_line_color"] = "#000000"
+				nstyle["hz_line_color"] = "#000000"
+				nstyle["vt_line_type"] = 0
+				nstyle["hz_line_type"] = 0
+		elif called_snps:
+			if name in called_snps:
+				### Only care about called SNPs and color all green
+				nstyle["fgcolor"] = self.snp_colors["derived"]
+				nstyle["size"] = 15
+			nstyle["vt_line_color"] = "#000000"
+			nstyle["hz_line_color"] = "#000000"
+			nstyle["vt_line_type"] = 0
+			nstyle["hz_line_type"] = 0
+		return nstyle
+
+	def get_node_state(self,name,snplist,called_snps=False):
+		'''Return the state of a node used in annotated tree output'''
+		if len(snplist) > 0:
+			return snp_states.get(snplist.get(name,0),"non_aligned")
+		elif called_snps and name in called_snps:
+			return "derived"
+		return "non_aligned"
+
+	def get_ete3_tree(self):
+		'''Parse the newick tree with ete3 (once per process)'''
+		if not self.ete3_tree:
+			import ete3
+			self.ete3_tree = ete3.Tree(self.newick, format=1)
+			farthest_leaf, self.tree_depth = self.ete3_tree.get_farthest_leaf()
+		return self.ete3_tree
+
+	def render_ete3_tree(self,path,snplist,called_snps=False):
+		'''Draws a phylogenetic tree using ETE3 and saves it to path (pdf)
+			All nodes are restyled so that the same parsed tree can be used for every sample
+		'''
+		import ete3
+		tree = self.get_ete3_tree()
+		for n in tree.traverse():
+			if n.name == "ROOT": ## Root should be just a line not a false "ancenstral node"
+				continue
+			nstyle = ete3.NodeStyle()
+			style = self.get_node_style(n.name,snplist,called_snps)
+			if style:
+				for key,value in style.items():
+					nstyle[key] = value
+			n.set_style(nstyle)
+		ts = ete3.TreeStyle()
+		ts.show_leaf_name = False  						# Do not print(leaf names, they are added in layout)
+		ts.show_scale = False  							# Do not show the scale
+		ts.layout_fn = CanSNPer_tree_layout  			# Use the custom layout
+		ts.optimal_scale_level = 'full' 			 	# Fully expand the branches of the tree
+		scale_factor = 500								# Tree scale factor, increases depth of tree to allow a higher resolution tree
+		tree.render(path, tree_style=ts, w=self.tree_depth * scale_factor)
+		return path
+
+	def render(self,prefix,snplist,called_snps=False,tree_format=["svg"]):
+		'''Render the tree in all requested formats, returns the list of files written'''
+		if called_snps and len(snplist) == 0:
+			called_snps = set(called_snps)
+		state = lambda name: self.get_node_state(name,snplist,called_snps)
+		default_style = self.get_node_style(False,{},False)
+		style = lambda name: self.get_node_style(name,snplist,called_snps) or default_style
+		files = []
+		for fmt in tree_format:
+			path = self.get_tree_file(prefix,fmt)
+			if fmt == "pdf":
+				self.render_ete3_tree(path,snplist,called_snps)
+			elif fmt == "svg":
+				self.svg_tree.write_svg(path,style)
+			elif fmt == "newick":
+				self.svg_tree.write_newick(path,state)
+			elif fmt == "json":
+				self.svg_tree.write_json(path,state)
+			files.append(path)
+		return files
+
+'''Render pool functions, the renderer is stored once in each worker process by the pool initializer'''
+_renderer = False
+
+def _init_worker(renderer):
+	global _renderer
+	_renderer = renderer
+
+def _render(prefix,snplist,called_snps,tree_format):
+	return _renderer.render(prefix,snplist,called_snps,tree_format)
+
+class RenderPool(object):
+	"""RenderPool renders trees in a bounded pool of processes, outside of the sample loop"""
+	def __init__(self, renderer, processes=2):
+		super(RenderPool, self).__init__()
+		self.processes = processes
+		self.pool = Pool(processes, initializer=_init_worker, initargs=(renderer,))
+		self.submitted = 0
+		self.rendered = 0
+		self.failed = 0
+		self.start = time()
+		logger.info("Render pool started with {n} processes".format(n=processes))
+
+	def __repr__(self):
+		return "RenderPool()"
+
+	def _done(self,files):
+		self.rendered += 1
+		logger.info("Tree rendered: {files}".format(files=", ".join(files)))
+
+	def _error(self,e):
+		self.failed += 1
+		logger.warning("Tree could not be rendered: {e}".format(e=e))
+
+	def submit(self,prefix,snplist,called_snps=False,tree_format=["svg"]):
+		'''Add a tree to the render queue'''
+		self.submitted += 1
+		self.pool.apply_async(_render, (prefix,snplist,called_snps,tree_format), callback=self._done, error_callback=self._error)
+
+	def close(self):
+		'''Wait for all queued trees to be rendered and shut down the pool'''
+		self.pool.close()
+		self.pool.join()
+		logger.info("Rendered {rendered}/{n} trees ({failed} failed) in {t:.1f}s".format(rendered=self.rendered,n=self.submitted,failed=self.failed,t=time()-self.start))
+		return self.rendered,self.failed
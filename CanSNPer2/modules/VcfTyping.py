@@ -0,0 +1,173 @@
+'''
+VcfTyping types SNPs from variant calls (VCF, bgzipped or not) made against one of the CanSNPer2 references
+
+The records are joined with the SNP catalogue by a sorted merge (the VCF has to be sorted by position within
+each contig, as written by all common variant callers), no alignment is made. The genotype of the first sample
+(GT) is used, sites only files use the first alternative allele. Records not passing the filters, missing
+genotypes, indels and symbolic alleles (<NON_REF>, * or no ALT) at SNP positions are missing calls.
+
+SNPs of the reference a VCF was called against (a contig of the reference is found in the file) that have no
+record are typed according to uncalled
+	missing 		not typed
+	ancestral 		typed as the ancestral base
+	reference 		typed as the base of the reference genome (variant callers only report differences to it)
+'''
+
+import os
+from bisect import bisect_right
+from time import time
+from CanSNPer2.modules.ReadTyping import open_reads,DERIVED,ANCESTRAL,OTHER
+from CanSNPer2.modules.SamTyping import get_contigs,get_contig_snps
+import logging
+logger = logging.getLogger(__name__)
+
+class VcfError(Exception):
+	def __init__(self, value):
+		self.value = value
+	def __str__(self):
+		return repr(self.value)
+
+def vcf_sample_name(path):
+	'''Return the sample name of a VCF file (file name without .vcf, .vcf.gz or .vcf.bgz)'''
+	name = os.path.basename(path)
+	for ending in [".gz",".bgz",".vcf"]:
+		if name.endswith(ending):
+			name = name[:-len(ending)]
+	return name
+
+def get_allele(allele):
+	'''Return the allele, False if it is not a sequence (no ALT ".", deletion "*" or symbolic "<NON_REF>")'''
+	if allele in (b".",b"*") or allele.startswith(b"<"):
+		return False
+	return allele
+
+def get_genotype(ref,alt,fmt,sample):
+	'''Return the called allele of a record (False if the genotype is missing, "N" if the sample is mixed)'''
+	alleles = [ref]+alt.split(b",")
+	if sample is None:		## sites only
+		return get_allele(alleles[1])
+	keys = fmt.split(b":")
+	if b"GT" not in keys:
+		return get_allele(alleles[1])
+	values = sample.split(b":")
+	gt = values[keys.index(b"GT")] if keys.index(b"GT") < len(values) else b"."
+	called = set(gt.replace(b"|",b"/").split(b"/"))
+	if b"." in called or b"" in called:
+		return False
+	if len(called) > 1:
+		return b"N"
+	return get_allele(alleles[int(called.pop())])
+
+class VcfTyper(object):
+	"""VcfTyper types SNPs from VCF files called against one of the references
+			xmfa_obj 		ParseXMFA object (gives the SNPs of each reference from the catalogue)
+			fasta_files 	{reference: FastaFile} reference genomes (contig names, lengths and bases)
+	"""
+	def __init__(self, xmfa_obj, fasta_files, references=[], uncalled="missing"):
+		super(VcfTyper, self).__init__()
+		self.xmfa_obj = xmfa_obj
+		self.fasta_files = fasta_files
+		self.uncalled = uncalled
+		self.contigs = get_contigs(fasta_files)
+		for reference in references:		## Single contig references can be named by the reference name (references are not required)
+			if reference.encode("utf-8") not in self.contigs:
+				self.contigs[reference.encode("utf-8")] = (reference,0,float("inf"))
+		self.contig_snps = {}
+		self.reference_bases = {}		## Bases of the reference genomes at SNP positions (uncalled="reference")
+
+	def __repr__(self):
+		return "VcfTyper({n} contigs)".format(n=len(self.contigs))
+
+	def get_contig_snps(self,contig):
+		if contig not in self.contig_snps:
+			self.contig_snps[contig] = get_contig_snps(self.xmfa_obj,*self.contigs[contig])
+		return self.contig_snps[contig]
+
+	def get_reference_base(self,reference,position):
+		'''Return the base of a reference genome at a position (counted over all contigs), False if the genome is not available'''
+		if reference not in self.fasta_files:
+			return False
+		if (reference,position) not in self.reference_bases:
+			fasta = self.fasta_files[reference]
+			starts = [self.contigs[name.encode("utf-8")][1] for name in fasta.names]
+			i = bisect_right(starts,position-1)-1
+			self.reference_bases[(reference,position)] = i >= 0 and fasta.get_base(fasta.names[i],position-starts[i])
+		return self.reference_bases[(reference,position)]
+
+	def read_calls(self,path):
+		'''Join the records of a sorted VCF file with the SNP catalogue
+			returns {(reference, position, ancestral, derived, snp_id): base (False if missing)} and the references found in the file
+		'''
+		calls,references,records,tic = {},set(),0,time()
+		contig,positions,snps,first,last = False,[],[],0,0
+		done,unknown = set(),set()
+		with open_reads(path) as f:
+			for line in f:
+				if line.startswith(b"#"):
+					continue
+				records += 1
+				chrom,pos,rest = line.split(b"\t",2)
+				if chrom != contig:
+					if chrom in done:
+						raise VcfError("{path} is not sorted ({contig} is found twice)".format(path=path,contig=chrom.decode("utf-8")))
+					done.add(contig)
+					contig,first,last = chrom,0,0
+					if contig in self.contigs:
+						positions,snps = self.get_contig_snps(contig)
+						references.add(self.contigs[contig][0])
+					else:
+						positions,snps = [],[]
+						unknown.add(contig)
+				pos = int(pos)
+				if pos < last:
+					raise VcfError("{path} is not sorted by position ({contig}:{pos})".format(path=path,contig=contig.decode("utf-8"),pos=pos))
+				last = pos
+				while first < len(positions) and positions[first] < pos:
+					first += 1
+				if first == len(positions):
+					continue
+				vid,ref,rest = rest.split(b"\t",2)
+				if positions[first] >= pos+len(ref):
+					continue		## the record does not cover the next SNP
+				fields = rest.rstrip(b"\r\n").split(b"\t",6)
+				alt,filt = fields[0],fields[2]
+				fmt,sample = (fields[4],fields[5]) if len(fields) > 5 else (b"",None)
+				allele = False
+				if filt in (b"PASS",b"."):
+					allele = get_genotype(ref,alt,fmt,sample)
+				j = first
+				while j < len(positions) and positions[j] < pos+len(ref):
+					if allele and (len(allele) == len(ref) or allele == b"N"):
+						calls[snps[j]] = chr(allele[0] if allele == b"N" else allele[positions[j]-pos]).upper()
+					else:
+						calls[snps[j]] = False		## missing genotype, filtered record or indel
+					j += 1
+		for contig in unknown:
+			logger.warning("{contig} in {path} is not a contig of the references".format(contig=contig.decode("utf-8"),path=os.path.basename(path)))
+		logger.debug("{records} records in {path} read in {t:.3f}s".format(records=records,path=os.path.basename(path),t=time()-tic))
+		return calls,references
+
+	def type_vcf(self,path,references=[]):
+		'''Type the SNPs of references (all if empty) from a VCF file, returns SNPS, SNP_info and called_snps (as ParseXMFA)'''
+		calls,called_references = self.read_calls(path)
+		if self.uncalled != "missing":
+			for reference in called_references:
+				for snppos,rbase,tbase,snp_id in self.xmfa_obj.get_reference_snps(reference).values():
+					snp = (reference,snppos,rbase,tbase,snp_id)
+					if snp not in calls:
+						calls[snp] = (self.uncalled == "reference" and self.get_reference_base(reference,snppos)) or rbase
+		references = set(ref.rsplit(".",1)[0] for ref in references)
+		SNPS,SNP_info,called_snps = {},[],[]
+		for (reference,snppos,rbase,tbase,snp_id),base in sorted(calls.items(),key=lambda item: (item[0][0],item[0][1])):
+			if not base or (references and reference not in references):
+				continue
+			if base == tbase:
+				SNPS[snp_id] = DERIVED
+				called_snps.append(snp_id)
+			elif base == rbase:
+				SNPS[snp_id] = ANCESTRAL
+			else:
+				SNPS[snp_id] = OTHER
+			SNP_info.append([snp_id,reference,str(snppos),rbase,tbase,base])
+		logger.info("{path}: {n} SNPs typed ({called} derived)".format(path=os.path.basename(path),n=len(SNPS),called=len(called_snps)))
+		return SNPS,SNP_info,called_snps
@@ -1,9 +1,18 @@
 #!/usr/bin/env python3
 '''
 CanSNPer self test for conda
-Check so that all required packages are installed
+Check so that all required packages are installed,
+that the command line tools start within the startup time budget
+and that SNPs are typed correctly from reads, SAM and VCF input (synthetic data)
 '''
 
+import os
+import sys
+import random
+import argparse
+import tempfile
+from subprocess import Popen,PIPE
+
 try:
 	import ete3
 except ImportError:
@@ -14,6 +23,166 @@ try:
 except ImportError:
 	raise ImportError("flextaxd could not be found!")
 
+## Modules behind the console scripts, these are imported by every invocation (also --help and --version)
+cli_modules = ["CanSNPer2.CanSNPerTree","CanSNPer2.SNPDatabase","CanSNPer2.DownloadGenomes"]
+## Packages that must only be imported by the code paths that need them
+heavy_modules = ["ete3","flextaxd","PyQt5","PyQt4","numpy"]
+
+STARTUP_SCRIPT = '''
+import sys,time
+t = time.perf_counter()
+import {module}
+print(time.perf_counter()-t)
+print(",".join(mod for mod in {heavy} if mod in sys.modules))
+'''
+
+def measure_startup(module,repeats=3):
+	'''Measure the import time of module in a fresh interpreter (best of repeats), returns time and heavy modules loaded'''
+	best,loaded = False,""
+	for i in range(repeats):
+		p = Popen([sys.executable,"-c",STARTUP_SCRIPT.format(module=module,heavy=heavy_modules)],stdout=PIPE,stderr=PIPE)
+		out,err = p.communicate()
+		if p.returncode != 0:
+			raise ImportError("{module} could not be imported!\n{err}".format(module=module,err=err.decode("utf-8")))
+		seconds,loaded = out.decode("utf-8").split("\n")[:2]
+		seconds = float(seconds)
+		if not best or seconds < best:
+			best = seconds
+	return best,loaded
+
+def check_startup(budget):
+	'''Check that each command line module imports within budget seconds without loading heavy dependencies'''
+	ok = True
+	for module in cli_modules:
+		seconds,loaded = measure_startup(module)
+		status = "ok"
+		if loaded:
+			status = "FAIL (imports {loaded})".format(loaded=loaded)
+			ok = False
+		elif seconds > budget:
+			status = "FAIL (budget {budget:.3f}s)".format(budget=budget)
+			ok = False
+		print("{module}: {ms:.1f} ms {status}".format(module=module,ms=seconds*1000,status=status))
+	return ok
+
+'''Synthetic sample for the typing self check
+	a reference of two contigs with six SNPs (positions count over both contigs), the sample carries the derived
+	base at S1, S3 (close to S2) and S5, the ancestral base at S2 and S6 and a third base at S4
+'''
+CONTIGS = [("synthetic_1",3000),("synthetic_2",2000)]
+SNPS = [("S1",500,"derived"),("S2",1500,"ancestral"),("S3",1520,"derived"),("S4",2500,"other"),("S5",3600,"derived"),("S6",4500,"ancestral")]
+READ_LENGTH = 100
+complement = str.maketrans("ACGT","TGCA")
+
+class SyntheticCatalogue(object):
+	"""SNP catalogue of the synthetic reference (replaces the CompiledDatabase)"""
+	def __init__(self, snps):
+		super(SyntheticCatalogue, self).__init__()
+		self.snps = snps
+
+	def get_snps(self, reference):
+		if reference != "synthetic":
+			return False
+		return self.snps,sorted(self.snps)
+
+def write_fasta(path,contigs):
+	with open(path, "w") as f:
+		for name,sequence in contigs:
+			print(">{name}".format(name=name),file=f)
+			for i in range(0,len(sequence),60):
+				print(sequence[i:i+60],file=f)
+
+def create_sample(directory):
+	'''Write the synthetic reference, reads, SAM and VCF files, returns the paths, the catalogue and the expected SNP states
+		of each input (reads only count the two alleles of a SNP, the VCF record of S6 has no ALT and no GT, a missing call)
+	'''
+	rng = random.Random(1)
+	reference = "".join(rng.choice("ACGT") for i in range(sum(length for name,length in CONTIGS)))
+	sample,snps = list(reference),{}
+	expected = {"derived": 1, "ancestral": 2, "other": 3}
+	states,vcf_records = {},[]
+	for snp_id,position,state in SNPS:
+		rbase = reference[position-1]
+		tbase,obase = [base for base in "ACGT" if base != rbase][:2]
+		snps[position] = (position,rbase,tbase,snp_id)
+		sample[position-1] = {"derived": tbase, "ancestral": rbase, "other": obase}[state]
+		states[snp_id] = expected[state]
+	sample = "".join(sample)
+	contigs,reference_contigs,start = [],[],0
+	for name,length in CONTIGS:
+		contigs.append((name,start,sample[start:start+length]))
+		reference_contigs.append((name,reference[start:start+length]))
+		start += length
+	paths = dict((ending,os.path.join(directory,"sample.{ending}".format(ending=ending))) for ending in ["fastq","sam","vcf"])
+	paths["fasta"] = os.path.join(directory,"synthetic.fna")
+	write_fasta(paths["fasta"],reference_contigs)
+	with open(paths["fastq"], "w") as fastq, open(paths["sam"], "w") as sam:
+		for name,length in CONTIGS:
+			print("@SQ\tSN:{name}\tLN:{length}".format(name=name,length=length),file=sam)
+		for name,start,sequence in contigs:
+			records = []
+			for i in range(0,len(sequence)-READ_LENGTH+1,10):
+				read = sequence[i:i+READ_LENGTH]
+				flag = 16 if i % 20 else 0
+				records.append((i+1,"r{n}\t{flag}\t{contig}\t{pos}\t60\t{length}M\t*\t0\t0\t{seq}\t{qual}".format(
+						n=start+i,flag=flag,contig=name,pos=i+1,length=READ_LENGTH,seq=read,qual="I"*READ_LENGTH)))
+				if flag:
+					read = read.translate(complement)[::-1]
+				print("@r{n}\n{seq}\n+\n{qual}".format(n=start+i,seq=read,qual="I"*READ_LENGTH),file=fastq)
+			## A record without a stored sequence, its alignment covers S1 after a deletion (must not be counted)
+			records.append((420,"nosequence\t0\t{contig}\t420\t60\t50M10D50M\t*\t0\t0\t*\t*".format(contig=name)))
+			for pos,record in sorted(records):
+				print(record,file=sam)
+	with open(paths["vcf"], "w") as f:
+		print("##fileformat=VCFv4.2",file=f)
+		print("\t".join(["#CHROM","POS","ID","REF","ALT","QUAL","FILTER","INFO","FORMAT","sample"]),file=f)
+		for snp_id,position,state in SNPS:
+			name,start,sequence = [contig for contig in contigs if contig[1] < position <= contig[1]+len(contig[2])][0]
+			rbase,base = reference[position-1],sample[position-1]
+			alt,fmt,gt = (".","GT","0") if state == "ancestral" else (base,"GT","1")
+			if snp_id == "S6":
+				fmt,gt = "DP","30"
+			print("\t".join([name,str(position-start),snp_id,rbase,alt,"50","PASS",".",fmt,gt]),file=f)
+	reads = dict((snp_id,state) for snp_id,state in states.items() if state != 3)
+	vcf = dict((snp_id,state) for snp_id,state in states.items() if snp_id != "S6")
+	return paths,SyntheticCatalogue(snps),{"reads": reads, "sam": states, "vcf": vcf}
+
+def check_typing():
+	'''Type the synthetic sample from reads, SAM and VCF input and compare the SNP states to the expected states'''
+	from CanSNPer2.modules.ParseXMFA import ParseXMFA
+	from CanSNPer2.modules.FastaIndex import FastaFile
+	from CanSNPer2.modules.ReadTyping import ReadTyper
+	from CanSNPer2.modules.SamTyping import SamTyper
+	from CanSNPer2.modules.VcfTyping import VcfTyper
+	ok = True
+	with tempfile.TemporaryDirectory() as directory:
+		paths,catalogue,expected = create_sample(directory)
+		xmfa_obj = ParseXMFA(catalogue=catalogue,export=False)
+		fasta_files = {"synthetic": FastaFile(paths["fasta"])}
+		read_typer = ReadTyper(xmfa_obj,fasta_files,workers=1)
+		try:
+			results = {"reads": read_typer.type_reads([paths["fastq"]])[0]}
+		finally:
+			read_typer.close()
+		results["sam"] = SamTyper(xmfa_obj,fasta_files).type_sam(paths["sam"])[0]
+		results["vcf"] = VcfTyper(xmfa_obj,fasta_files).type_vcf(paths["vcf"])[0]
+		fasta_files["synthetic"].close()
+	for source in ["reads","sam","vcf"]:
+		status = "ok"
+		if results[source] != expected[source]:
+			status = "FAIL (expected {expected}, typed {typed})".format(expected=expected[source],typed=results[source])
+			ok = False
+		print("typing from {source}: {status}".format(source=source,status=status))
+	return ok
 
 def main():
+	parser = argparse.ArgumentParser(description='CanSNPer2-test')
+	parser.add_argument('--startup_budget', type=float, default=0.25, help="Maximum import time in seconds for the command line tools (default 0.25)")
+	args = parser.parse_args()
 	print("required python packages installed!")
+	if not check_startup(args.startup_budget):
+		exit("Startup time budget exceeded!")
+	print("startup time within budget!")
+	if not check_typing():
+		exit("SNP typing self check failed!")
+	print("SNP typing from reads, SAM and VCF files is correct!")